@@ -0,0 +1,137 @@
+import argparse
+import os
+import random
+import time
+import tracemalloc
+from contextlib import redirect_stdout
+
+from langchain_core.messages import AIMessage
+
+from debug.fake_llm import (
+    ScriptedChatModel,
+    run_linux_shell_command,
+    sleep_through_turn,
+)
+from debug.fake_shell import fake_shell_backend
+from models.agents.prompt import prefix_stats
+from runtimes.runtime import use_shell_backend
+from shared.AgentPool import AgentPool
+from shared.CoreLLM import CoreLLM
+
+# Measures orchestration overhead of the hierarchy, apart from provider latency.
+# Both the LLM and the shell are in-process fakes, so every number below is our own hot path.
+# Usage: `python -m debug.benchmark --sizes 10 100 1000 --rounds 5`
+
+BRANCHING = 8
+MESSAGES_PER_PAIR = 20
+
+
+def scripted_policy(seed: int):
+    rng = random.Random(seed)
+
+    def script(_messages):
+        roll = rng.random()
+        if roll < 0.6:
+            return sleep_through_turn()
+        if roll < 0.85:
+            return run_linux_shell_command("ls")
+        return AIMessage("Progress update: still working on it.")
+
+    return script
+
+
+def build_tree(size: int):
+    # runtime imports - the fakes have to be in place before agents get created
+    from models.agents.general import General
+    from models.agents.user import User
+
+    AgentPool()._init()
+    user = User()
+    root = General(user.id, "Execute the user's orders", "Team Lead")
+    user.connect_to(root.id)
+    agents = [root]
+    while len(agents) < size:
+        parent = agents[(len(agents) - 1) // BRANCHING]
+        parent._tool_hire_worker(f"Worker {len(agents)}", "Benchmark sub-task.")
+        agents.append(list(parent.children.values())[-1])
+    AgentPool().message(user.id, root.id, "Benchmark the hierarchy.")
+    return user, root, agents
+
+
+def run_benchmark(
+    size: int, rounds: int, seed: int, llm_latency: float
+) -> dict[str, float]:
+    from shared.Scheduler import TreeScheduler
+
+    llm = ScriptedChatModel(script=scripted_policy(seed), latency=llm_latency)
+    CoreLLM.use(llm)
+    use_shell_backend(fake_shell_backend())
+
+    results = {"agents": size}
+    with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+        tracemalloc.start()
+        baseline, _ = tracemalloc.get_traced_memory()
+        user, root, agents = build_tree(size)
+        current, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        results["kib_per_agent"] = (current - baseline) / size / 1024
+
+        start = time.perf_counter()
+        for agent in agents:
+            agent._generate_prompt(agent.parent_id)
+        results["prompt_build_us"] = (time.perf_counter() - start) / size * 1e6
+
+        scheduler = TreeScheduler(root)
+        prefix_stats.reset()
+        start = time.perf_counter()
+        for _ in range(rounds):
+            scheduler.run_round()
+        elapsed = time.perf_counter() - start
+        scheduler.shutdown()
+        results["rounds_per_sec"] = rounds / elapsed
+        results["llm_calls_per_sec"] = llm.calls / elapsed
+        results["prefix_share_pct"] = prefix_stats.share() * 100
+
+        pool = AgentPool()
+        start = time.perf_counter()
+        for agent in agents:
+            for _ in range(MESSAGES_PER_PAIR):
+                pool.message(agent.parent_id, agent.id, "ping")
+        results["messages_per_sec"] = (
+            size * MESSAGES_PER_PAIR / (time.perf_counter() - start)
+        )
+    return results
+
+
+COLUMNS = [
+    ("agents", ".0f"),
+    ("rounds_per_sec", ".2f"),
+    ("llm_calls_per_sec", ".1f"),
+    ("prompt_build_us", ".1f"),
+    ("prefix_share_pct", ".1f"),
+    ("kib_per_agent", ".1f"),
+    ("messages_per_sec", ".0f"),
+]
+
+
+def print_table(rows: list[dict[str, float]]):
+    print(" ".join(name for name, _ in COLUMNS))
+    for row in rows:
+        print(" ".join(f"{row[name]:>{len(name)}{fmt}}" for name, fmt in COLUMNS))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 100, 1000])
+    parser.add_argument("--rounds", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--llm-latency", type=float, default=0.0)
+    parser.add_argument("--layout", choices=["classic", "cache"], default=None)
+    args = parser.parse_args()
+    if args.layout is not None:
+        import models.agents.general
+
+        models.agents.general.PROMPT_LAYOUT = args.layout
+    print_table(
+        [run_benchmark(n, args.rounds, args.seed, args.llm_latency) for n in args.sizes]
+    )
@@ -0,0 +1,104 @@
+import hashlib
+import os
+from threading import Lock
+from typing import Any, Callable, Literal, TypeVar
+
+import orjson
+import zstandard
+
+from shared.frames import iter_frames, pack_frame
+
+# Record/replay of every non-deterministic interaction: LLM calls, shell commands and project trees.
+# A cassette is an append-only file of length-prefixed zstd frames, each holding one orjson entry.
+# Entries are keyed by a stable hash of their input, repeated inputs are served in recorded order.
+# Replays need deterministic agent ids, see `AgentPool.use_deterministic_ids`.
+
+T = TypeVar("T")
+
+
+class CassetteMiss(KeyError):
+    pass
+
+
+def stable_hash(value: Any) -> str:
+    return hashlib.sha256(orjson.dumps(value, option=orjson.OPT_SORT_KEYS)).hexdigest()
+
+
+class Cassette:
+    def __init__(self, path: str, mode: Literal["record", "replay"]):
+        self.path = path
+        self.mode = mode
+        self._entries: dict[tuple[str, str], list[Any]] = {}
+        self._served: dict[tuple[str, str], int] = {}
+        self._lock = Lock()
+        self._file = None
+        if mode == "replay":
+            self._load()
+        else:
+            # sessions never get mixed, and a torn tail could swallow the new frames
+            if os.path.exists(path) and os.path.getsize(path) > 0:
+                raise FileExistsError(
+                    f"Cassette {path} already holds a recording, replay it or remove it."
+                )
+            self._compressor = zstandard.ZstdCompressor()
+            self._file = open(path, "wb")
+
+    def _load(self):
+        decompressor = zstandard.ZstdDecompressor()
+        with open(self.path, "rb") as f:
+            data = f.read()
+        for frame in iter_frames(data):
+            entry = orjson.loads(decompressor.decompress(frame))
+            self._entries.setdefault((entry["kind"], entry["key"]), []).append(
+                entry["data"]
+            )
+
+    def append(self, kind: str, key: str, data: Any):
+        entry = orjson.dumps({"kind": kind, "key": key, "data": data})
+        with self._lock:
+            # compressors are not thread-safe
+            self._file.write(pack_frame(self._compressor.compress(entry)))
+            self._file.flush()
+
+    def next(self, kind: str, key: str) -> Any:
+        with self._lock:
+            recorded = self._entries.get((kind, key), [])
+            served = self._served.get((kind, key), 0)
+            if served >= len(recorded):
+                raise CassetteMiss(f"No recorded {kind} entry left for key {key}.")
+            self._served[(kind, key)] = served + 1
+            return recorded[served]
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+_active: Cassette | None = None
+
+
+def use_cassette(path: str, mode: Literal["record", "replay"]) -> Cassette:
+    global _active
+    _active = Cassette(path, mode)
+    return _active
+
+
+def active_cassette() -> Cassette | None:
+    return _active
+
+
+def recorded(
+    kind: str,
+    key: str,
+    produce: Callable[[], T],
+    encode: Callable[[T], Any] = lambda v: v,
+    decode: Callable[[Any], T] = lambda v: v,
+) -> T:
+    if _active is None:
+        return produce()
+    if _active.mode == "replay":
+        return decode(_active.next(kind, key))
+    value = produce()
+    _active.append(kind, key, encode(value))
+    return value
@@ -0,0 +1,91 @@
+import json
+import time
+from typing import Any, Callable, Iterator
+from uuid import uuid4
+
+from langchain_core.language_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+
+# Deterministic stand-in for the provider model, set in place of it with `CoreLLM.use(...)`.
+# The script is either a list of responses (cycled through) or a callable receiving the prompt.
+
+Script = list[AIMessage] | Callable[[list[BaseMessage]], AIMessage]
+
+
+def tool_call_message(name: str, content: str = "", **args) -> AIMessage:
+    return AIMessage(
+        content,
+        tool_calls=[{"name": name, "args": args, "id": f"call_{uuid4().hex[:8]}"}],
+    )
+
+
+def hire_worker(worker_label: str, task_description: str) -> AIMessage:
+    return tool_call_message(
+        "hire_worker",
+        worker_label=worker_label,
+        task_description=task_description,
+    )
+
+
+def run_linux_shell_command(command: str) -> AIMessage:
+    return tool_call_message("run_linux_shell_command", command=command)
+
+
+def sleep_through_turn() -> AIMessage:
+    return tool_call_message("sleep_through_turn")
+
+
+class ScriptedChatModel(BaseChatModel):
+    script: Any
+    latency: float = 0.0  # seconds per call
+    calls: int = 0
+
+    @property
+    def _llm_type(self) -> str:
+        return "scripted-fake"
+
+    def bind_tools(self, tools, **kwargs):
+        # tool schemas are irrelevant to a scripted model
+        return self
+
+    def _next_message(self, messages: list[BaseMessage]) -> AIMessage:
+        if callable(self.script):
+            return self.script(messages)
+        return self.script[self.calls % len(self.script)]
+
+    def _scripted_message(self, messages: list[BaseMessage]) -> AIMessage:
+        message = self._next_message(messages)
+        self.calls += 1
+        # copies keep each call's tool call ids unique
+        return AIMessage(
+            message.content,
+            tool_calls=[
+                {**t, "id": f"call_{uuid4().hex[:8]}"} for t in message.tool_calls
+            ],
+        )
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        if self.latency > 0:
+            time.sleep(self.latency)
+        message = self._scripted_message(messages)
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    def _stream(
+        self, messages, stop=None, run_manager=None, **kwargs
+    ) -> Iterator[ChatGenerationChunk]:
+        # the text first, then one chunk per tool call, the latency is spread evenly between them
+        message = self._scripted_message(messages)
+        parts = [AIMessageChunk(content=message.content)]
+        for i, tool_call in enumerate(message.tool_calls):
+            tool_call_chunk = {
+                "name": tool_call["name"],
+                "args": json.dumps(tool_call["args"]),
+                "id": tool_call["id"],
+                "index": i,
+            }
+            parts.append(AIMessageChunk(content="", tool_call_chunks=[tool_call_chunk]))
+        for part in parts:
+            if self.latency > 0:
+                time.sleep(self.latency / len(parts))
+            yield ChatGenerationChunk(message=part)
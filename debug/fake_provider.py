@@ -0,0 +1,135 @@
+import argparse
+import itertools
+import json
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock
+
+# Minimal OpenAI-compatible chat endpoint, for exercising CoreLLM's rate limiting locally.
+# Streamed requests, i.e. `"stream": true`, are answered with server-sent events.
+# Usage: `python -m debug.fake_provider --reject-every 3`, then run with
+#        GROQ_BASE_URL=http://127.0.0.1:8900 GROQ_API_KEY=fake
+
+LIMIT_HEADERS = {
+    "x-ratelimit-remaining-requests": "1000",
+    "x-ratelimit-remaining-tokens": "100000",
+    "x-ratelimit-reset-requests": "1m0s",
+    "x-ratelimit-reset-tokens": "0.5s",
+}
+
+
+class FakeProviderHandler(BaseHTTPRequestHandler):
+    reject_every = 0  # every n-th request gets a 429, 0 disables
+    retry_after = 1.0
+    latency = 0.0
+    _counter = itertools.count(1)
+    _lock = Lock()
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status: int, body: dict, headers: dict[str, str]):
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("content-type", "application/json")
+        self.send_header("content-length", str(len(payload)))
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_POST(self):
+        length = int(self.headers.get("content-length", 0))
+        request = json.loads(self.rfile.read(length) or b"{}")
+        with self._lock:
+            n = next(self._counter)
+
+        if self.reject_every > 0 and n % self.reject_every == 0:
+            self._send_json(
+                429,
+                {"error": {"message": "Rate limit reached", "type": "tokens"}},
+                {"retry-after": str(self.retry_after)},
+            )
+            return
+
+        time.sleep(self.latency)
+        reply = f"Fake reply #{n}."
+        usage = {"prompt_tokens": 10, "completion_tokens": 5, "total_tokens": 15}
+        if request.get("stream"):
+            self._send_stream(n, request.get("model", "fake"), reply, usage)
+            return
+        self._send_json(
+            200,
+            {
+                "id": f"fake-{n}",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": request.get("model", "fake"),
+                "choices": [
+                    {
+                        "index": 0,
+                        "message": {"role": "assistant", "content": reply},
+                        "finish_reason": "stop",
+                    }
+                ],
+                "usage": usage,
+            },
+            LIMIT_HEADERS,
+        )
+
+    def _send_stream(self, n: int, model: str, reply: str, usage: dict):
+        # server-sent events, the reply comes word by word, usage along with the last chunk
+        self.send_response(200)
+        self.send_header("content-type", "text/event-stream")
+        for key, value in LIMIT_HEADERS.items():
+            self.send_header(key, value)
+        self.end_headers()
+        words = reply.split(" ")
+        deltas = [{"role": "assistant", "content": ""}] + [
+            {"content": w if i == 0 else f" {w}"} for i, w in enumerate(words)
+        ]
+        for i, delta in enumerate(deltas + [{}]):
+            last = i == len(deltas)
+            chunk = {
+                "id": f"fake-{n}",
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [
+                    {
+                        "index": 0,
+                        "delta": delta,
+                        "finish_reason": "stop" if last else None,
+                    }
+                ],
+            }
+            if last:
+                chunk["x_groq"] = {"usage": usage}
+            self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode())
+            self.wfile.flush()
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.wfile.flush()
+
+
+def create_server(
+    port: int, reject_every: int, retry_after: float, latency: float
+) -> ThreadingHTTPServer:
+    FakeProviderHandler.reject_every = reject_every
+    FakeProviderHandler.retry_after = retry_after
+    FakeProviderHandler.latency = latency
+    FakeProviderHandler._counter = itertools.count(1)
+    return ThreadingHTTPServer(("127.0.0.1", port), FakeProviderHandler)
+
+
+def serve(port: int, reject_every: int, retry_after: float, latency: float):
+    create_server(port, reject_every, retry_after, latency).serve_forever()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=8900)
+    parser.add_argument("--reject-every", type=int, default=3)
+    parser.add_argument("--retry-after", type=float, default=1.0)
+    parser.add_argument("--latency", type=float, default=0.0)
+    args = parser.parse_args()
+    serve(args.port, args.reject_every, args.retry_after, args.latency)
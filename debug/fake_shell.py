@@ -0,0 +1,58 @@
+import time
+from threading import Lock
+from typing import Callable
+
+# In-process stand-in for a docker shell session, see `runtimes.runtime.use_shell_backend`.
+# Commands are answered by a callable, no processes are spawned.
+
+Responder = Callable[[str], tuple[str, int]]
+
+
+def echo_responder(command_text: str) -> tuple[str, int]:
+    return f"$ {command_text}\n", 0
+
+
+class FakeShellSession:
+    def __init__(self, responder: Responder = echo_responder, latency: float = 0.0):
+        self.responder = responder
+        self.latency = latency
+        self.commands: list[str] = []
+        self.closed = False
+        self.cwd: str | None = None
+        self._lock = Lock()
+
+    def is_alive(self) -> bool:
+        return not self.closed
+
+    def run(
+        self,
+        command_text: str,
+        timeout: float,
+        wait: bool = True,
+    ) -> tuple[str, int | None, bool] | None:
+        if not self._lock.acquire(blocking=wait):
+            return None
+        try:
+            return self._run(command_text, timeout)
+        finally:
+            self._lock.release()
+
+    def _run(self, command_text: str, timeout: float) -> tuple[str, int | None, bool]:
+        self.commands.append(command_text)
+        if self.latency > timeout:
+            time.sleep(timeout)
+            return "", None, True
+        if self.latency > 0:
+            time.sleep(self.latency)
+        out, code = self.responder(command_text)
+        return out, code, False
+
+    def close(self):
+        self.closed = True
+
+
+def fake_shell_backend(
+    responder: Responder = echo_responder,
+    latency: float = 0.0,
+) -> Callable[[str], FakeShellSession]:
+    return lambda _instance_id: FakeShellSession(responder, latency)
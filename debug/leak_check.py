@@ -0,0 +1,72 @@
+import os
+
+from models.agents.base import Agent
+from runtimes.runtime import live_sessions
+from shared.AgentPool import AgentPool
+
+# Cross-checks everything holding resources against the live agent tree, see `CORTEX_LEAK_CHECK` in main.
+# Pool entries, chats and shell sessions not reachable from the root are reported as leaked.
+
+
+def _tree_ids(root: Agent) -> set[str]:
+    ids = set()
+    stack = [root]
+    while len(stack) > 0:
+        agent = stack.pop()
+        ids.add(agent.id)
+        stack.extend(getattr(agent, "children", {}).values())
+    return ids
+
+
+def _child_process_count() -> int | None:
+    # direct children of this process, linux only
+    try:
+        count = 0
+        for task in os.listdir("/proc/self/task"):
+            with open(f"/proc/self/task/{task}/children") as f:
+                count += len(f.read().split())
+        return count
+    except OSError:
+        return None
+
+
+def _rss_mib() -> float | None:
+    try:
+        with open("/proc/self/statm") as f:
+            resident_pages = int(f.read().split()[1])
+        return resident_pages * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except (OSError, ValueError):
+        return None
+
+
+def leak_report(root: Agent, user: Agent) -> str:
+    expected = _tree_ids(root) | {user.id}
+    pool = {i: a for i, a in AgentPool()._store.items() if a is not None}
+    sessions = live_sessions()
+    # internal instances, e.g. the health check one, are not tied to agents
+    agent_sessions = {i: s for i, s in sessions.items() if not i.startswith("__")}
+
+    leaks = []
+    for agent_id in pool.keys() - expected:
+        leaks.append(f"agent {agent_id} is pooled, but not in the tree")
+    for agent_id in expected - pool.keys():
+        leaks.append(f"agent {agent_id} is in the tree, but not pooled")
+    for agent_id, agent in pool.items():
+        for peer_id in agent.external_chats.keys() - pool.keys():
+            leaks.append(f"agent {agent_id} holds a chat with removed agent {peer_id}")
+    for instance_id in agent_sessions.keys() - expected:
+        count = len(agent_sessions[instance_id])
+        if count > 0:
+            leaks.append(
+                f"{count} shell session(s) of removed agent {instance_id} still alive"
+            )
+
+    processes = _child_process_count()
+    rss = _rss_mib()
+    summary = (
+        f"LEAK CHECK: {len(expected)} in tree, {len(pool)} pooled, "
+        f"{sum(len(s) for s in sessions.values())} live shells, "
+        f"{'?' if processes is None else processes} child processes, "
+        f"RSS {'?' if rss is None else f'{rss:.1f} MiB'}"
+    )
+    return "\n".join([summary, *(f"  LEAK: {leak}" for leak in leaks)])
@@ -0,0 +1,49 @@
+import os
+import time
+
+from shared.Service import Service
+
+# Launch-to-prompt timings, see `CORTEX_STARTUP_PROFILE` in main.
+# Times are relative to the process start, interpreter boot and imports of main included.
+
+
+def process_age() -> float | None:
+    # seconds since this process got started, linux only
+    try:
+        with open("/proc/self/stat") as f:
+            # fields after the parenthesised command name, starting at the 3rd one
+            start_ticks = int(f.read().rsplit(")", 1)[1].split()[19])
+        with open("/proc/uptime") as f:
+            uptime = float(f.read().split()[0])
+        return uptime - start_ticks / os.sysconf("SC_CLK_TCK")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+class StartupProfile:
+    def __init__(self):
+        age = process_age()
+        self.origin = time.perf_counter() - (age or 0.0)
+        self.exact = age is not None  # otherwise relative to the profile's creation
+        self.marks: list[tuple[str, float]] = []
+
+    def mark(self, name: str):
+        self.marks.append((name, time.perf_counter() - self.origin))
+
+    def report(self, services: list[Service]) -> str:
+        since = "launch" if self.exact else "main"
+        lines = [f"STARTUP PROFILE (ms since {since}):"]
+        for name, at in self.marks:
+            lines.append(f"  {name:<28} {at * 1000:8.1f}")
+        for service in services:
+            if service.started_at is None:
+                lines.append(f"  service {service.name:<20} {'not started':>8}")
+                continue
+            start = (service.started_at - self.origin) * 1000
+            took = (
+                "running"
+                if service.duration is None
+                else f"took {service.duration * 1000:.1f}"
+            )
+            lines.append(f"  service {service.name:<20} {start:8.1f}  {took}")
+        return "\n".join(lines)
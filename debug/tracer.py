@@ -1,7 +1,29 @@
+import atexit
+import os
+import sys
+import time
+from collections import deque
 from enum import Enum
+from threading import Condition, Thread
+from typing import Any
 
+import orjson
 from colorama import Fore, Back, Style
 
+# Traces are structured events on a bus, the hot path only enqueues them.
+# A bounded ring buffer holds them until a background writer hands them over to the sinks,
+# once it's full the oldest events get dropped, turns never wait for the terminal.
+# Kinds no sink is interested in are skipped before anything is allocated.
+
+TRACE_BUFFER_SIZE = 4096  # events
+TRACE_CONSOLE = os.getenv("CORTEX_TRACE", "1") != "0"
+# comma separated, e.g. "CHAT,SHELL", all by default
+TRACE_KINDS = os.getenv("CORTEX_TRACE_KINDS", "")
+# per console event, 0 disables truncation
+TRACE_MAX_CHARS = int(os.getenv("CORTEX_TRACE_MAX_CHARS", "2000"))
+# path, full events are appended as json lines
+TRACE_JSONL = os.getenv("CORTEX_TRACE_JSONL")
+
 
 class Trace(Enum):
     # no simple way to convert front-color to back-color
@@ -14,7 +36,195 @@ class Trace(Enum):
     DEL_TASK = (Fore.LIGHTRED_EX, Back.LIGHTRED_EX)
 
 
-def trace(kind: Trace, header: str, message: str = ""):
-    trace_head = f"{kind.value[1]}  {Style.RESET_ALL}"
-    trace_body = f"{kind.value[0]}{header}{Style.RESET_ALL}{message}"
-    print(f"{trace_head} {trace_body}")
+def parse_kinds(names: str) -> frozenset[Trace]:
+    if names.strip() == "":
+        return frozenset(Trace)
+    return frozenset(
+        Trace[name.strip().upper()] for name in names.split(",") if name.strip() != ""
+    )
+
+
+class TraceEvent:
+    __slots__ = ("time", "kind", "header", "message")
+
+    def __init__(self, kind: Trace, header: str, message: Any):
+        self.time = time.time()
+        self.kind = kind
+        self.header = header
+        self.message = message  # formatted by the writer, off the hot path
+
+
+class TraceSink:
+    def __init__(self, kinds: frozenset[Trace] = frozenset(Trace)):
+        self.kinds = kinds
+
+    def write(self, events: list[TraceEvent]):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class ConsoleSink(TraceSink):
+    def __init__(
+        self,
+        kinds: frozenset[Trace] = frozenset(Trace),
+        max_chars: int = TRACE_MAX_CHARS,
+    ):
+        super().__init__(kinds)
+        self.max_chars = max_chars
+
+    def _format(self, event: TraceEvent) -> str:
+        message = str(event.message)
+        if 0 < self.max_chars < len(message):
+            message = f"{message[: self.max_chars]}... ({len(message) - self.max_chars} more chars)"
+        trace_head = f"{event.kind.value[1]}  {Style.RESET_ALL}"
+        trace_body = f"{event.kind.value[0]}{event.header}{Style.RESET_ALL}{message}"
+        return f"{trace_head} {trace_body}\n"
+
+    def write(self, events: list[TraceEvent]):
+        # a single write per batch, instead of a print per event
+        sys.stdout.write("".join(self._format(e) for e in events))
+        sys.stdout.flush()
+
+
+class JsonlSink(TraceSink):
+    def __init__(self, path: str, kinds: frozenset[Trace] = frozenset(Trace)):
+        super().__init__(kinds)
+        self.path = path
+        self._file = None  # opened with the first batch
+
+    def write(self, events: list[TraceEvent]):
+        if self._file is None:
+            self._file = open(self.path, "ab")
+        for e in events:
+            record = {
+                "time": e.time,
+                "kind": e.kind.name,
+                "header": e.header,
+                "message": str(e.message),
+            }
+            self._file.write(orjson.dumps(record) + b"\n")
+        self._file.flush()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class TraceBus:
+    def __init__(self, capacity: int = TRACE_BUFFER_SIZE):
+        self.sinks: list[TraceSink] = []
+        self.dropped = 0
+        self._wanted: frozenset[Trace] = frozenset()
+        self._events: deque[TraceEvent] = deque(maxlen=capacity)
+        self._cond = Condition()
+        self._writing = False
+        self._writer: Thread | None = None
+
+    def add_sink(self, sink: TraceSink):
+        with self._cond:
+            self.sinks = [*self.sinks, sink]
+            self._wanted = self._wanted | sink.kinds
+
+    def remove_sink(self, sink: TraceSink):
+        self.flush()
+        with self._cond:
+            self.sinks = [s for s in self.sinks if s is not sink]
+            self._wanted = frozenset(k for s in self.sinks for k in s.kinds)
+        sink.close()
+
+    def publish(self, kind: Trace, header: str, message: Any = ""):
+        if kind not in self._wanted:
+            return
+        event = TraceEvent(kind, header, message)
+        with self._cond:
+            if len(self._events) == self._events.maxlen:
+                self.dropped += 1
+            self._events.append(event)
+            if self._writer is None:
+                self._start_writer()
+            self._cond.notify()
+
+    def _start_writer(self):
+        # started with the first event, importing the tracer starts nothing
+        self._writer = Thread(target=self._write_loop, name="trace-writer", daemon=True)
+        self._writer.start()
+        atexit.register(self.flush)
+
+    def _write_loop(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: len(self._events) > 0)
+                batch = list(self._events)
+                self._events.clear()
+                dropped, self.dropped = self.dropped, 0
+                sinks = self.sinks
+                self._writing = True
+            if dropped > 0:
+                batch.insert(
+                    0,
+                    TraceEvent(
+                        Trace.THINK,
+                        f"{dropped} trace events dropped, the writer fell behind.",
+                        "",
+                    ),
+                )
+            try:
+                for sink in sinks:
+                    events = [e for e in batch if e.kind in sink.kinds]
+                    if len(events) > 0:
+                        sink.write(events)
+            except Exception as e:
+                # tracing must never take the tree down
+                sys.stderr.write(f"Trace sink failed: {e}\n")
+            finally:
+                with self._cond:
+                    self._writing = False
+                    self._cond.notify_all()
+
+    def flush(self, timeout: float = 5.0):
+        # waits until everything published so far has been written out
+        with self._cond:
+            if self._writer is None:
+                return
+            self._cond.notify()
+            self._cond.wait_for(
+                lambda: len(self._events) == 0 and not self._writing, timeout
+            )
+
+
+trace_bus = TraceBus()
+if TRACE_CONSOLE:
+    trace_bus.add_sink(ConsoleSink(parse_kinds(TRACE_KINDS)))
+if TRACE_JSONL:
+    trace_bus.add_sink(JsonlSink(TRACE_JSONL, parse_kinds(TRACE_KINDS)))
+
+
+def trace(kind: Trace, header: str, message: Any = ""):
+    trace_bus.publish(kind, header, message)
+
+
+def flush_traces():
+    trace_bus.flush()
+
+
+class TraceStream:
+    # Streams generated text into the trace line by line, concurrent streams never interleave mid-line.
+
+    def __init__(self, kind: Trace, header: str):
+        self.kind = kind
+        self.header = header
+        self._buffer = ""
+
+    def write(self, text: str):
+        self._buffer += text
+        *lines, self._buffer = self._buffer.split("\n")
+        for line in lines:
+            trace(self.kind, self.header, line)
+
+    def close(self):
+        if self._buffer != "":
+            trace(self.kind, self.header, self._buffer)
+            self._buffer = ""
@@ -2,8 +2,10 @@ from models.agents.base import Agent
 from models.agents.general import General
 
 
-def visualize_tree(root: Agent, indent=0):
-    print(" " * indent + f"- [{root.type}] {root.label}")
+def visualize_tree(root: Agent, indent=0, paused: set[str] = frozenset()):
+    # ids are what the console addresses agents by
+    mark = " (paused)" if root.id in paused else ""
+    print(" " * indent + f"- [{root.type}] {root.label} [id: {root.id}]{mark}")
     if isinstance(root, General):
         for child in root.children.values():
-            visualize_tree(child, indent + 1)
+            visualize_tree(child, indent + 1, paused)
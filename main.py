@@ -1,10 +1,12 @@
+import os
+import select
+import sys
+
 from colorama import Back, Style, Fore
 
-from debug.visualizer import visualize_tree
-from models.agents.general import General
-from models.agents.user import User
-from runtimes.runtime import is_linux_ok
-from shared.AgentPool import AgentPool
+from debug.cassette import use_cassette, recorded, CassetteMiss
+from debug.startup_profile import StartupProfile
+from shared.Service import Service
 from shared.logo import logo
 
 # note: We're not doing any persistent thinking functions
@@ -16,39 +18,195 @@ from shared.logo import logo
 # note: there doesn't seem to be a need for an id-based pool of agents, thus sticking to a ref-tree
 
 
-# todo: impl async user chat or injection CLI
-#       user should be able to contact ANY member of the hierarchy
-
-
 SECTION_SEP = f"{Fore.LIGHTRED_EX}{Back.LIGHTWHITE_EX}-------------------------------{Style.RESET_ALL}"
 INPUT_MSG = f"{Back.YELLOW}Write message to root AI:{Style.RESET_ALL} "
 
 # todo: add retry conditions to tools, retry response on said fail
 
 
-def main():
-    is_linux_ok()
-    user_agent = User()
-    root_manager = General(user_agent.id, "Execute the user's orders", "Team Lead")
+# Record/replay of all LLM, shell and project tree interactions, e.g. for reproducing incidents.
+CASSETTE_PATH = os.getenv("CORTEX_CASSETTE")
+CASSETTE_MODE = os.getenv("CORTEX_CASSETTE_MODE", "record")
+
+# Reports agents, chats and shell processes outliving the tree after every round.
+LEAK_CHECK = os.getenv("CORTEX_LEAK_CHECK", "") not in ("", "0")
+
+# Append-only delta log of the whole hierarchy, resumed from on startup if it exists.
+CHECKPOINT_PATH = os.getenv("CORTEX_CHECKPOINT")
+
+# Prints launch-to-prompt timings, and how long each startup service took.
+STARTUP_PROFILE = os.getenv("CORTEX_STARTUP_PROFILE", "") not in ("", "0")
+
+# Serves per-agent latency and token metrics at `http://127.0.0.1:<port>/metrics`, in Prometheus text format.
+METRICS_PORT = int(os.getenv("CORTEX_METRICS_PORT", "0"))
+
+
+# Heavy lifting happens in services, while the user types the first message.
+# Only what is needed to show the prompt gets imported up front.
+
+
+def _import_agents():
+    # the heaviest imports - langchain, and the schemas of every tool
+    from models.agents.general import General
+    from models.agents.user import User
+
+    return General, User
+
+
+def _warm_up_llm(agents: Service) -> None:
+    General, _ = agents.result()
+    from shared.CoreLLM import CoreLLM
+
+    router = CoreLLM()
+    for client in set(router.routes.values()):
+        client.warm_up(General._available_tools)
+
+
+def _unrecorded_command(command_text: str) -> tuple[str, int]:
+    raise CassetteMiss(f"No recorded shell output for: {command_text}")
+
+
+def _use_replay_shells():
+    # every shell output comes from the cassette, replays start no containers or processes
+    from debug.fake_shell import fake_shell_backend
+    from runtimes.runtime import use_shell_backend
 
-    user_agent.connect_to(root_manager.id)
+    use_shell_backend(fake_shell_backend(_unrecorded_command))
+
+
+def _check_linux(report: list[str]) -> bool:
+    from runtimes.runtime import is_linux_ok
+
+    return is_linux_ok(report.append)
+
+
+PROMPT_POLL_INTERVAL = 0.2  # seconds, how soon the prompt notices the tree has stopped
+
+
+def _read_line(console) -> str | None:
+    # None once the tree stops, the operator isn't left typing into a dead console
+    while console.is_running():
+        ready, _, _ = select.select([sys.stdin], [], [], PROMPT_POLL_INTERVAL)
+        if len(ready) > 0:
+            line = sys.stdin.readline()
+            return line if line != "" else "/quit"
+    return None
+
+
+def main():
+    profile = StartupProfile()
+    profile.mark("main imported")
+    replaying = bool(CASSETTE_PATH) and CASSETTE_MODE == "replay"
+    if CASSETTE_PATH:
+        use_cassette(CASSETTE_PATH, CASSETTE_MODE)
+    if replaying:
+        _use_replay_shells()
+
+    health_report: list[str] = []
+    agents = Service("agents", _import_agents).start()
+    llm = Service("llm", lambda: _warm_up_llm(agents)).start()
+    health = Service("linux", lambda: _check_linux(health_report))
+    if not replaying:
+        health.start()
 
     print(logo)
 
-    message = input(INPUT_MSG)
-    AgentPool().message(user_agent.id, root_manager.id, message)
+    resuming = (
+        bool(CHECKPOINT_PATH)
+        and os.path.exists(CHECKPOINT_PATH)
+        and os.path.getsize(CHECKPOINT_PATH) > 0
+    )
+    message = None
+    if not resuming:
+        profile.mark("first prompt")
+        message = recorded("input", "user", lambda: input(INPUT_MSG))
+
+    General, User = agents.result()
+    from debug.leak_check import leak_report
+    from debug.tracer import flush_traces
+    from debug.visualizer import visualize_tree
+    from shared.AgentPool import AgentPool
+    from shared.Checkpoint import Checkpoint
+    from shared.Console import CONSOLE_HELP, Console
+    from shared.Metrics import metrics, serve_metrics
+    from shared.Scheduler import TreeScheduler
+
+    if CASSETTE_PATH:
+        AgentPool().use_deterministic_ids("cassette")
+    checkpoint = Checkpoint(CHECKPOINT_PATH) if CHECKPOINT_PATH else None
+
+    if health.started_at is not None:
+        health.result()
+        for line in health_report:
+            print(line)
+
+    if resuming:
+        scheduler = checkpoint.restore()
+        root_manager = scheduler.root
+        user_agent = AgentPool().get(root_manager.parent_id)
+        print(f"Resumed {len(AgentPool().agents())} agents at round {scheduler.round}.")
+    else:
+        user_agent = User()
+        root_manager = General(user_agent.id, "Execute the user's orders", "Team Lead")
+        user_agent.connect_to(root_manager.id)
+        scheduler = TreeScheduler(root_manager)
+        AgentPool().message(user_agent.id, root_manager.id, message)
 
-    while True:
-        root_manager.run_turn_recurse()
-        visualize_tree(root_manager)
-        print(SECTION_SEP)
-        print(root_manager.get_agent_view(user_agent.id))
+    if METRICS_PORT:
+        serve_metrics(METRICS_PORT)
+        print(f"Metrics at http://127.0.0.1:{METRICS_PORT}/metrics")
+
+    if STARTUP_PROFILE:
+        profile.mark("tree ready")
+        print(profile.report([agents, llm, health]))
+
+    def after_round():
+        if checkpoint is not None:
+            checkpoint.write(scheduler)
+        if LEAK_CHECK:
+            flush_traces()
+            print(leak_report(root_manager, user_agent))
+
+    def show_tree():
         print(SECTION_SEP)
-        message = input(f"{Back.YELLOW}Press enter to skip. {INPUT_MSG}")
+        visualize_tree(root_manager, paused=scheduler.paused)
         print(SECTION_SEP)
-        if message == "":
-            continue
-        AgentPool().message(user_agent.id, root_manager.id, message)
 
-
-main()
+    def show_summary():
+        flush_traces()
+        show_tree()
+        print(metrics.summary())
+
+    def on_error(error: BaseException):
+        # shown right away, the prompt stops along with the tree
+        if not replaying:
+            flush_traces()
+            print(f"The tree stopped: {type(error).__name__}: {error}")
+
+    # the tree runs on its own, replies to the operator show up in the trace as they come
+    console = Console(scheduler, user_agent, after_round, show_tree, on_error)
+    console.start()
+    if replaying:
+        console.join()
+        show_summary()
+        return
+    print(CONSOLE_HELP)
+    while True:
+        line = _read_line(console)
+        if line is None:
+            break
+        error = console.submit(line)
+        if error is not None:
+            print(error)
+        if line.strip() == "/quit":
+            break
+    console.join()
+    show_summary()
+
+
+if __name__ == "__main__":
+    try:
+        main()
+    except CassetteMiss as e:
+        # a replay ends once the recorded session runs out, or diverges from it
+        print(f"Replay stopped: {e}")
@@ -1,23 +1,29 @@
+import time
 from abc import ABC, abstractmethod
+from threading import Lock
 from typing import Literal
-from uuid import uuid4
 
-from langchain_core.language_models import BaseChatModel
 from langchain_core.messages import (
     BaseMessage,
     AIMessage,
+    HumanMessage,
     ToolCall,
     ToolMessage,
     SystemMessage,
 )
-from langchain_core.tools import BaseTool, StructuredTool
+from langchain_core.tools import BaseTool
 from pydantic import ValidationError
 
-from debug.tracer import trace, Trace
+from debug.tracer import trace, Trace, TraceStream
 from debug.viewer import serialize_prompt_view
+from models.agents.prompt import Prompt, PromptCache, PromptSection, prefix_stats
+from models.agents.tools import AgentTool, ToolDispatch, agent_tool, compile_tools
+from prompts.summarizer import chat_summary_prompt
 from shared.AgentPool import AgentPool
-from shared.CoreLLM import CoreLLM
+from shared.CoreLLM import CoreLLM, LLMClient, ModelRouter
 from shared.ExternalChat import ExternalChat
+from shared.Metrics import metrics
+from shared.tokens import messages_tokens
 
 # We want to add 'reasoning' to each tool call.
 # Do we have to convert the tools to structural outputs?
@@ -33,19 +39,31 @@ from shared.ExternalChat import ExternalChat
 # Note: Having multiple chats is too confusing to the model
 # Note: I think we can get away with not doing a primary model chat at all, or doing just 1/2 messages lookback
 
-# Agents may fall into prolonged sleep.
-# This is good, but may lead to stagnation.
-# Nudge allows agents to occasionally wake up and check their surroundings.
-ROUNDS_TO_NUDGE = 7
-NUDGE_PROMPT = "Hey, just checking in on the progress."
+# Per-agent prompt budget, older chat messages get folded into a summary to stay within it.
+DEFAULT_TOKEN_LIMIT = 8000
+
+# Malformed tool calls send the agent's next few responses to the strong model.
+ESCALATION_TURNS = 3
+
+# Concrete agent classes by name, used for restoring checkpoints.
+agent_classes: dict[str, type["Agent"]] = {}
 
 
 class Agent(ABC):
+    # todo: remove all communication tools - the tree agents should only act as project scaffold.
+    #       the only reason why they'd need to talk to each other, is project interventions and corrections.
+    #       ^ corrections should be offloaded to separate, off-tree agents.
+    #       This way, in-tree agents don't have to deal with complexities of context switching.
+    # todo: agent should:
+    #       - sleep if it has children and no queued responses
+    #       - work if it is has no children
+
     # def _tool_broadcast_question(self, _question: str):
     #     """Broadcasts a question within your team, opens a chat with the peer who can answer you."""
     #     # overseer determines if the question can and should be answered, then routes it appropriately
     #     return "Broadcasting questions is not possible yet."
 
+    @agent_tool("send_message", "Sends a message to one of your open peer chats.")
     def _tool_send_message(self, message: str, target_id: str):
         if target_id not in self.external_chats:
             # New chats are opened only for special occasions, e.g. resolving conflicts.
@@ -54,20 +72,31 @@ class Agent(ABC):
         AgentPool().message(self.id, target_id, message)
         return "Message sent."
 
+    @agent_tool(
+        "close_peer_chat", "Closes a chat once the original question has been resolved."
+    )
     def _tool_close_peer_chat(self, peer_id: str):
         if peer_id not in self.external_chats:
             return f"No chat with {peer_id} exists."
         if peer_id == self.parent_id:
             return "You cannot close the chat with your superior."
+        peer = AgentPool().get(peer_id)
+        if peer is not None and peer.parent_id == self.id:
+            return "You cannot close the chat with your worker, terminate it instead."
         trace(
             Trace.DEL_CHAT,
             f"[{self.label} -> {peer_id}]: ",
             "=== CLOSING PEER CHAT ===",
         )
-        # todo: remove message from child, add __del__ to auto-resolve circ dep
-        del self.external_chats[peer_id]
+        # both sides go at once, neither chat is left referencing the other agent
+        if peer is not None:
+            peer.external_chats.pop(self.id, None)
+            peer._prompts.forget(self.id)
+        self.external_chats.pop(peer_id).clear()
+        self._prompts.forget(peer_id)
         return "Closed chat."
 
+    @agent_tool("message_your_superior", "Sends message to your superior.")
     def _tool_message_superior(self, message: str):
         trace(Trace.CHAT, f"[{self.label} -> {self.parent_id} (superior)]: ", message)
         AgentPool().message(self.id, self.parent_id, message)
@@ -75,68 +104,156 @@ class Agent(ABC):
 
     id: str  # unique but readable, 6 alpha-num chars
     parent_id: str
+    depth: int  # distance from the tree root, agents closer to it get LLM priority
     label: str  # non-unique
     type: Literal["overseer", "manager", "worker", "verifier"]
 
     creation_task: str
     _response_queue: list[str]  # queue of all agent ids pending a response
-    _available_tools: list[BaseTool]
+    _queue_lock: Lock  # turns run concurrently, peers may queue up mid-turn
+    _queued_at: dict[str, float]  # since when each pending response has been waiting
+
+    # compiled once per class, in `__init_subclass__`
+    _tool_table: dict[str, AgentTool] = {}
+    _available_tools: list[BaseTool] = []
 
     # todo: ExternalChat should have direct member ref, but circ refs can be an issue for GC in some known situations.
     external_chats: dict[str, ExternalChat]  # chats opened with other agents
 
-    llm: BaseChatModel  # ref to predefined class
-    token_limit: int  # todo: implement
+    llm: ModelRouter  # ref to predefined class, picks the model per call
+    # responses left on the strong model, after malformed tool calls
+    escalated_turns: int
+    token_limit: int  # prompt budget, enforced by compacting chats
+    _prompts: PromptCache  # sections are rebuilt only once their version changes
 
     # misc. optimizations
-    idle_turns_count: int
+    subtree_has_work: bool  # set up the ancestor chain on every queued response
+    nudge_token: int  # bumped on new work, invalidates pending nudges
 
     def __init__(self, parent_id: str, task: str, label: str):
-        self.id = uuid4().hex[:6]  # todo: add collision avoidance, collisions likely
+        self.id = AgentPool().generate_id(parent_id)
         AgentPool().register(self.id, self)
         self.llm = CoreLLM()
+        self.escalated_turns = 0
         self.parent_id = parent_id
+        parent = AgentPool().get(parent_id)
+        self.depth = parent.depth + 1 if parent is not None else 0
         self.label = label
         self.creation_task = task
         self._response_queue = []
+        self._queue_lock = Lock()
+        self._queued_at = {}
         self.external_chats = {}
-        self.idle_turns_count = 0
-        self._available_tools = [
-            # todo: remove all communication tools - the tree agents should only act as project scaffold.
-            #       the only reason why they'd need to talk to each other, is project interventions and corrections.
-            #       ^ corrections should be offloaded to separate, off-tree agents.
-            #       This way, in-tree agents don't have to deal with complexities of context switching.
-            # todo: agent should:
-            #       - sleep if it has children and no queued responses
-            #       - work if it is has no children
-            StructuredTool.from_function(
-                name="send_message",
-                func=self._tool_send_message,
-                description="Sends a message to one of your open peer chats.",
-            ),
-            StructuredTool.from_function(
-                name="close_peer_chat",
-                func=self._tool_close_peer_chat,
-                description="Closes a chat once the original question has been resolved.",
-            ),
-            StructuredTool.from_function(
-                name="message_your_superior",
-                func=self._tool_message_superior,
-                description="Sends message to your superior.",
-            ),
-        ]
+        self.subtree_has_work = False
+        self.nudge_token = 0
+        self.token_limit = DEFAULT_TOKEN_LIMIT
+        self._prompts = PromptCache()
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls._tool_table = compile_tools(cls)
+        cls._available_tools = [t.tool for t in cls._tool_table.values()]
+        agent_classes[cls.__name__] = cls
+
+    def snapshot(self) -> dict:
+        # scalar state only, chats are checkpointed separately
+        return {
+            "class": type(self).__name__,
+            "parent_id": self.parent_id,
+            "label": self.label,
+            "task": self.creation_task,
+            "depth": self.depth,
+            "token_limit": self.token_limit,
+            "queue": list(self._response_queue),
+            "subtree_has_work": self.subtree_has_work,
+            "nudge_token": self.nudge_token,
+        }
+
+    @classmethod
+    def restore(cls, agent_id: str, state: dict) -> "Agent":
+        # skips `__init__` - no ids get issued, no messages get sent
+        agent = cls.__new__(cls)
+        agent.id = agent_id
+        agent.llm = CoreLLM()
+        agent.escalated_turns = 0
+        agent.parent_id = state["parent_id"]
+        agent.label = state["label"]
+        agent.creation_task = state["task"]
+        agent.depth = state["depth"]
+        agent.token_limit = state["token_limit"]
+        agent._response_queue = list(state["queue"])
+        agent._queue_lock = Lock()
+        agent._queued_at = {
+            target_id: time.monotonic() for target_id in agent._response_queue
+        }
+        agent.external_chats = {}
+        agent.subtree_has_work = state["subtree_has_work"]
+        agent.nudge_token = state["nudge_token"]
+        agent._prompts = PromptCache()
+        AgentPool().register(agent_id, agent)
+        return agent
+
+    def teardown(self):
+        # breaks every reference to this agent, so nothing outlives its termination
+        for peer_id, chat in self.external_chats.items():
+            peer = AgentPool().get(peer_id)
+            if peer is not None:
+                peer.external_chats.pop(self.id, None)
+                peer._prompts.forget(self.id)
+            chat.clear()
+        self.external_chats.clear()
+        with self._queue_lock:
+            self._response_queue.clear()
+            self._queued_at.clear()
+        metrics.release(self.id)
+        AgentPool().remove(self.id)
 
     def _get_chat_by_target_id(self, target_id) -> ExternalChat | None:
         return self.external_chats.get(target_id)
 
-    def _task_part(self) -> SystemMessage:
-        return SystemMessage(f"# Your primary objective: {self.creation_task}\n")
+    def _task_part(self) -> PromptSection:
+        # the task never changes
+        return self._prompts.section(
+            "task",
+            lambda: [
+                SystemMessage(f"# Your primary objective: {self.creation_task}\n")
+            ],
+        )
 
-    def _chat_part(self, target_id: str) -> list[BaseMessage]:
-        return [
-            SystemMessage(f"Your chat with {target_id}:\n\n"),
-            *self.external_chats.get(target_id).chat_history,
+    def _summarize_chat(self, summary: str, messages: list[BaseMessage]) -> str:
+        transcript = ""
+        for message in messages:
+            if isinstance(message, AIMessage):
+                transcript += f"You: {message.content}\n"
+                for tool_call in message.tool_calls:
+                    transcript += (
+                        f"You called {tool_call['name']}({tool_call['args']})\n"
+                    )
+            elif isinstance(message, ToolMessage):
+                transcript += f"Tool {message.name} output: {message.content}\n"
+            else:
+                transcript += f"Coworker: {message.content}\n"
+        prompt = [
+            SystemMessage(chat_summary_prompt),
+            HumanMessage(
+                f"# Current summary:\n{summary or '(empty)'}\n\n# New messages:\n{transcript}"
+            ),
         ]
+        llm = self._llm_for(messages_tokens(prompt))
+        return str(llm.invoke(prompt, priority=self.depth, agent_id=self.id).content)
+
+    def _chat_part(self, target_id: str, budget: int | None = None) -> PromptSection:
+        chat = self.external_chats.get(target_id)
+        if budget is not None:
+            chat.compact(budget, self._summarize_chat)
+
+        def build() -> list[BaseMessage]:
+            header = f"Your chat with {target_id}:\n\n"
+            if chat.summary != "":
+                header += f"Summary of your earlier messages:\n{chat.summary}\n\n"
+            return [SystemMessage(header), *chat.chat_history]
+
+        return self._prompts.section(("chat", target_id), build, chat.version())
 
     def _sign_message(self, text: str):
         clean_text = text.replace("\n", "<br>")
@@ -145,11 +262,10 @@ class Agent(ABC):
         return f'{{"author": "{self.id}", "message": "{clean_text}"}}\n'
 
     @abstractmethod
-    def _generate_prompt(self, target_id: str) -> list[BaseMessage]:
+    def _generate_prompt(self, target_id: str, compact: bool = True) -> Prompt:
         raise NotImplementedError()
 
     def _execute_tool_call(self, tool_call: ToolCall) -> ToolMessage:
-        tools = {t.name: t for t in self._available_tools}
         t_id = tool_call["id"]
         t_name = tool_call["name"]
         t_args = tool_call["args"]
@@ -163,40 +279,111 @@ class Agent(ABC):
             content=f'Tool mistyped or unavailable: "{t_name}"',
         )
 
-        if t_name not in tools:
-            return t_response
+        # early tool calls run on the dispatch pool, not on the turn's thread
+        with metrics.scope(self.id, self.depth):
+            tool = self._tool_table.get(t_name)
+            if tool is None:
+                self.escalated_turns = ESCALATION_TURNS
+                metrics.increment(
+                    "tool_errors_total", tool="unknown", reason="mistyped"
+                )
+                return t_response
+
+            start = time.perf_counter()
+            try:
+                call_result = tool.call(self, t_args)
+                trace(Trace.TOOL, f"Tool {t_name}({t_args}) output:", call_result)
+                t_response.content = str(call_result)
+                return t_response
+            except ValidationError:
+                err = f"Tool called with invalid arguments, or invalid argument count."
+                t_response.content = err
+                self.escalated_turns = ESCALATION_TURNS
+                metrics.increment("tool_errors_total", tool=t_name, reason="validation")
+                return t_response
+            except Exception:
+                metrics.increment("tool_errors_total", tool=t_name, reason="exception")
+                raise
+            finally:
+                metrics.observe(
+                    "tool_seconds", time.perf_counter() - start, tool=t_name
+                )
+
+    def _is_parallel_safe(self, tool_call: ToolCall) -> bool:
+        tool = self._tool_table.get(tool_call["name"])
+        return tool is not None and tool.is_parallel_safe(tool_call["args"])
+
+    def _llm_for(self, prompt_tokens: int, escalated: bool = False) -> LLMClient:
+        workers = len(getattr(self, "children", {}))
+        return self.llm.route(
+            self.depth, workers, prompt_tokens, escalated or self.escalated_turns > 0
+        )
 
-        try:
-            call_result = tools[t_name].invoke(t_args)
-            trace(Trace.TOOL, f"Tool {t_name}({t_args}) output:", call_result)
-            t_response.content = str(call_result)
-            return t_response
-        except ValidationError:
-            err = f"Tool called with invalid arguments, or invalid argument count."
-            t_response.content = err
-            return t_response
-
-    def _execute_tool_calls(self, tool_calls: list[ToolCall]) -> list[ToolMessage]:
-        t_results = []
-        for tool_call in tool_calls:
-            res = self._execute_tool_call(tool_call)
-            t_results.append(res)
-        return t_results
+    def _tool_dispatch(self) -> ToolDispatch:
+        return ToolDispatch(self._execute_tool_call, self._is_parallel_safe)
 
     def get_agent_view(self, target_id: str):
-        prompt = self._generate_prompt(target_id)
-        return serialize_prompt_view(prompt)
+        # unchanged sections are reused, an untouched prompt is the one the LLM saw last
+        # viewing is read-only, chats are compacted only when responding
+        prompt = self._generate_prompt(target_id, compact=False)
+        return serialize_prompt_view(prompt.messages)
 
     def queue_response(self, respond_to_id: str):
-        self._response_queue.append(respond_to_id)
-        # keep deduped
-        self._response_queue = list(set(self._response_queue))
+        with self._queue_lock:
+            # keep deduped, in arrival order
+            if respond_to_id not in self._response_queue:
+                self._response_queue.append(respond_to_id)
+                self._queued_at[respond_to_id] = time.monotonic()
+            self.nudge_token += 1
+        agent = self
+        while agent is not None:
+            agent.subtree_has_work = True
+            agent = AgentPool().get(agent.parent_id)
+
+    def has_pending_responses(self) -> bool:
+        return len(self._response_queue) > 0
 
     def _respond_to_target(self, target_id: str):
         # todo: handle errors better
-        tool_llm = self.llm.bind_tools(self._available_tools).with_retry()
+        build_start = time.perf_counter()
+        prompt = self._generate_prompt(target_id)
+        metrics.observe("prompt_build_seconds", time.perf_counter() - build_start)
+        shared_tokens = self._prompts.sent(prompt)
+        # tool calls start as soon as they're streamed in, while the rest is still being generated
+        dispatch = self._tool_dispatch()
+        text_trace = TraceStream(Trace.THINK, f"{self.label} -> {target_id}: ")
+        llm = self._llm_for(prompt.tokens)
+        if self.escalated_turns > 0:
+            self.escalated_turns -= 1
+
+        def invoke(client: LLMClient) -> BaseMessage:
+            return client.invoke(
+                prompt.messages,
+                tools=self._available_tools,
+                priority=self.depth,
+                agent_id=self.id,
+                on_text=text_trace.write,
+                on_tool_call=dispatch.submit_early,
+            )
 
-        result = tool_llm.invoke(self._generate_prompt(target_id))
+        try:
+            try:
+                result = invoke(llm)
+            except Exception:
+                # the fast model gave up, escalate unless some tool call already started
+                if llm is self.llm.strong() or dispatch.has_started():
+                    raise
+                self.escalated_turns = ESCALATION_TURNS
+                result = invoke(self.llm.strong())
+        except Exception:
+            # calls in flight still finish, or get dropped, before the turn fails
+            dispatch.settle()
+            raise
+        finally:
+            text_trace.close()
+        usage = getattr(result, "usage_metadata", None) or {}
+        cached_tokens = usage.get("input_token_details", {}).get("cache_read", 0)
+        prefix_stats.record(prompt.tokens, shared_tokens, cached_tokens)
 
         # smart-cast to only possible output
         if isinstance(result, AIMessage):
@@ -204,17 +391,27 @@ class Agent(ABC):
 
             # tool call results are saved to the chat local-side only
             target_chat = self.external_chats.get(target_id)
-            t_results = self._execute_tool_calls(result.tool_calls)
-            target_chat.chat_history.extend(t_results)
-            if len(t_results) > 0:
+            t_results = dispatch.results(result.tool_calls)
+            target_chat.extend(t_results)
+            # sleeping should not wake the agent right back up, nor should a closed chat
+            if target_id not in self.external_chats:
+                return
+            if any(t.name != "sleep_through_turn" for t in t_results):
                 self.queue_response(target_id)
 
     def run_turn(self):
-        if len(self._response_queue) == 0:
-            self.idle_turns_count += 1
-        if self.idle_turns_count == ROUNDS_TO_NUDGE:
-            AgentPool().message(self.parent_id, self.id, NUDGE_PROMPT)
-        for target_id in self._response_queue:
-            self._respond_to_target(target_id)
-            self.idle_turns_count = 0
-        self._response_queue.clear()
+        # nudges are handled by the scheduler, only ever called with pending responses
+        # swap the queue - anything queued mid-turn is handled next round
+        with self._queue_lock:
+            pending = self._response_queue
+            self._response_queue = []
+            queued_at, self._queued_at = self._queued_at, {}
+        with metrics.scope(self.id, self.depth):
+            for target_id in pending:
+                # chats may have been closed since, e.g. by terminating a worker
+                if target_id not in self.external_chats:
+                    continue
+                metrics.observe(
+                    "queue_wait_seconds", time.monotonic() - queued_at[target_id]
+                )
+                self._respond_to_target(target_id)
@@ -1,37 +1,103 @@
+import os
 from typing import Literal
 
-from langchain_core.messages import SystemMessage, BaseMessage
-from langchain_core.tools import StructuredTool
+from langchain_core.messages import SystemMessage
 
+from debug.cassette import recorded
 from debug.tracer import Trace, trace
 from models.agents.base import Agent
+from models.agents.prompt import Prompt, PromptSection
+from models.agents.tools import agent_tool
+from models.pipelines.splitter import (
+    MAX_SPLIT_DEPTH,
+    TaskSplit,
+    split_task,
+    split_tasks,
+)
 from prompts.general import general_system_prompt
 from prompts.tool_descriptions import (
     hire_worker_desc,
     kill_worker_desc,
     run_shell_desc,
     sleep_turn_desc,
+    split_task_desc,
     write_scratchpad_desc,
 )
-from runtimes.runtime import use_linux_shell, create_linux_instance, get_project_tree
+from runtimes.runtime import (
+    use_linux_shell,
+    use_memoized_shell,
+    create_linux_instance,
+    delete_linux_instance,
+    get_project_tree,
+    get_workspace_fingerprint,
+)
+from runtimes.shell_memo import is_read_only
 from shared.AgentPool import AgentPool
+from shared.CoreLLM import StructuredOutputError
 from shared.ExternalChat import create_chat_pair
+from shared.TaskCache import task_cache
+from shared.tokens import estimate_tokens, fit_text
 
 
 # General is an all-purpose agent, capable of both managerial and technical tasks.
 # The previous split-role model had issues with predicting the complexity of the given tasks,
 # this one should be able to adapt to new challenges in the given tasks more easily.
 
+# Identical for every General, shared by all prompts.
+SYSTEM_PART = PromptSection(0, [SystemMessage(general_system_prompt)])
+
+# "cache" orders sections from the most to the least stable one, maximising the prefix
+# repeated between calls, which providers serve from their prompt cache.
+# "classic" keeps the tree up front, right after the system prompt.
+PROMPT_LAYOUT = os.getenv("CORTEX_PROMPT_LAYOUT", "classic")
+
+# Shares of `token_limit`. Memory and workers are capped, so they can't crowd the chat out,
+# and the chat keeps a floor, so compaction doesn't re-run on every turn.
+MEMORY_SHARE = 0.15
+WORKERS_SHARE = 0.1
+MIN_CHAT_SHARE = 0.25
+
 
 class General(Agent):
+    @agent_tool("hire_worker", hire_worker_desc)
     def _tool_hire_worker(
         self,
         worker_label: str,
         task_description: str,
     ):
+        cached = task_cache.get(task_description, self._workspace_fingerprint())
+        if cached is not None:
+            trace(
+                Trace.NEW_TASK,
+                f'{self.label} reuses the result of a finished task "{worker_label}".',
+            )
+            return f"An identical task has already been completed, no worker was hired. Its result:\n{cached}"
+        child = self._hire(worker_label, task_description)
+        return f"Task '{child.id}' created successfully."
+
+    @agent_tool("split_task", split_task_desc)
+    def _tool_split_task(self):
+        if self.depth >= MAX_SPLIT_DEPTH:
+            return "Your task cannot be split any further, execute it yourself."
+        try:
+            split = split_task(
+                self.creation_task, self.llm.strong(), self.depth, self.id
+            )
+        except StructuredOutputError as e:
+            return f"Task splitting failed, try again later or execute the task yourself. Error: {e}"
+        if not split.is_split():
+            self._note_plan(split)
+            return f"Your task fits a single worker, execute it yourself. Plan:\n{split.detailed_plan}"
+        children = self._apply_split(split)
+        if len(children) == 0:
+            return "Every sub-task has already been completed, their results are in your memory."
+        return "Hired: " + ", ".join(f"{c.label} [id: {c.id}]" for c in children)
+
+    def _hire(self, worker_label: str, task_description: str) -> "General":
         child = General(self.id, task_description, worker_label)
         trace(Trace.NEW_TASK, f'{self.label} creates child "{child.label}".')
         self.children[child.id] = child
+        self._prompts.bump("workers")
 
         chat_for_self, chat_for_child = create_chat_pair(
             self.id,
@@ -44,112 +110,232 @@ class General(Agent):
         child.external_chats[self.id] = chat_for_child
 
         AgentPool().message(self.id, child.id, task_description)
+        return child
 
-        return f"Task '{child.id}' created successfully."
+    def _apply_split(self, split: TaskSplit) -> list["General"]:
+        # the whole layer is hired at once, and the next one is planned in a single batched request
+        fingerprint = self._workspace_fingerprint()
+        children = []
+        for subtask in split.subtasks:
+            cached = task_cache.get(subtask.task_description, fingerprint)
+            if cached is None:
+                children.append(
+                    self._hire(subtask.worker_label, subtask.task_description)
+                )
+                continue
+            trace(
+                Trace.NEW_TASK,
+                f'{self.label} reuses the result of a finished task "{subtask.worker_label}".',
+            )
+            self.memory_notes.append(
+                f"- Sub-task '{subtask.worker_label}' was already done, its result: {cached}"
+            )
+            self._prompts.bump("memory")
+        if self.depth + 1 < MAX_SPLIT_DEPTH:
+            tasks = [child.creation_task for child in children]
+            for child, plan in zip(
+                children, split_tasks(tasks, self.llm.strong(), self.depth, self.id)
+            ):
+                child.plan = plan
+        return children
+
+    def _note_plan(self, split: TaskSplit):
+        if split.detailed_plan == "":
+            return
+        self.memory_notes.append(f"- Execution plan: {split.detailed_plan}")
+        self._prompts.bump("memory")
 
-    def _tool_terminate_worker(self, task_id: str):
+    def _workspace_fingerprint(self) -> str:
+        # recorded per agent, replays don't touch the workspace
+        return recorded("fingerprint", self.id, get_workspace_fingerprint)
+
+    @agent_tool("terminate_worker", kill_worker_desc)
+    def _tool_terminate_worker(self, task_id: str, success: bool = False):
         child = self.children.get(task_id)
         chat = self._get_chat_by_target_id(task_id)
         if child is None or chat is None:
             return f"Error: Task {task_id} not found."
         trace(Trace.DEL_TASK, f"{self.label} removes {child.label}")
 
+        if success:
+            # the worker's last report stands for the result of the task
+            reports = [
+                r
+                for r in chat.records()
+                if r.author == child.id and str(r.content) != ""
+            ]
+            if len(reports) > 0:
+                task_cache.put(
+                    child.creation_task,
+                    self._workspace_fingerprint(),
+                    str(reports[-1].content),
+                )
+
         del self.children[child.id]
-        del self.external_chats[child.id]
+        self._prompts.bump("workers")
+        child.teardown()  # closes our chat with it as well
         return f"Task {task_id} successfully terminated."
 
+    # only read-only commands run side by side, others may depend on the calls around them
+    @agent_tool(
+        "run_linux_shell_command",
+        run_shell_desc,
+        parallel_safe=lambda args: is_read_only(str(args.get("command", ""))),
+    )
     def _tool_run_linux_shell_command(self, command: str):
+        cached = use_memoized_shell(command, self.id)
+        if cached is not None:
+            trace(Trace.SHELL, f"{self.label} uses shell (cached): ", command)
+            return cached
         trace(Trace.SHELL, f"{self.label} uses shell: ", command)
         return use_linux_shell(command, self.id)
 
+    @agent_tool("write_to_scratchpad", write_scratchpad_desc, parallel_safe=True)
     def _tool_save_to_memory(self, text: str):
         trace(Trace.THINK, f"{self.label} saves to memory: ", text)
         self.memory_notes.append(f"- {text}")
+        self._prompts.bump("memory")
         return "Added entry to your memory."
 
-    @staticmethod
-    def _sleep_through_turn():
+    @agent_tool("sleep_through_turn", sleep_turn_desc, parallel_safe=True)
+    def _sleep_through_turn(self):
         return "Sleeping through this turn."
 
     # tree node - access to technical tools, dispatches subcontractors
     type: Literal["general"] = "general"
     children: dict[str, Agent]
     memory_notes: list[str]  # notes
+    plan: TaskSplit | None  # made by the superior, applied on the first turn
 
     def __init__(self, parent_id, task, label):
         super().__init__(parent_id, task, label)
-        create_linux_instance(self.id)
+        create_linux_instance(self.id, parent_id)
         self.memory_notes = []
         self.children = {}
-        self._available_tools += [
-            StructuredTool.from_function(
-                name="hire_worker",
-                func=self._tool_hire_worker,
-                description=hire_worker_desc,
-            ),
-            StructuredTool.from_function(
-                name="terminate_worker",
-                func=self._tool_terminate_worker,
-                description=kill_worker_desc,
-            ),
-            StructuredTool.from_function(
-                name="run_linux_shell_command",
-                func=self._tool_run_linux_shell_command,
-                description=run_shell_desc,
-            ),
-            StructuredTool.from_function(
-                name="write_to_scratchpad",
-                func=self._tool_save_to_memory,
-                description=write_scratchpad_desc,
-            ),
-            StructuredTool.from_function(
-                name="sleep_through_turn",
-                func=self._sleep_through_turn,
-                description=sleep_turn_desc,
-            ),
-        ]
-
-    def run_turn_recurse(self):
-        for child in self.children.values():
-            if isinstance(child, General):
-                child.run_turn_recurse()
+        self.plan = None
+
+    def snapshot(self) -> dict:
+        return {
+            **super().snapshot(),
+            "children": list(self.children.keys()),
+            "plan": None if self.plan is None else self.plan.model_dump(),
+        }
+
+    @classmethod
+    def restore(cls, agent_id: str, state: dict) -> "General":
+        agent = super().restore(agent_id, state)
+        # sessions start their shell on first use
+        create_linux_instance(agent_id, agent.parent_id)
+        agent.memory_notes = []
+        agent.children = {}  # linked once the whole tree is restored
+        agent.plan = (
+            None
+            if state.get("plan") is None
+            else TaskSplit.model_validate(state["plan"])
+        )
+        return agent
+
+    def run_turn(self):
+        # plans are applied before responding, a whole layer gets hired and planned every round
+        if self.plan is not None:
+            plan, self.plan = self.plan, None
+            if plan.is_split():
+                self._apply_split(plan)
             else:
-                # Verifier or Overseer - these get the first turn to ensure back-to-back behaviour
-                child.run_turn()
-        self.run_turn()
-
-    def _memory_part(self) -> list[BaseMessage]:
-        if len(self.memory_notes) == 0:
-            return []
-        out = "# Your dynamic memory:\n"
-        for mem in self.memory_notes:
-            out += f"{mem}\n"
-        return [SystemMessage(out)]
-
-    @staticmethod
-    def _project_tree_part() -> list[BaseMessage]:
-        tree = get_project_tree()
-        if tree is None:
-            return []
-        return [SystemMessage(f"# Full project tree:\n\n{tree}")]
-
-    def _worker_status_part(self) -> list[SystemMessage]:
-        if len(self.children) == 0:
-            return []
-        out = "# List of employees currently working for you:\n\n"
+                self._note_plan(plan)
+        super().run_turn()
+
+    def teardown(self):
+        # workers go first, their chats with us are still open
         for child in self.children.values():
-            child_task = child.creation_task.replace("\n", "<br>")
-            out += f"- {child.label} [id: {child.id}] is executing task: {child_task}\n"
-        out += "\n"
-        return [SystemMessage(out)]
+            child.teardown()
+        self.children.clear()
+        self.memory_notes.clear()
+        delete_linux_instance(self.id)
+        super().teardown()
+
+    def _memory_part(self, max_tokens: int) -> PromptSection:
+        def build():
+            if len(self.memory_notes) == 0:
+                return []
+            # the newest notes are kept, older ones get dropped once over the cap
+            lines = []
+            tokens = 0
+            for mem in reversed(self.memory_notes):
+                tokens += estimate_tokens(mem)
+                if tokens > max_tokens:
+                    break
+                lines.append(f"{mem}\n")
+            omitted = len(self.memory_notes) - len(lines)
+            if omitted > 0:
+                lines.append(f"... ({omitted} older notes omitted)\n")
+            lines.append("# Your dynamic memory:\n")
+            return [SystemMessage("".join(reversed(lines)))]
+
+        return self._prompts.section("memory", build, max_tokens)
+
+    def _project_tree_part(self, max_tokens: int) -> PromptSection:
+        # recorded per agent, replays don't touch the workspace
+        tree = recorded("tree", self.id, get_project_tree)
+
+        def build():
+            if tree is None:
+                return []
+            return [
+                SystemMessage(f"# Full project tree:\n\n{fit_text(tree, max_tokens)}")
+            ]
 
-    def _generate_prompt(self, target_id: str) -> list[BaseMessage]:
+        # trees are cached, an unchanged tree is the very same string
+        return self._prompts.section("tree", build, (tree, max_tokens))
+
+    def _worker_status_part(self, max_tokens: int) -> PromptSection:
+        def build():
+            if len(self.children) == 0:
+                return []
+            lines = ["# List of employees currently working for you:\n\n"]
+            for child in self.children.values():
+                child_task = child.creation_task.replace("\n", "<br>")
+                lines.append(
+                    f"- {child.label} [id: {child.id}] is executing task: {child_task}\n"
+                )
+            text = fit_text("".join(lines), max_tokens)
+            return [SystemMessage(text + "\n")]
+
+        return self._prompts.section("workers", build, max_tokens)
+
+    def _generate_prompt(self, target_id: str, compact: bool = True) -> Prompt:
         # todo: add pre-response scratchpads
-        return [
-            SystemMessage(general_system_prompt),
-            *self._project_tree_part(),
-            self._task_part(),
-            *self._memory_part(),
-            *self._worker_status_part(),
-            *self._chat_part(target_id),
-        ]
+        task_part = self._task_part()
+        memory_part = self._memory_part(int(self.token_limit * MEMORY_SHARE))
+        worker_status_part = self._worker_status_part(
+            int(self.token_limit * WORKERS_SHARE)
+        )
+
+        # the tree may take up to a third of what's left, the chat gets the rest
+        budget = self.token_limit - sum(
+            p.tokens for p in [SYSTEM_PART, task_part, memory_part, worker_status_part]
+        )
+        project_tree_part = self._project_tree_part(budget // 3)
+        budget -= project_tree_part.tokens
+        budget = max(budget, int(self.token_limit * MIN_CHAT_SHARE))
+
+        chat_part = self._chat_part(target_id, budget if compact else None)
+        if PROMPT_LAYOUT == "cache":
+            sections = [
+                SYSTEM_PART,
+                task_part,
+                memory_part,
+                worker_status_part,
+                project_tree_part,
+                chat_part,
+            ]
+        else:
+            sections = [
+                SYSTEM_PART,
+                project_tree_part,
+                task_part,
+                memory_part,
+                worker_status_part,
+                chat_part,
+            ]
+        return self._prompts.assemble(target_id, sections)
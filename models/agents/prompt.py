@@ -0,0 +1,129 @@
+from threading import Lock
+from typing import Callable, Hashable
+
+from langchain_core.messages import BaseMessage
+
+from shared.Metrics import metrics
+from shared.tokens import message_tokens, messages_tokens
+
+# Prompts are assembled from sections, each one rebuilt only once its version changes.
+# Assembled prompts are reused as well, as long as none of their sections got rebuilt,
+# so the LLM call and the viewer share the very same prompt object.
+
+
+class PromptSection:
+    __slots__ = ("version", "messages", "tokens")
+
+    def __init__(self, version: Hashable, messages: list[BaseMessage]):
+        self.version = version
+        self.messages = messages
+        self.tokens = messages_tokens(messages)
+
+
+class Prompt:
+    __slots__ = ("sections", "messages", "tokens")
+
+    def __init__(self, sections: list[PromptSection]):
+        self.sections = sections
+        self.messages = [m for s in sections for m in s.messages]
+        self.tokens = sum(s.tokens for s in sections)
+
+    def is_built_from(self, sections: list[PromptSection]) -> bool:
+        return len(sections) == len(self.sections) and all(
+            a is b for a, b in zip(sections, self.sections)
+        )
+
+
+def shared_prefix_tokens(previous: Prompt | None, current: Prompt) -> int:
+    # leading tokens of `current` repeating `previous` verbatim
+    if previous is None:
+        return 0
+    shared = 0
+    for old, new in zip(previous.sections, current.sections):
+        if old is new:
+            shared += new.tokens
+            continue
+        for a, b in zip(old.messages, new.messages):
+            if a is not b and a != b:
+                return shared
+            shared += message_tokens(b)
+        if len(old.messages) != len(new.messages):
+            return shared
+    return shared
+
+
+class PrefixStats:
+    # Providers cache prompt prefixes, the longer the repeated prefix, the cheaper and faster the call.
+    # `shared_tokens` is our own estimate, `cached_tokens` is what the provider reports, if anything.
+
+    def __init__(self):
+        self._lock = Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.calls = 0
+            self.prompt_tokens = 0
+            self.shared_tokens = 0
+            self.cached_tokens = 0
+
+    def record(self, prompt_tokens: int, shared_tokens: int, cached_tokens: int = 0):
+        # attributed to the calling agent, see `Metrics.scope`
+        metrics.observe("prompt_shared_tokens", shared_tokens)
+        metrics.observe("prompt_cached_tokens", cached_tokens)
+        with self._lock:
+            self.calls += 1
+            self.prompt_tokens += prompt_tokens
+            self.shared_tokens += shared_tokens
+            self.cached_tokens += cached_tokens
+
+    def share(self) -> float:
+        return (
+            self.shared_tokens / self.prompt_tokens if self.prompt_tokens > 0 else 0.0
+        )
+
+
+prefix_stats = PrefixStats()
+
+
+class PromptCache:
+    def __init__(self):
+        self._versions: dict[Hashable, int] = {}
+        self._sections: dict[Hashable, PromptSection] = {}
+        self._prompts: dict[str, Prompt] = {}
+        self._last_sent: Prompt | None = None
+
+    def bump(self, name: Hashable):
+        # invalidates a section whose version is tracked by the cache
+        self._versions[name] = self._versions.get(name, 0) + 1
+
+    def section(
+        self,
+        name: Hashable,
+        build: Callable[[], list[BaseMessage]],
+        version: Hashable = None,
+    ) -> PromptSection:
+        # bumps invalidate a section on top of its own version
+        version = (self._versions.get(name, 0), version)
+        cached = self._sections.get(name)
+        if cached is None or cached.version != version:
+            cached = PromptSection(version, build())
+            self._sections[name] = cached
+        return cached
+
+    def assemble(self, target_id: str, sections: list[PromptSection]) -> Prompt:
+        prompt = self._prompts.get(target_id)
+        if prompt is None or not prompt.is_built_from(sections):
+            prompt = Prompt(sections)
+            self._prompts[target_id] = prompt
+        return prompt
+
+    def sent(self, prompt: Prompt) -> int:
+        # returns the prefix shared with the previously sent prompt, whichever chat it was for
+        shared = shared_prefix_tokens(self._last_sent, prompt)
+        self._last_sent = prompt
+        return shared
+
+    def forget(self, target_id: str):
+        self._prompts.pop(target_id, None)
+        self._sections.pop(("chat", target_id), None)
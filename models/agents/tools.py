@@ -0,0 +1,148 @@
+import inspect
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from typing import Callable
+
+from langchain_core.messages import ToolCall, ToolMessage
+from langchain_core.tools import BaseTool, StructuredTool
+from langchain_core.tools.base import create_schema_from_function
+from pydantic import BaseModel
+
+# Tools are declared on agent methods with `@agent_tool`, and compiled once per agent class.
+# Pydantic schema generation is expensive, thus it must never happen per agent instance.
+
+
+# Tool calls of one response are either parallel-safe or ordered.
+# Parallel-safe calls may run concurrently with each other, ordered calls act as barriers.
+ParallelSafety = bool | Callable[[dict], bool]
+
+# Shared by all agents, every parallel-safe tool call runs here.
+TOOL_CALL_WORKERS = 16
+_tool_call_executor = ThreadPoolExecutor(
+    max_workers=TOOL_CALL_WORKERS, thread_name_prefix="tool-call"
+)
+
+
+class AgentTool:
+    def __init__(
+        self,
+        name: str,
+        description: str,
+        method: Callable,
+        parallel_safe: ParallelSafety = False,
+    ):
+        self.name = name
+        self.method = method  # unbound, called with the agent as `self`
+        self._parallel_safe = parallel_safe
+        self.arg_names = [
+            p for p in inspect.signature(method).parameters if p != "self"
+        ]
+        self.args_schema: type[BaseModel] = create_schema_from_function(
+            name,
+            method,
+            filter_args=["self"],
+            include_injected=False,
+        )
+        # schema-only tool, used for binding to the LLM, never invoked directly
+        self.tool: BaseTool = StructuredTool(
+            name=name,
+            description=description,
+            args_schema=self.args_schema,
+            func=method,
+        )
+
+    def is_parallel_safe(self, args: dict) -> bool:
+        if callable(self._parallel_safe):
+            return self._parallel_safe(args)
+        return self._parallel_safe
+
+    def call(self, agent, args: dict):
+        validated = self.args_schema.model_validate(args)
+        return self.method(agent, **{n: getattr(validated, n) for n in self.arg_names})
+
+
+def agent_tool(name: str, description: str, parallel_safe: ParallelSafety = False):
+    def mark(method: Callable) -> Callable:
+        method.__agent_tool__ = (name, description, parallel_safe)
+        return method
+
+    return mark
+
+
+# shared between classes, inherited tools are compiled only once
+_compiled: dict[tuple[Callable, str], AgentTool] = {}
+
+
+def compile_tools(cls: type) -> dict[str, AgentTool]:
+    # base class tools come first, overrides keep their original position
+    table: dict[str, AgentTool] = {}
+    for klass in reversed(cls.__mro__):
+        for method in vars(klass).values():
+            spec = getattr(method, "__agent_tool__", None)
+            if spec is None:
+                continue
+            name, description, parallel_safe = spec
+            if (method, name) not in _compiled:
+                _compiled[(method, name)] = AgentTool(
+                    name, description, method, parallel_safe
+                )
+            table[name] = _compiled[(method, name)]
+    return table
+
+
+class ToolDispatch:
+    # Runs the tool calls of a single response.
+    # Parallel-safe calls run on the shared pool, side by side, ordered calls run in the turn's thread,
+    # each one once every call before it is done. Calls may be handed over early,
+    # while the response is still being generated, see `submit_early`.
+
+    def __init__(
+        self,
+        execute: Callable[[ToolCall], ToolMessage],
+        is_parallel_safe: Callable[[ToolCall], bool],
+    ):
+        self._execute = execute
+        self._is_parallel_safe = is_parallel_safe
+        self._futures: dict[str, Future] = {}
+        self._holding = False
+
+    def submit_early(self, tool_call: ToolCall):
+        # Only parallel-safe calls start early, and only up to the first ordered one.
+        # Ordered calls may touch chats, e.g. send messages, which must follow the response itself.
+        if self._holding or not self._is_parallel_safe(tool_call):
+            self._holding = True
+            return
+        self._submit(tool_call)
+
+    def _submit(self, tool_call: ToolCall):
+        self._futures[tool_call["id"]] = _tool_call_executor.submit(
+            self._execute, tool_call
+        )
+
+    def has_started(self) -> bool:
+        return len(self._futures) > 0
+
+    def settle(self):
+        # the response failed, calls which haven't started are dropped, running ones are waited for
+        for future in self._futures.values():
+            future.cancel()
+        wait(self._futures.values())
+
+    def results(self, tool_calls: list[ToolCall]) -> list[ToolMessage]:
+        # runs whatever wasn't handed over early, results keep the order of `tool_calls`
+        try:
+            for tool_call in tool_calls:
+                if tool_call["id"] in self._futures:
+                    continue
+                if self._is_parallel_safe(tool_call):
+                    # the barrier before it is done, it joins the batch running since
+                    self._submit(tool_call)
+                    continue
+                # an earlier call raised, later ones never run - same as running them in sequence
+                for future in self._futures.values():
+                    future.result()
+                future = Future()
+                future.set_result(self._execute(tool_call))
+                self._futures[tool_call["id"]] = future
+            return [self._futures[t["id"]].result() for t in tool_calls]
+        finally:
+            self.settle()
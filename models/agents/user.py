@@ -1,6 +1,5 @@
-from langchain_core.messages import BaseMessage
-
 from models.agents.base import Agent
+from models.agents.prompt import Prompt
 from shared.AgentPool import AgentPool
 from shared.ExternalChat import create_chat_pair
 
@@ -9,8 +8,8 @@ from shared.ExternalChat import create_chat_pair
 
 
 class User(Agent):
-    def _generate_prompt(self, target_id: str) -> list[BaseMessage]:
-        return []
+    def _generate_prompt(self, target_id: str, compact: bool = True) -> Prompt:
+        return Prompt([])
 
     def __init__(self):
         super().__init__("__none", "__none", "Root User")
@@ -26,5 +25,7 @@ class User(Agent):
             "Your target",
         )
 
+        # replies reach the user through the trace, our side of the chat is never read
+        for_self.stop_reading()
         self.external_chats[target_id] = for_self
         AgentPool().get(target_id).external_chats[self.id] = for_target
@@ -1,7 +1,18 @@
 from typing import Literal
 
+from langchain_core.messages import HumanMessage, SystemMessage
 from pydantic import BaseModel, Field
 
+from prompts.splitter import split_task_prompt
+from shared.CoreLLM import LLMClient, StructuredOutputError
+
+# Task splitting as a structured-output pipeline.
+# A whole layer of the tree is planned at once: one request returns the decision, the plan,
+# and the sub-tasks of every given task, so building a deep tree takes one round per layer.
+
+MAX_SUBTASKS = 6
+MAX_SPLIT_DEPTH = 5  # deeper agents always execute their task themselves
+
 THOUGHT_PROCESS_PROMPT = "Your reasoning and thought process for your decisions."
 
 
@@ -19,9 +30,73 @@ class TaskSplittingDecision(BaseModel):
     )
 
 
-def split_task():
-    # 1. Come up with a plan for execution of this task
-    # 2. Determine if this task can be executed by a single agent
-    # 2.1. If so, dispatch a General worker
-    # 2.2. If not, split into smaller plan, recurse.
-    pass
+class SubTask(BaseModel):
+    worker_label: str = Field(
+        description="Tiny label of the worker, e.g. Backend Engineer."
+    )
+    task_description: str = Field(
+        description="Exhaustive description of the sub-task, with all the context it needs."
+    )
+
+
+class TaskSplit(TaskSplittingDecision, ExecutionPlan):
+    subtasks: list[SubTask] = Field(
+        default_factory=list,
+        description="Sub-tasks, each for a separate worker. Empty for single worker tasks.",
+    )
+
+    def is_split(self) -> bool:
+        return self.choice == "multi_worker_task" and len(self.subtasks) > 0
+
+
+class LayerPlan(BaseModel):
+    plans: list[TaskSplit] = Field(
+        description="Exactly one plan per given task, in the same order."
+    )
+
+
+def _single_worker_plan() -> TaskSplit:
+    return TaskSplit(though_process="", detailed_plan="", choice="single_worker_task")
+
+
+def _plan_layer(
+    tasks: list[str], llm: LLMClient, priority: int, agent_id: str
+) -> list[TaskSplit]:
+    # a single batched request for the whole layer, raises `StructuredOutputError`
+    listing = "".join(f"## Task {i + 1}\n{task}\n\n" for i, task in enumerate(tasks))
+    prompt = [
+        SystemMessage(split_task_prompt.format(max_subtasks=MAX_SUBTASKS)),
+        HumanMessage(f"# Tasks to plan:\n\n{listing}"),
+    ]
+    layer = llm.invoke_structured(
+        prompt, LayerPlan, priority=priority, agent_id=agent_id
+    )
+    plans = layer.plans[: len(tasks)]
+    for plan in plans:
+        plan.subtasks = plan.subtasks[:MAX_SUBTASKS]
+    # a missing plan means nothing was decided, such tasks stay with a single worker
+    while len(plans) < len(tasks):
+        plans.append(_single_worker_plan())
+    return plans
+
+
+def split_tasks(
+    tasks: list[str],
+    llm: LLMClient,
+    priority: int = 0,
+    agent_id: str = "",
+) -> list[TaskSplit]:
+    # planning ahead is optional, a failed layer is left to single workers
+    if len(tasks) == 0:
+        return []
+    try:
+        return _plan_layer(tasks, llm, priority, agent_id)
+    except StructuredOutputError:
+        return [_single_worker_plan() for _ in tasks]
+
+
+def split_task(
+    task: str, llm: LLMClient, priority: int = 0, agent_id: str = ""
+) -> TaskSplit:
+    # raises `StructuredOutputError`, the caller decides what to tell the agent
+    return _plan_layer([task], llm, priority, agent_id)[0]
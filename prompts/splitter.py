@@ -0,0 +1,12 @@
+split_task_prompt = """
+You plan the execution of tasks in a large hierarchical software organization.
+Each task is handled by a single worker, who may hire sub-contractors for parts of it.
+For each of the given tasks:
+- Think about how it should be executed.
+- Decide whether a single worker can complete it, or if it has to be split into smaller, independent sub-tasks.
+- If it has to be split, list every sub-task, with a tiny label for its worker and an exhaustive description.
+  Each sub-task description must contain all the context its worker needs, workers do not see the parent task.
+Prefer single-worker tasks. Split only tasks which are clearly too large or too broad for a single engineer.
+Never split a task into more than {max_subtasks} sub-tasks.
+Answer with exactly one plan per given task, in the order the tasks were given.
+"""
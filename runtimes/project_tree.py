@@ -0,0 +1,175 @@
+import hashlib
+import os
+import time
+from threading import Lock
+
+# Host-side replacement for running `tree` inside the container.
+# The workspace is mounted, so the listing is read straight from the host fs.
+# Listings are cached per directory and re-scanned only once its mtime moves,
+# which is exactly when entries get created, removed or renamed.
+# The whole listed tree is walked, the listing shown to agents is truncated, the fingerprint is not.
+
+Entries = list[tuple[str, bool]]  # sorted (name, is_dir)
+
+TREE_EXCLUDES = frozenset(["bin", "lib", "node_modules", "dist"])
+MAX_DIR_ENTRIES = 64  # per directory, the rest is elided
+MAX_TREE_LINES = 800
+RECHECK_INTERVAL = 0.5  # seconds, collapses bursts of prompt builds
+
+_BRANCH = "├── "
+_LAST = "└── "
+_PIPE = "│   "
+_SPACE = "    "
+
+
+class ProjectTree:
+    def __init__(self, root_dir: str, excludes: frozenset[str] = TREE_EXCLUDES):
+        self.root_dir = root_dir
+        self.excludes = excludes
+        self.generation = 0  # bumped on every observed change
+        # dir path -> (mtime_ns, listed entries, hidden and excluded entries)
+        self._dirs: dict[str, tuple[int, Entries, Entries]] = {}
+        # hidden and excluded dir path -> (mtime_ns, its top-level listing)
+        self._skipped_listings: dict[str, tuple[int, str]] = {}
+        self._rendered: str | None = None
+        self._checked_at = 0.0
+        self._lock = Lock()
+
+    def _scan(self, path: str) -> tuple[Entries, Entries]:
+        entries = []
+        skipped = []
+        with os.scandir(path) as it:
+            for entry in it:
+                item = (entry.name, entry.is_dir(follow_symlinks=False))
+                # mirrors `tree -I`, hidden files are skipped by `tree` as well
+                if entry.name.startswith(".") or entry.name in self.excludes:
+                    skipped.append(item)
+                else:
+                    entries.append(item)
+        entries.sort()
+        skipped.sort()
+        return entries, skipped
+
+    def _entries(self, path: str) -> Entries | None:
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except OSError:
+            return None
+        cached = self._dirs.get(path)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+        try:
+            entries, skipped = self._scan(path)
+        except OSError:
+            return None
+        self._dirs[path] = (mtime, entries, skipped)
+        self.generation += 1
+        return entries
+
+    def _walk(self, render: bool) -> list[str]:
+        # Pre-order walk over the whole listed tree, lines are only added for its shown part.
+        # Every visited directory is stat'ed, but only re-scanned when changed.
+        lines = ["."]
+        counts = [0, 0]  # directories, files
+        visited = set()
+
+        def visit(path: str, prefix: str, visible: bool):
+            entries = self._entries(path)
+            if entries is None:
+                return
+            visited.add(path)
+            for i, (name, is_dir) in enumerate(entries):
+                shown = visible and i < MAX_DIR_ENTRIES and len(lines) < MAX_TREE_LINES
+                is_last = i == len(entries) - 1
+                if shown:
+                    counts[0 if is_dir else 1] += 1
+                    if render:
+                        lines.append(f"{prefix}{_LAST if is_last else _BRANCH}{name}")
+                    else:
+                        lines.append("")
+                if is_dir:
+                    child_prefix = prefix + (_SPACE if is_last else _PIPE)
+                    visit(os.path.join(path, name), child_prefix, shown)
+            elided = len(entries) - MAX_DIR_ENTRIES
+            if visible and elided > 0 and len(lines) < MAX_TREE_LINES:
+                lines.append(f"{prefix}{_LAST}... {elided} more entries")
+
+        visit(self.root_dir, "", True)
+
+        # forget directories that are gone or no longer listed
+        for path in self._dirs.keys() - visited:
+            del self._dirs[path]
+            self.generation += 1
+
+        if len(lines) >= MAX_TREE_LINES:
+            lines.append("... (tree truncated)")
+        lines.append("")
+        lines.append(f"{counts[0]} directories, {counts[1]} files")
+        return lines
+
+    def get(self) -> str:
+        with self._lock:
+            now = time.monotonic()
+            if self._rendered is not None and now - self._checked_at < RECHECK_INTERVAL:
+                return self._rendered
+            self._checked_at = now
+
+            generation = self.generation
+            lines = self._walk(render=self._rendered is None)
+            if self._rendered is not None and self.generation != generation:
+                # something changed on the way - listings are cached by now
+                lines = self._walk(render=True)
+            if self._rendered is None or self.generation != generation:
+                self._rendered = "\n".join(lines)
+            return self._rendered
+
+    def _skipped_listing(self, path: str, mtime: int) -> str:
+        cached = self._skipped_listings.get(path)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+        try:
+            listing = "\0".join(sorted(os.listdir(path)))
+        except OSError:
+            listing = ""
+        self._skipped_listings[path] = (mtime, listing)
+        return listing
+
+    def fingerprint(self) -> str:
+        # Every listed entry along with file sizes and mtimes, moves with any edit inside the listed tree.
+        # Hidden and excluded entries, e.g. `node_modules` or `.venv`, aren't walked,
+        # yet their mtimes and top-level listings count, e.g. installing or removing dependencies.
+        self.get()
+        digest = hashlib.sha256()
+        with self._lock:
+            seen = set()
+            for path in sorted(self._dirs.keys()):
+                _, entries, skipped = self._dirs[path]
+                for name, is_dir in entries:
+                    entry_path = os.path.join(path, name)
+                    if is_dir:
+                        digest.update(f"{entry_path}/\n".encode())
+                        continue
+                    self._digest_file(digest, entry_path)
+                for name, is_dir in skipped:
+                    entry_path = os.path.join(path, name)
+                    if not is_dir:
+                        self._digest_file(digest, entry_path)
+                        continue
+                    try:
+                        mtime = os.stat(entry_path, follow_symlinks=False).st_mtime_ns
+                    except OSError:
+                        continue
+                    seen.add(entry_path)
+                    listing = self._skipped_listing(entry_path, mtime)
+                    digest.update(f"{entry_path}/\0{mtime}\0{listing}\n".encode())
+            for path in self._skipped_listings.keys() - seen:
+                del self._skipped_listings[path]
+        return digest.hexdigest()
+
+    @staticmethod
+    def _digest_file(digest, path: str):
+        try:
+            stat = os.stat(path, follow_symlinks=False)
+        except OSError:
+            return
+        digest.update(f"{path}\0{stat.st_size}\0{stat.st_mtime_ns}\n".encode())
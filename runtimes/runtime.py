@@ -1,66 +1,120 @@
 import os
-import subprocess
-from subprocess import Popen, TimeoutExpired
-
-# 1. `docker run` starts a runtime-persistent instance.
-# 2. `docker exec` hooks an agent into the instance.
+import re
+import shlex
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from typing import Callable
+
+from debug.cassette import recorded, stable_hash
+from runtimes.project_tree import ProjectTree
+from runtimes.sandbox import FactoryBackend, SandboxBackend, backend_from_env
+from runtimes.shell_memo import ShellMemo, is_read_only
+from runtimes.shell_session import ShellSession
+from shared.Metrics import metrics
+
+# 1. The sandbox backend starts runtime-persistent instances, e.g. a pool of docker containers.
+# 2. Every agent gets placed in one of them, e.g. with `docker exec`.
 # Multiple Workers may be hooked in independently.
+# 3. Every hook is a persistent shell session, reused across commands.
 
-linux_instances: dict[str, Popen[str]] = {}
+linux_instances: dict[str, ShellSession] = {}
+# extra sessions for concurrent commands
+_idle_forks: dict[str, list[ShellSession]] = {}
+_forks_lock = Lock()
 
 local_workspace_dir = os.path.abspath("workspace")
 
-os.makedirs(local_workspace_dir, exist_ok=True)
-
-subprocess.run(
-    [
-        "docker",
-        "run",
-        "--rm",
-        "-dit",
-        "-v",  # mounts fs locally
-        f"{local_workspace_dir}:/home/ai",
-        # "--network=none",  # disabled network
-        "--network=bridge",  # enabled network
-        "--cpus=0.5",
-        "--memory=128m",
-        # "--cap-drop=ALL", # safety, blocks multiple kernel capabilities (e.g. network)
-        "--name",
-        "linux-shell",
-        "linux",
-    ],
-    # Args theoretically redundant due to main never being used.
-    stdin=subprocess.PIPE,
-    stdout=subprocess.PIPE,
-    stderr=subprocess.PIPE,
-    text=True,
-    bufsize=1,
-)
+project_tree = ProjectTree(local_workspace_dir)
+shell_memo = ShellMemo(project_tree.fingerprint)
 
 
-def create_linux_instance(instance_id: str):
-    global linux_instances
-    shell = subprocess.Popen(
-        [
-            "docker",
-            "exec",
-            "-i",
-            "-w",  # use home dir
-            "/home/ai",
-            "linux-shell",
-            "/bin/bash",
-        ],
-        stdin=subprocess.PIPE,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
-        text=True,
-        bufsize=1,
+# Swappable, e.g. for the local backend, or an in-process fake shell in benchmarks.
+# Sessions are objects implementing `ShellSession.run` and `ShellSession.close`.
+# Created on first use, importing this module starts nothing.
+_backend: SandboxBackend | None = None
+_backend_lock = Lock()
+
+
+def use_shell_backend(backend: SandboxBackend | Callable[[str], ShellSession]):
+    global _backend
+    _backend = (
+        backend if isinstance(backend, SandboxBackend) else FactoryBackend(backend)
     )
-    linux_instances[instance_id] = shell
+
+
+def _sandbox() -> SandboxBackend:
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                os.makedirs(local_workspace_dir, exist_ok=True)
+                _backend = backend_from_env(local_workspace_dir)
+    return _backend
+
+
+def create_linux_instance(instance_id: str, parent_id: str | None = None):
+    global linux_instances
+    # the parent decides the placement, e.g. workers sharing a container with their superior
+    linux_instances[instance_id] = _sandbox().create_session(instance_id, parent_id)
 
 
 def delete_linux_instance(instance_id: str):
-    linux_instances.pop(instance_id, None)
+    shell = linux_instances.pop(instance_id, None)
+    with _forks_lock:
+        forks = _idle_forks.pop(instance_id, [])
+    for session in forks if shell is None else [shell, *forks]:
+        session.close()
+    _sandbox().release(instance_id)
+
+
+def live_sessions() -> dict[str, list[ShellSession]]:
+    # every session still holding a process, forks included
+    with _forks_lock:
+        sessions = {i: [s] for i, s in linux_instances.items()}
+        for instance_id, forks in _idle_forks.items():
+            sessions.setdefault(instance_id, []).extend(forks)
+    return {i: [s for s in ss if s.is_alive()] for i, ss in sessions.items()}
+
+
+# Commands changing the state of the shell itself must run in the agent's own session.
+# Anything else may run on a forked session, next to a busy one.
+_SESSION_STATE_CMD = re.compile(
+    r"(^|[;&|(]\s*)(cd|pushd|popd|export|unset|source|\.|alias|unalias|set|shopt|umask|exec|\w+=\S*\s*($|[;&|]))(\s|$)"
+)
+
+
+def changes_session_state(command_text: str) -> bool:
+    return _SESSION_STATE_CMD.search(command_text.strip()) is not None
+
+
+def _run_on_free_session(
+    instance_id: str,
+    command_text: str,
+    timeout: float,
+) -> tuple[str, int | None, bool]:
+    shell = linux_instances[instance_id]
+    if changes_session_state(command_text):
+        return shell.run(command_text, timeout)
+    result = shell.run(command_text, timeout, wait=False)
+    if result is not None:
+        return result
+
+    # the agent's own session is busy, fork off in its last known cwd
+    with _forks_lock:
+        idle = _idle_forks.setdefault(instance_id, [])
+        fork = idle.pop() if len(idle) > 0 else _sandbox().create_session(instance_id)
+    try:
+        if shell.cwd is not None and fork.cwd != shell.cwd:
+            command_text = f"cd {shlex.quote(shell.cwd)}; {command_text}"
+        return fork.run(command_text, timeout)
+    finally:
+        with _forks_lock:
+            if instance_id in linux_instances:
+                _idle_forks.setdefault(instance_id, []).append(fork)
+                fork = None
+        # the instance got deleted mid-command
+        if fork is not None:
+            fork.close()
 
 
 # todo:
@@ -80,53 +134,119 @@ def use_linux_shell(
         return None
     timeout = timeout_seconds or SHELL_DEFAULT_TIMEOUT
 
-    # fixme: there is no shell persistence (e.g. cd doesn't work)
-    # fixme: this is a quick patch to fix .communicate crashes
-    create_linux_instance(instance_id)
-
     # todo: test if `yes` can be appended to EVERY command called
     forced_cmds = ["npx"]
     for cmd in forced_cmds:
         command_text = command_text.replace(cmd, f"yes | {cmd}")
 
-    try:
-        outs, errs = shell.communicate(command_text, timeout=timeout)
-        return outs + errs
-    except TimeoutExpired:
-        shell.kill()
-        return f"Timeout error: Command terminated after {timeout} seconds."
+    out, code, timed_out = recorded(
+        "shell",
+        stable_hash([instance_id, command_text]),
+        lambda: _run_memoized(instance_id, command_text, timeout),
+        encode=list,
+        decode=tuple,
+    )
+    if timed_out:
+        metrics.increment("shell_timeouts_total")
+    return _format_shell_result(out, code, timed_out, timeout)
+
+
+def _format_shell_result(
+    out: str, code: int | None, timed_out: bool, timeout: float
+) -> str:
+    if timed_out:
+        return f"{out}\nTimeout error: Command terminated after {timeout} seconds."
+    if code is None:
+        return f"{out}\nError: Shell session terminated unexpectedly."
+    if code != 0:
+        return f"{out}\n[exit code: {code}]"
+    return out
+
+
+def _memo_key(instance_id: str, command_text: str) -> tuple[str | None, str]:
+    # read-only commands give the same output for every agent in the same directory
+    shell = linux_instances.get(instance_id)
+    return getattr(shell, "cwd", None), command_text
+
+
+def _run_memoized(
+    instance_id: str,
+    command_text: str,
+    timeout: float,
+) -> tuple[str, int | None, bool]:
+    if not is_read_only(command_text):
+        # reads running next to this one may see the workspace mid-change, their output is dropped
+        shell_memo.bump()
+        try:
+            return _run_on_free_session(instance_id, command_text, timeout)
+        finally:
+            shell_memo.bump()
+
+    key = _memo_key(instance_id, command_text)
+    generation = shell_memo.current_generation()
+    out, code, timed_out = _run_on_free_session(instance_id, command_text, timeout)
+    if not timed_out and code is not None:
+        shell_memo.put(key, generation, (out, code, timed_out))
+    return out, code, timed_out
+
+
+def use_memoized_shell(command_text: str, instance_id: str) -> str | None:
+    # output of an earlier run of the same read-only command, if the workspace hasn't changed since
+    def lookup():
+        if instance_id not in linux_instances or not is_read_only(command_text):
+            return None
+        return shell_memo.get(_memo_key(instance_id, command_text))
+
+    result = recorded(
+        "shell_memo",
+        stable_hash([instance_id, command_text]),
+        lookup,
+        encode=list,
+        decode=tuple,
+    )
+    if result is None:
+        return None
+    out, code, timed_out = result
+    return _format_shell_result(out, code, timed_out, SHELL_DEFAULT_TIMEOUT)
 
 
 def get_project_tree() -> str | None:
-    create_linux_instance("__tree")
-    exclude_list = "|".join(["bin", "lib", "node_modules", "dist"])
-    exclude_arg = f'"{exclude_list}"'
-    return use_linux_shell(f"tree -I {exclude_arg}", "__tree")
+    return project_tree.get()
+
+
+def get_workspace_fingerprint() -> str:
+    return project_tree.fingerprint()
 
 
 TEST_CMD_ECHO = 'echo "OK"'
 TEST_CMD_NET = "ping -c 1 -W 1 8.8.8.8 &> /dev/null && echo OK || echo NOT OK"
 
 
-def is_linux_ok() -> bool:
-    create_linux_instance("__test")
+def is_linux_ok(report: Callable[[str], None] = print) -> bool:
+    if "__test" not in linux_instances:
+        create_linux_instance("__test")
 
-    echo_out = use_linux_shell(TEST_CMD_ECHO, "__test").strip()
-    net_out = use_linux_shell(TEST_CMD_NET, "__test").strip()
+    # both at once, the second one forks off the busy session
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        outputs = pool.map(
+            lambda cmd: (use_linux_shell(cmd, "__test") or "").strip(),
+            [TEST_CMD_ECHO, TEST_CMD_NET],
+        )
+        echo_out, net_out = outputs
 
-    echo_ok = echo_out is not None and echo_out != ""
-    net_ok = net_out is not None and net_out != ""
+    echo_ok = echo_out != ""
+    net_ok = net_out != ""
 
     if echo_ok:
-        print(f"LINUX [HEALTH] CHECK: {echo_out}")
+        report(f"LINUX [HEALTH] CHECK: {echo_out}")
     else:
-        print("LINUX [HEALTH] CHECK: FAILED")
+        report("LINUX [HEALTH] CHECK: FAILED")
         return False
 
     if net_ok:
-        print(f"LINUX [NETWORK] CHECK: {net_out}")
+        report(f"LINUX [NETWORK] CHECK: {net_out}")
     else:
-        print("LINUX [NETWORK] CHECK: FAILED")
+        report("LINUX [NETWORK] CHECK: FAILED")
         return False
 
     return True
@@ -0,0 +1,305 @@
+import os
+import shutil
+import subprocess
+import tempfile
+from threading import Lock, Thread
+from typing import Callable
+
+from runtimes.shell_session import SESSION_START_TIMEOUT, ShellSession
+
+# Sandbox backends create the shell sessions agents run their commands in.
+# - docker: a pool of pre-warmed containers, each with its own cpu and memory limits,
+#   a runaway command starves or OOM-kills only the agents placed in its container.
+# - local: plain local shells with rlimits, for machines without docker and for fast tests.
+# Every backend shares the same workspace, the project is one and the same for the whole tree.
+
+SANDBOX_BACKEND = os.getenv("CORTEX_SANDBOX", "docker")  # "docker" | "local"
+SANDBOX_CPUS = float(os.getenv("CORTEX_SANDBOX_CPUS", "1"))  # per container
+# per container, or per local process
+SANDBOX_MEMORY = os.getenv("CORTEX_SANDBOX_MEMORY", "512m")
+# one container per `SANDBOX_CPUS` cores by default, shell throughput scales with the machine
+SANDBOX_POOL_SIZE = int(os.getenv("CORTEX_SANDBOX_POOL_SIZE", "0")) or max(
+    1, int((os.cpu_count() or 1) / SANDBOX_CPUS)
+)
+# "subtree" | "least_loaded"
+SANDBOX_PLACEMENT = os.getenv("CORTEX_SANDBOX_PLACEMENT", "subtree")
+
+CONTAINER_NAME = "linux-shell"
+CONTAINER_IMAGE = "linux"
+CONTAINER_WORKDIR = "/home/ai"
+# running or not, and the mounted workspace, of an existing container
+CONTAINER_STATE_FORMAT = "{{.State.Running}} {{range .Mounts}}{{.Source}}{{end}}"
+WARM_SHELLS_PER_CONTAINER = 1  # started ahead of time, handed out to the next new agent
+LOCAL_CPU_SECONDS = 600  # per process, local shells cannot be throttled, only capped
+LOCAL_NICENESS = 10  # keeps the orchestrator responsive next to busy local shells
+
+
+def parse_memory(limit: str) -> int:
+    # docker notation, e.g. "512m" or "2g", to bytes
+    units = {"k": 2**10, "m": 2**20, "g": 2**30}
+    limit = limit.strip().lower()
+    if limit[-1:] in units:
+        return int(float(limit[:-1]) * units[limit[-1]])
+    return int(limit)
+
+
+class Placement:
+    # Assigns instances to pool slots, and tracks how many instances each slot holds.
+
+    def __init__(self, slots: int):
+        self.slots = slots
+        self._slot_of: dict[str, int] = {}
+        self._depth_of: dict[str, int] = {}
+        self._load = [0] * slots
+        self._lock = Lock()
+
+    def _choose(self, instance_id: str, parent_id: str | None) -> int:
+        raise NotImplementedError
+
+    def _least_loaded(self) -> int:
+        return min(range(self.slots), key=lambda i: self._load[i])
+
+    def assign(self, instance_id: str, parent_id: str | None = None) -> int:
+        with self._lock:
+            slot = self._slot_of.get(instance_id)
+            if slot is not None:
+                return slot
+            parent_depth = (
+                self._depth_of.get(parent_id) if parent_id is not None else None
+            )
+            self._depth_of[instance_id] = (
+                0 if parent_depth is None else parent_depth + 1
+            )
+            slot = self._choose(instance_id, parent_id)
+            self._slot_of[instance_id] = slot
+            self._load[slot] += 1
+            return slot
+
+    def slot_of(self, instance_id: str) -> int | None:
+        return self._slot_of.get(instance_id)
+
+    def release(self, instance_id: str):
+        with self._lock:
+            slot = self._slot_of.pop(instance_id, None)
+            self._depth_of.pop(instance_id, None)
+            if slot is not None:
+                self._load[slot] -= 1
+
+
+class LeastLoadedPlacement(Placement):
+    def _choose(self, instance_id: str, parent_id: str | None) -> int:
+        return self._least_loaded()
+
+
+class SubtreePlacement(Placement):
+    # Top-level subtrees are spread over the pool, everything below stays with its ancestors,
+    # so a subtree shares its installed tools and caches, and its load stays its own.
+
+    def __init__(self, slots: int, spread_depth: int = 1):
+        super().__init__(slots)
+        self.spread_depth = spread_depth
+
+    def _choose(self, instance_id: str, parent_id: str | None) -> int:
+        parent_slot = self._slot_of.get(parent_id) if parent_id is not None else None
+        if parent_slot is None or self._depth_of[instance_id] <= self.spread_depth:
+            return self._least_loaded()
+        return parent_slot
+
+
+placements: dict[str, Callable[[int], Placement]] = {
+    "subtree": SubtreePlacement,
+    "least_loaded": LeastLoadedPlacement,
+}
+
+
+class SandboxBackend:
+    def create_session(
+        self, instance_id: str, parent_id: str | None = None
+    ) -> ShellSession:
+        # called for the agent's own session, and for every fork of it
+        raise NotImplementedError
+
+    def release(self, instance_id: str):
+        # every session of the instance has been closed
+        pass
+
+
+class FactoryBackend(SandboxBackend):
+    # Wraps a plain session factory, e.g. an in-process fake shell in benchmarks.
+
+    def __init__(self, session_factory: Callable[[str], ShellSession]):
+        self.session_factory = session_factory
+
+    def create_session(
+        self, instance_id: str, parent_id: str | None = None
+    ) -> ShellSession:
+        return self.session_factory(instance_id)
+
+
+class DockerBackend(SandboxBackend):
+    def __init__(
+        self,
+        workspace_dir: str,
+        pool_size: int = SANDBOX_POOL_SIZE,
+        cpus: float = SANDBOX_CPUS,
+        memory: str = SANDBOX_MEMORY,
+        placement: str = SANDBOX_PLACEMENT,
+    ):
+        self.workspace_dir = workspace_dir
+        self.cpus = cpus
+        self.memory = memory
+        self.names = [f"{CONTAINER_NAME}-{i}" for i in range(pool_size)]
+        self.placement = placements[placement](pool_size)
+        self._warm: list[list[ShellSession]] = [[] for _ in self.names]
+        self._warming = [0] * pool_size
+        self._warm_lock = Lock()
+        self._started = False
+        self._start_lock = Lock()
+
+    def _docker(self, *args: str) -> subprocess.CompletedProcess:
+        return subprocess.run(
+            ["docker", *args],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            text=True,
+        )
+
+    def _is_adoptable(self, name: str) -> bool:
+        # left running by a previous run, over the same workspace
+        inspected = self._docker("inspect", "-f", CONTAINER_STATE_FORMAT, name)
+        state = inspected.stdout.split()
+        return inspected.returncode == 0 and state == ["true", self.workspace_dir]
+
+    def _run_container(self, name: str) -> str | None:
+        # returns the error, if the container could be neither started nor adopted
+        if self._is_adoptable(name):
+            return None
+        # e.g. a stopped leftover, or one mounting another workspace, holding the name
+        self._docker("rm", "-f", name)
+        result = self._docker(
+            "run",
+            "--rm",
+            "-dit",
+            "-v",  # mounts fs locally
+            f"{self.workspace_dir}:{CONTAINER_WORKDIR}",
+            # "--network=none",  # disabled network
+            "--network=bridge",  # enabled network
+            f"--cpus={self.cpus}",
+            f"--memory={self.memory}",
+            # "--cap-drop=ALL", # safety, blocks multiple kernel capabilities (e.g. network)
+            "--name",
+            name,
+            CONTAINER_IMAGE,
+        )
+        if result.returncode != 0:
+            return f"docker run {name} failed: {result.stderr.strip()}"
+        return None
+
+    def start(self):
+        # the whole pool starts in parallel, before the first agent needs a shell
+        with self._start_lock:
+            if self._started:
+                return
+            errors: list[str | None] = [None] * len(self.names)
+
+            def run(slot: int):
+                errors[slot] = self._run_container(self.names[slot])
+
+            threads = [
+                Thread(target=run, args=(slot,), daemon=True)
+                for slot in range(len(self.names))
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            failed = [e for e in errors if e is not None]
+            if len(failed) > 0:
+                raise RuntimeError("\n".join(failed))
+            self._started = True
+        for slot in range(len(self.names)):
+            self._refill(slot)
+
+    def _session_in(self, slot: int) -> ShellSession:
+        name = self.names[slot]
+        return ShellSession(
+            ["docker", "exec", "-i", "-w", CONTAINER_WORKDIR, name, "/bin/bash"],
+            ["docker", "exec", name],
+        )
+
+    def _refill(self, slot: int):
+        # warms up a shell in the background, `docker exec` takes a while to attach
+        def warm():
+            session = self._session_in(slot)
+            try:
+                session.run("true", SESSION_START_TIMEOUT)
+            finally:
+                with self._warm_lock:
+                    self._warming[slot] -= 1
+                    if session.is_alive():
+                        self._warm[slot].append(session)
+
+        with self._warm_lock:
+            if len(self._warm[slot]) + self._warming[slot] >= WARM_SHELLS_PER_CONTAINER:
+                return
+            self._warming[slot] += 1
+        Thread(target=warm, daemon=True).start()
+
+    def create_session(
+        self, instance_id: str, parent_id: str | None = None
+    ) -> ShellSession:
+        self.start()
+        slot = self.placement.assign(instance_id, parent_id)
+        with self._warm_lock:
+            warm = self._warm[slot]
+            session = warm.pop() if len(warm) > 0 else None
+        self._refill(slot)
+        if session is None or not session.is_alive():
+            session = self._session_in(slot)
+        return session
+
+    def release(self, instance_id: str):
+        self.placement.release(instance_id)
+
+
+class LocalBackend(SandboxBackend):
+    # Local bash processes, working in the shared workspace, each agent with its own home and temp dir.
+    # note: no isolation from the host whatsoever, rlimits only keep a runaway command from taking it down
+
+    def __init__(self, workspace_dir: str, memory: str = SANDBOX_MEMORY):
+        self.workspace_dir = workspace_dir
+        self.memory_bytes = parse_memory(memory)
+        self.homes_dir = tempfile.mkdtemp(prefix="cortex-sandbox-")
+
+    def _shell_args(self) -> list[str]:
+        # limits are set by the child itself, `preexec_fn` isn't safe in a multithreaded process
+        # the data limit caps allocated memory, close to docker's `--memory`, unlike `ulimit -v`,
+        # which counts reserved address space, and breaks e.g. node right at startup
+        limits = (
+            f"ulimit -d {self.memory_bytes // 1024}; "
+            f"ulimit -t {LOCAL_CPU_SECONDS}; "
+            f"exec nice -n {LOCAL_NICENESS} bash --noprofile --norc"
+        )
+        return ["bash", "-c", limits]
+
+    def create_session(
+        self, instance_id: str, parent_id: str | None = None
+    ) -> ShellSession:
+        home = os.path.join(self.homes_dir, instance_id)
+        os.makedirs(os.path.join(home, "tmp"), exist_ok=True)
+        env = {**os.environ, "HOME": home, "TMPDIR": os.path.join(home, "tmp")}
+        return ShellSession(
+            self._shell_args(), [], {"cwd": self.workspace_dir, "env": env}
+        )
+
+    def release(self, instance_id: str):
+        shutil.rmtree(os.path.join(self.homes_dir, instance_id), ignore_errors=True)
+
+
+def backend_from_env(workspace_dir: str) -> SandboxBackend:
+    if SANDBOX_BACKEND == "local":
+        return LocalBackend(workspace_dir)
+    if SANDBOX_BACKEND == "docker":
+        return DockerBackend(workspace_dir)
+    raise ValueError(f"Unknown sandbox backend: {SANDBOX_BACKEND}")
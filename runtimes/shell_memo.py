@@ -0,0 +1,135 @@
+import os
+import re
+import shlex
+import time
+from collections import OrderedDict
+from threading import Lock
+from typing import Callable
+
+# Output of side-effect-free commands, shared by all agents.
+# Entries are only valid for the workspace generation they were produced in.
+# Every command which isn't known to be read-only bumps the generation, before and after running,
+# and so does any host-side change to the workspace, noticed via its fingerprint.
+
+SHELL_MEMO_SIZE = int(os.getenv("CORTEX_SHELL_MEMO_SIZE", "512"))  # 0 disables the memo
+HOST_RECHECK_INTERVAL = 0.5  # seconds, between workspace fingerprints
+
+# note: conservative on purpose, anything that may write, spawn or depend on time is left out
+READ_ONLY_COMMANDS = frozenset(
+    [
+        *["cat", "head", "tail", "wc", "diff", "cmp", "md5sum", "sha256sum"],
+        *["file", "stat", "ls", "tree", "find", "du", "pwd", "realpath"],
+        *["basename", "dirname", "which", "grep", "egrep", "fgrep", "rg", "git"],
+    ]
+)
+READ_ONLY_GIT = frozenset(
+    ["status", "log", "diff", "show", "ls-files", "rev-parse", "blame"]
+)
+# options which write files, or run other programs, per command
+WRITING_ARGS = {
+    "find": frozenset(
+        [
+            *["-exec", "-execdir", "-ok", "-okdir", "-delete"],
+            *["-fprint", "-fprint0", "-fprintf", "-fls"],
+        ]
+    ),
+    "tree": frozenset(["-o"]),
+    "file": frozenset(["-C", "--compile"]),
+    "git": frozenset(["--output"]),
+    "rg": frozenset(["--pre"]),
+}
+
+# only /dev/null itself, e.g. not `/dev/nullx`
+_DISCARDED_OUTPUT = re.compile(r"\d?>\s*/dev/null(?![^\s;&|])|2>&1")
+_UNSAFE = re.compile(r"[<>`]|\$\(|(^|[^&])&($|[^&])")
+_SEPARATORS = re.compile(r"&&|\|\||[;|\n]")
+
+MemoKey = tuple[str | None, str]  # cwd, command
+ShellResult = tuple[str, int | None, bool]  # output, exit code, timed out
+
+
+def is_read_only(command_text: str) -> bool:
+    text = _DISCARDED_OUTPUT.sub("", command_text)
+    if _UNSAFE.search(text) is not None:
+        return False
+    parts = [p for p in _SEPARATORS.split(text) if p.strip() != ""]
+    if len(parts) == 0:
+        return False
+    for part in parts:
+        try:
+            args = shlex.split(part)
+        except ValueError:
+            return False
+        if len(args) == 0 or args[0] not in READ_ONLY_COMMANDS:
+            return False
+        if args[0] == "git" and (len(args) < 2 or args[1] not in READ_ONLY_GIT):
+            return False
+        if any(_is_option(arg, WRITING_ARGS.get(args[0], ())) for arg in args[1:]):
+            return False
+    return True
+
+
+def _is_option(arg: str, options: frozenset[str]) -> bool:
+    # matches `--opt=value`, and short options bundled together, e.g. `-ao`
+    if arg in options or arg.split("=")[0] in options:
+        return True
+    if arg.startswith("-") and not arg.startswith("--"):
+        return any(f"-{c}" in options for c in arg[1:])
+    return False
+
+
+class ShellMemo:
+    def __init__(
+        self, fingerprint: Callable[[], str], max_entries: int = SHELL_MEMO_SIZE
+    ):
+        self.max_entries = max_entries
+        self.generation = 0
+        self._fingerprint = fingerprint
+        self._host_fingerprint: str | None = None
+        self._checked_at = 0.0
+        self._entries: OrderedDict[MemoKey, ShellResult] = OrderedDict()
+        self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def bump(self):
+        with self._lock:
+            self.generation += 1
+            self._entries.clear()
+
+    def current_generation(self) -> int:
+        # host-side edits don't go through the shell, they're caught by the workspace fingerprint
+        now = time.monotonic()
+        if now - self._checked_at >= HOST_RECHECK_INTERVAL:
+            self._checked_at = now
+            fingerprint = self._fingerprint()
+            if fingerprint != self._host_fingerprint:
+                if self._host_fingerprint is not None:
+                    self.bump()
+                self._host_fingerprint = fingerprint
+        return self.generation
+
+    def get(self, key: MemoKey) -> ShellResult | None:
+        if self.max_entries <= 0:
+            return None
+        self.current_generation()
+        with self._lock:
+            result = self._entries.get(key)
+            if result is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return result
+
+    def put(self, key: MemoKey, generation: int, result: ShellResult):
+        # `generation` as of starting the command, whatever ran in the meantime may have changed its output
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            if generation != self.generation:
+                return
+            self._entries[key] = result
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
@@ -0,0 +1,187 @@
+import shlex
+import subprocess
+import time
+from queue import Queue, Empty
+from subprocess import Popen
+from threading import Lock, Thread
+from typing import Any, Literal
+from uuid import uuid4
+
+from shared.Metrics import metrics
+
+SESSION_START_TIMEOUT = 30
+KILL_GRACE_SECONDS = 5
+SENTINEL_PREFIX = "__CORTEX_DONE_"
+# Commands run inside a single-pass loop, so a timed out one can be aborted as a whole:
+# the shell gets ABORT_SIGNAL, whose trap breaks out of the loop once the running process is killed,
+# the rest of the command line is skipped, while cwd and env stay as they were.
+ABORT_SIGNAL = "USR1"
+ABORT_TRAP = f"trap '{{ break 1000; }} 2>/dev/null' {ABORT_SIGNAL}"
+
+
+class ShellSession:
+    # A long-lived bash process, shared by all commands of a single agent.
+    # Each command is framed by a unique sentinel carrying its exit code,
+    # so cwd and env persist between commands without reopening the pipe.
+
+    def __init__(
+        self,
+        shell_args: list[str],
+        exec_args: list[str],
+        popen_options: dict[str, Any] | None = None,
+    ):
+        self._shell_args = shell_args  # starts the interactive shell
+        # runs one-off helper commands next to it, empty for local shells
+        self._exec_args = exec_args
+        # e.g. cwd, env, or limits of local shells
+        self._popen_options = popen_options or {}
+        self._process: Popen[str] | None = None
+        self._lines: Queue[str | None] = Queue()
+        self._lock = Lock()
+        self.pid: int | None = None  # shell pid, as seen by `exec_args`
+        self.cwd: str | None = None  # as of the last finished command
+
+    def is_alive(self) -> bool:
+        return self._process is not None and self._process.poll() is None
+
+    def _start(self):
+        # restarted and restored sessions pick up where the previous shell left off
+        resume_cwd = self.cwd
+        self._process = subprocess.Popen(
+            self._shell_args,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            text=True,
+            bufsize=1,
+            **self._popen_options,
+        )
+        self._lines = Queue()
+        Thread(
+            target=_pump_lines,
+            args=(self._process.stdout, self._lines),
+            daemon=True,
+        ).start()
+        out, code, _ = self._run_framed("echo $$", SESSION_START_TIMEOUT)
+        self.pid = int(out) if code == 0 and out.strip().isdigit() else None
+        if resume_cwd is not None:
+            self._run_framed(f"cd {shlex.quote(resume_cwd)}", SESSION_START_TIMEOUT)
+
+    def _write_frame(self, command_text: str) -> str:
+        sentinel = f"{SENTINEL_PREFIX}{uuid4().hex}__"
+        # eval keeps syntax errors of the command from derailing the framing,
+        # stdin is detached so commands cannot swallow the following frames
+        self._process.stdin.write(
+            f"{ABORT_TRAP}; for __cortex_frame in 1; do "
+            f"eval {shlex.quote(command_text)} </dev/null 2>&1; done\n"
+            f"printf '\\n{sentinel} %d %s\\n' $? \"$PWD\"\n"
+        )
+        self._process.stdin.flush()
+        return sentinel
+
+    def _read_frame(
+        self,
+        sentinel: str,
+        timeout: float,
+        lines: list[str],
+    ) -> Literal["done", "timeout", "died"] | int:
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                line = self._lines.get(timeout=max(deadline - time.monotonic(), 0))
+            except Empty:
+                return "timeout"
+            if line is None:
+                return "died"
+            if line.startswith(sentinel):
+                # drop the newline the sentinel frame is prefixed with
+                if len(lines) > 0:
+                    lines[-1] = lines[-1][:-1]
+                frame = line.rstrip("\n").split(" ", 2)
+                self.cwd = frame[2] if len(frame) > 2 else self.cwd
+                return int(frame[1])
+            lines.append(line)
+
+    def _run_framed(
+        self, command_text: str, timeout: float
+    ) -> tuple[str, int | None, bool]:
+        lines = []
+        try:
+            sentinel = self._write_frame(command_text)
+        except (BrokenPipeError, OSError):
+            self.close()
+            return "Shell session is not available.", None, False
+
+        status = self._read_frame(sentinel, timeout, lines)
+        if isinstance(status, int):
+            return "".join(lines), status, False
+        if status == "died":
+            self.close()
+            return "".join(lines), None, False
+
+        # timed out - abort the whole command line, give the frame a moment to close
+        if self.pid is not None:
+            self._kill_descendants(abort=True)
+        status = self._read_frame(sentinel, KILL_GRACE_SECONDS, lines)
+        if not isinstance(status, int):
+            # the shell itself is stuck, e.g. in a builtin, restart it
+            self.close()
+        return "".join(lines), None, True
+
+    def _kill_descendants(self, include_shell: bool = False, abort: bool = False):
+        # kills every descendant of the shell, leaving the shell itself intact unless asked to
+        # with `abort`, the shell is signalled first, and skips the rest of the running command
+        kill_tree = f"kill -{ABORT_SIGNAL} {self.pid} 2>/dev/null; " if abort else ""
+        kill_tree += (
+            "k() { for c in $(cat /proc/$1/task/*/children 2>/dev/null); do k $c; done; "
+            "kill -KILL $1 2>/dev/null; }; "
+            f"for c in $(cat /proc/{self.pid}/task/*/children 2>/dev/null); do k $c; done"
+        )
+        if include_shell:
+            kill_tree += f"; kill -KILL {self.pid} 2>/dev/null"
+        subprocess.run(
+            [*self._exec_args, "sh", "-c", kill_tree],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+
+    def run(
+        self,
+        command_text: str,
+        timeout: float,
+        wait: bool = True,
+    ) -> tuple[str, int | None, bool] | None:
+        # returns output, exit code (None if killed), and whether it timed out
+        # without `wait`, returns None right away if the session is busy
+        if not self._lock.acquire(blocking=wait):
+            return None
+        try:
+            if not self.is_alive():
+                spawn_start = time.perf_counter()
+                self._start()
+                metrics.observe(
+                    "shell_spawn_seconds", time.perf_counter() - spawn_start
+                )
+            exec_start = time.perf_counter()
+            result = self._run_framed(command_text, timeout)
+            metrics.observe("shell_exec_seconds", time.perf_counter() - exec_start)
+            return result
+        finally:
+            self._lock.release()
+
+    def close(self):
+        if self._process is None:
+            return
+        # killing the exec client alone leaves the shell and its commands running in the container
+        if self.pid is not None and self.is_alive():
+            self._kill_descendants(include_shell=True)
+        self._process.kill()
+        self._process.wait()
+        self._process = None
+        self.pid = None
+
+
+def _pump_lines(stream, lines: Queue):
+    for line in stream:
+        lines.put(line)
+    lines.put(None)
@@ -1,6 +1,9 @@
+import hashlib
+from threading import Lock
 from typing import Any
+from uuid import uuid4
 
-from langchain_core.messages import AIMessage, HumanMessage
+from langchain_core.messages import AIMessage
 
 
 class AgentPool:
@@ -12,6 +15,9 @@ class AgentPool:
         from models.agents.base import Agent
 
         self._store: dict[str, Agent] = {}
+        self._id_lock = Lock()
+        self._id_seed: str | None = None
+        self._ids_issued: dict[str, int] = {}  # parent id -> children ids issued
 
     def __new__(cls, *args, **kwargs):
         if cls._instance is None:
@@ -19,6 +25,26 @@ class AgentPool:
             cls._instance._init()
         return cls._instance
 
+    def use_deterministic_ids(self, seed: str):
+        # required for replays - ids end up in prompts, and thus in cassette keys
+        self._id_seed = seed
+
+    def generate_id(self, parent_id: str) -> str:
+        # unique but readable, 6 alpha-num chars
+        with self._id_lock:
+            while True:
+                if self._id_seed is None:
+                    agent_id = uuid4().hex[:6]
+                else:
+                    # derived from the parent, so concurrent hiring still yields reproducible ids
+                    n = self._ids_issued.get(parent_id, 0)
+                    self._ids_issued[parent_id] = n + 1
+                    digest = hashlib.sha256(f"{self._id_seed}:{parent_id}:{n}".encode())
+                    agent_id = digest.hexdigest()[:6]
+                if agent_id not in self._store:
+                    self._store[agent_id] = None  # reserved until registered
+                    return agent_id
+
     def register(self, agent_id, agent: Any):
         # note: could move creation here if we moved methods out of Agent
         self._store[agent_id] = agent
@@ -26,8 +52,22 @@ class AgentPool:
     def get(self, agent_id):
         return self._store.get(agent_id)
 
+    def agents(self) -> list[Any]:
+        # registered agents only, skips reserved ids
+        return [a for a in list(self._store.values()) if a is not None]
+
+    def issued_ids(self) -> dict[str, int]:
+        with self._id_lock:
+            return dict(self._ids_issued)
+
+    def restore_issued_ids(self, issued: dict[str, int]):
+        with self._id_lock:
+            self._ids_issued.update(issued)
+
     def remove(self, agent_id):
-        return self._store.pop(agent_id)
+        with self._id_lock:
+            self._ids_issued.pop(agent_id, None)
+            return self._store.pop(agent_id, None)
 
     def execute(self, agent_id):
         return self.get(agent_id).run_turn()
@@ -51,5 +91,5 @@ class AgentPool:
 
         receiver.queue_response(sender.id)
 
-        sender_chat.chat_history.append(message)
-        receiver_chat.chat_history.append(HumanMessage(message.content))
+        # both chats view the same log, the receiver sees the message as a human one
+        sender_chat.append(message)
@@ -0,0 +1,272 @@
+import os
+from typing import Any
+
+import orjson
+import zstandard
+
+from runtimes.runtime import linux_instances
+from shared.AgentPool import AgentPool
+from shared.ExternalChat import ChatLog, ChatRecord, ExternalChat
+from shared.frames import complete_length, iter_frames, pack_frame
+from shared.Scheduler import TreeScheduler
+
+# Snapshot/restore of the whole hierarchy, as an append-only file of zstd frames, one per round.
+# Frames only carry what changed since the previous one: agent state, chat log records past the
+# last written one, folding progress of each chat side, new memory notes, shell working dirs, and removals.
+# Restoring replays the frames in order, summaries included - no LLM calls are made.
+
+SideKey = tuple[str, str]  # owner id, peer id
+_CHANGES = ("removed", "agents", "notes", "logs", "sides", "closed", "cwds", "ids")
+
+
+def _encode_record(r: ChatRecord) -> list:
+    return [r.author, r.content, r.tool_calls, r.tool_call_id, r.name]
+
+
+class Checkpoint:
+    def __init__(self, path: str):
+        self.path = path
+        self._file = None
+        self._compressor = zstandard.ZstdCompressor()
+        # last written state, deltas are taken against it
+        self._agents: dict[str, dict] = {}
+        self._notes: dict[str, int] = {}
+        # members -> serial, end
+        self._logs: dict[tuple[str, str], tuple[int, int]] = {}
+        # serial, start, folded, summary
+        self._sides: dict[SideKey, tuple[int, int | None, int, str]] = {}
+        self._cwds: dict[str, str | None] = {}
+        self._ids: dict[str, int] = {}
+        self._scheduling: tuple | None = None  # root, nudges, and paused subtrees
+
+    def exists(self) -> bool:
+        return os.path.exists(self.path) and os.path.getsize(self.path) > 0
+
+    def _delta(self, scheduler: TreeScheduler) -> dict[str, Any]:
+        live = {agent.id: agent for agent in AgentPool().agents()}
+        frame = {
+            "round": scheduler.round,
+            "root": scheduler.root.id,
+            "nudges": [
+                [due, i, t]
+                for due, nudges in scheduler.nudges.items()
+                for i, t in nudges
+            ],
+            "paused": sorted(scheduler.paused),
+            "removed": [i for i in self._agents if i not in live],
+            "agents": {},
+            "notes": {},
+            "logs": [],
+            "sides": [],
+            "closed": [],
+            "cwds": {},
+            "ids": {},
+        }
+        for agent_id in frame["removed"]:
+            del self._agents[agent_id]
+            self._notes.pop(agent_id, None)
+            self._cwds.pop(agent_id, None)
+
+        open_sides = set()
+        open_logs: dict[tuple[str, str], ChatLog] = {}
+        for agent_id, agent in live.items():
+            state = agent.snapshot()
+            if self._agents.get(agent_id) != state:
+                frame["agents"][agent_id] = state
+                self._agents[agent_id] = state
+
+            notes = getattr(agent, "memory_notes", None)
+            if notes is not None:
+                written = self._notes.get(agent_id, 0)
+                if len(notes) < written:
+                    written = 0  # cleared, rewritten from scratch
+                if len(notes) != self._notes.get(agent_id, 0):
+                    frame["notes"][agent_id] = [written, notes[written:]]
+                    self._notes[agent_id] = len(notes)
+
+            for peer_id, chat in list(agent.external_chats.items()):
+                key = (agent_id, peer_id)
+                open_sides.add(key)
+                open_logs[chat.log.members] = chat.log
+                record = self._side_delta(key, chat)
+                if record is not None:
+                    frame["sides"].append(record)
+
+            session = linux_instances.get(agent_id)
+            cwd = getattr(session, "cwd", None)
+            if session is not None and self._cwds.get(agent_id) != cwd:
+                frame["cwds"][agent_id] = cwd
+                self._cwds[agent_id] = cwd
+
+        for log in open_logs.values():
+            record = self._log_delta(log)
+            if record is not None:
+                frame["logs"].append(record)
+        for members in self._logs.keys() - open_logs.keys():
+            del self._logs[members]
+        for key in self._sides.keys() - open_sides:
+            frame["closed"].append(list(key))
+            del self._sides[key]
+
+        for parent_id, issued in AgentPool().issued_ids().items():
+            if self._ids.get(parent_id) != issued:
+                frame["ids"][parent_id] = issued
+                self._ids[parent_id] = issued
+        return frame
+
+    def _log_delta(self, log: ChatLog) -> dict | None:
+        with log.lock:
+            serial, base, end = log.serial, log.base, log.end()
+            written = self._logs.get(log.members)
+            if written == (serial, end):
+                return None
+            # a different serial - the chat was closed and opened again
+            reset = written is None or written[0] != serial
+            start = base if reset else max(written[1], base)
+            records = [_encode_record(r) for r in log.records[start - base :]]
+        self._logs[log.members] = (serial, end)
+        return {
+            "members": list(log.members),
+            "reset": reset,
+            "from": start,
+            "records": records,
+        }
+
+    def _side_delta(self, key: SideKey, chat: ExternalChat) -> dict | None:
+        state = (
+            chat.log.serial,
+            chat.log.starts.get(key[0]),
+            chat.folded_count,
+            chat.summary,
+        )
+        written = self._sides.get(key)
+        if written == state:
+            return None
+        record = {
+            "owner": key[0],
+            "peer": key[1],
+            "label": chat.target_label,
+            "start": state[1],
+            "folded": state[2],
+        }
+        if written is None or written[3] != state[3]:
+            record["summary"] = state[3]
+        self._sides[key] = state
+        return record
+
+    def write(self, scheduler: TreeScheduler):
+        # called between rounds, while no turns are running
+        delta = self._delta(scheduler)
+        scheduling = (delta["root"], delta["nudges"], delta["paused"])
+        # rounds that changed nothing aren't written, only the round number would differ
+        if scheduling == self._scheduling and not any(delta[k] for k in _CHANGES):
+            return
+        self._scheduling = scheduling
+        frame = orjson.dumps(delta)
+        if self._file is None:
+            self._file = open(self.path, "ab")
+        self._file.write(pack_frame(self._compressor.compress(frame)))
+        self._file.flush()
+
+    def restore(self) -> TreeScheduler:
+        # runtime import - registers every agent class
+        from models.agents.base import agent_classes
+        import models.agents.general, models.agents.user  # noqa: F401
+
+        agents: dict[str, dict] = {}
+        notes: dict[str, list[str]] = {}
+        logs: dict[tuple[str, str], dict] = {}
+        sides: dict[SideKey, dict] = {}
+        cwds: dict[str, str | None] = {}
+        ids: dict[str, int] = {}
+        last = None
+
+        decompressor = zstandard.ZstdDecompressor()
+        with open(self.path, "rb") as f:
+            data = f.read()
+        for raw in iter_frames(data):
+            frame = orjson.loads(decompressor.decompress(raw))
+            last = frame
+            for agent_id in frame["removed"]:
+                agents.pop(agent_id, None)
+                notes.pop(agent_id, None)
+                cwds.pop(agent_id, None)
+            agents.update(frame["agents"])
+            for agent_id, (start, items) in frame["notes"].items():
+                notes[agent_id] = notes.get(agent_id, [])[:start] + items
+            for owner, peer in frame["closed"]:
+                sides.pop((owner, peer), None)
+            for record in frame["logs"]:
+                _apply_log_record(logs, record)
+            for record in frame["sides"]:
+                side = sides.setdefault(
+                    (record["owner"], record["peer"]), {"summary": ""}
+                )
+                side.update(record)
+            cwds.update(frame["cwds"])
+            ids.update(frame["ids"])
+        if last is None:
+            raise RuntimeError(f"Checkpoint {self.path} holds no complete frame.")
+        # a torn frame from a crash mid-write, new frames go right after the last complete one
+        if complete_length(data) < len(data):
+            with open(self.path, "r+b") as f:
+                f.truncate(complete_length(data))
+
+        restored = {
+            i: agent_classes[s["class"]].restore(i, s) for i, s in agents.items()
+        }
+        for agent_id, agent in restored.items():
+            if agent_id in notes:
+                agent.memory_notes = notes[agent_id]
+            for child_id in agents[agent_id].get("children", []):
+                agent.children[child_id] = restored[child_id]
+            if agent_id in cwds and agent_id in linux_instances:
+                linux_instances[agent_id].cwd = cwds[agent_id]
+        for members, state in logs.items():
+            # sides which stopped reading, e.g. the user's, have no start
+            starts = {
+                s["owner"]: s["start"]
+                for k, s in sides.items()
+                if set(k) == set(members) and s["start"] is not None
+            }
+            if not any(set(k) == set(members) for k in sides):
+                continue  # closed by both sides
+            records = [ChatRecord(*r) for r in state["records"]]
+            log = ChatLog.restored(tuple(members), state["base"], records, starts)
+            for owner, peer in (members, members[::-1]):
+                side = sides.get((owner, peer))
+                if side is None:
+                    continue
+                chat = ExternalChat(log, owner, peer, side["label"])
+                chat.summary = side["summary"]
+                chat.folded_count = side["folded"]
+                restored[owner].external_chats[peer] = chat
+        AgentPool().restore_issued_ids(ids)
+
+        scheduler = TreeScheduler(restored[last["root"]])
+        scheduler.round = last["round"]
+        for due, agent_id, token in last["nudges"]:
+            scheduler.nudges.setdefault(due, []).append((agent_id, token))
+        scheduler.paused.update(last.get("paused", []))
+
+        # continue appending deltas against what was just restored
+        delta = self._delta(scheduler)
+        self._scheduling = (delta["root"], delta["nudges"], delta["paused"])
+        return scheduler
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def _apply_log_record(logs: dict[tuple[str, str], dict], record: dict):
+    members = tuple(record["members"])
+    state = None if record["reset"] else logs.get(members)
+    if state is None:
+        state = {"base": record["from"], "records": []}
+        logs[members] = state
+    # records past `from` are re-sent, records before the new base were trimmed away
+    records = state["records"]
+    del records[record["from"] - state["base"] :]
+    records.extend(record["records"])
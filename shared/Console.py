@@ -0,0 +1,194 @@
+import shlex
+from threading import Event, Lock, Thread
+from typing import Any, Callable
+
+from debug.cassette import active_cassette, recorded
+from debug.tracer import flush_traces
+from shared.AgentPool import AgentPool
+from shared.Scheduler import TreeScheduler
+
+# Operator console, the tree keeps running in the background while the operator reads and types.
+# Commands are only queued when typed, and applied between rounds, never mid-turn:
+# messages land in the target's response queue for the next round, and views never race a turn.
+# Every round's batch of commands is recorded, replays apply them at the very same rounds.
+
+# Rounds only run while there's work, an idle tree costs nothing.
+# Once it has been idle this long, its sleeping agents get their pending nudges.
+IDLE_NUDGE_INTERVAL = 300.0  # seconds
+
+CONSOLE_HELP = """Commands:
+  <text>                  message the root agent
+  /msg <agent id> <text>  message any agent in the tree
+  /pause <agent id>       hold back the agent's whole subtree
+  /resume <agent id>      let it continue
+  /view <agent id> [peer] show the agent's prompt, for its chat with the peer (its superior by default)
+  /tree                   show the hierarchy
+  /quit                   stop the tree and exit"""
+
+# name -> minimum and maximum number of arguments
+_COMMANDS: dict[str, tuple[int, int]] = {
+    "msg": (2, 2),
+    "pause": (1, 1),
+    "resume": (1, 1),
+    "view": (1, 2),
+    "tree": (0, 0),
+    "quit": (0, 0),
+}
+
+Command = list[str]  # name, then arguments
+# queued by the console itself once idle, recorded along with the operator's commands
+IDLE_TICK: Command = ["idle"]
+
+
+def parse_command(line: str) -> Command:
+    line = line.strip()
+    if not line.startswith("/"):
+        return ["msg", "", line]  # the root, resolved once applied
+    name, _, rest = line[1:].partition(" ")
+    if name not in _COMMANDS:
+        raise ValueError(f"Unknown command /{name}.")
+    if name == "msg":
+        agent_id, _, text = rest.strip().partition(" ")
+        args = [agent_id, text.strip()] if agent_id != "" and text.strip() != "" else []
+    else:
+        args = shlex.split(rest)
+    low, high = _COMMANDS[name]
+    if not low <= len(args) <= high:
+        raise ValueError(f"Wrong arguments for /{name}.")
+    return [name, *args]
+
+
+class Console:
+    def __init__(
+        self,
+        scheduler: TreeScheduler,
+        user: Any,
+        after_round: Callable[[], None] = lambda: None,
+        show_tree: Callable[[], None] = lambda: None,
+        on_error: Callable[[BaseException], None] = lambda e: None,
+    ):
+        self.scheduler = scheduler
+        self.user = user
+        self.after_round = after_round
+        self.show_tree = show_tree
+        self.on_error = on_error  # called from the runner thread, right as it stops
+        # whatever stopped the tree, e.g. an exhausted replay
+        self.error: BaseException | None = None
+        self._stalled = False  # the last round ran no turns, e.g. all work is paused
+        self._inbox: list[Command] = []
+        self._lock = Lock()
+        self._wake = Event()
+        self._stopped = False
+        self._thread: Thread | None = None
+
+    def submit(self, line: str) -> str | None:
+        # returns an error to show the operator, the command itself is applied between rounds
+        if line.strip() in ("", "/help"):
+            return CONSOLE_HELP if line.strip() == "/help" else None
+        try:
+            command = parse_command(line)
+        except ValueError as e:
+            return f"{e}\n{CONSOLE_HELP}"
+        with self._lock:
+            self._inbox.append(command)
+        self._wake.set()
+        return None
+
+    def _drain(self) -> list[Command]:
+        def take():
+            with self._lock:
+                commands, self._inbox = self._inbox, []
+            return commands
+
+        return recorded("console", str(self.scheduler.round + 1), take)
+
+    def _apply(self, command: Command):
+        name, args = command[0], command[1:]
+        # whatever the operator asked for is printed after the traces leading up to it
+        flush_traces()
+        if name == "idle":
+            self.scheduler.fire_idle_nudges()
+            return
+        if name == "quit":
+            self._stopped = True
+            return
+        if name == "tree":
+            self.show_tree()
+            return
+        agent_id = args[0] if args[0] != "" else self.scheduler.root.id
+        agent = AgentPool().get(agent_id)
+        if agent is None or agent is self.user:
+            print(f"CONSOLE: no agent with id {agent_id}.")
+            return
+        if name == "msg":
+            if agent_id not in self.user.external_chats:
+                self.user.connect_to(agent_id)
+            AgentPool().message(self.user.id, agent_id, args[1])
+        elif name == "pause":
+            self.scheduler.pause(agent_id)
+        elif name == "resume":
+            self.scheduler.resume(agent_id)
+        elif name == "view":
+            peer_id = args[1] if len(args) > 1 else agent.parent_id
+            if peer_id not in agent.external_chats:
+                print(f"CONSOLE: {agent_id} has no chat with {peer_id}.")
+                return
+            print(agent.get_agent_view(peer_id))
+
+    def _has_work(self) -> bool:
+        root = self.scheduler.root
+        return (
+            root.subtree_has_work
+            and root.id not in self.scheduler.paused
+            and not self._stalled
+        )
+
+    def _wait_for_work(self):
+        if self._has_work():
+            return
+        if not self._wake.wait(IDLE_NUDGE_INTERVAL):
+            with self._lock:
+                self._inbox.append(IDLE_TICK)
+
+    def _run(self):
+        cassette = active_cassette()
+        replaying = cassette is not None and cassette.mode == "replay"
+        try:
+            while not self._stopped:
+                if not replaying:
+                    self._wait_for_work()
+                self._wake.clear()
+                commands = self._drain()
+                for command in commands:
+                    self._apply(command)
+                if self._stopped:
+                    break
+                if len(commands) > 0:
+                    self._stalled = False
+                if not self._has_work():
+                    continue
+                self.scheduler.run_round()
+                self._stalled = self.scheduler.round_turns == 0
+                self.after_round()
+        except BaseException as e:
+            self.error = e
+            self._stopped = True
+            self.on_error(e)
+
+    def start(self) -> "Console":
+        self._thread = Thread(target=self._run, name="tree-runner", daemon=True)
+        self._thread.start()
+        return self
+
+    def is_running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def stop(self):
+        self.submit("/quit")
+        self.join()
+
+    def join(self):
+        if self._thread is not None:
+            self._thread.join()
+        if self.error is not None:
+            raise self.error
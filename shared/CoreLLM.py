@@ -1,23 +1,413 @@
+import json
 import os
+import random
+import time
+from threading import Lock
+from typing import Callable, TypeVar
 
-from dotenv import load_dotenv
+import httpx
 from langchain_core.language_models import BaseChatModel
-from langchain_groq import ChatGroq
+from langchain_core.messages import (
+    AIMessageChunk,
+    BaseMessage,
+    ToolCall,
+    message_chunk_to_message,
+    message_to_dict,
+    messages_from_dict,
+)
+from langchain_core.runnables import Runnable
+from langchain_core.tools import BaseTool
+from langchain_core.utils.function_calling import convert_to_openai_tool
+from pydantic import BaseModel
 
-load_dotenv()
+from debug.cassette import active_cassette, recorded, stable_hash
+from shared.Metrics import metrics
+from shared.RateLimiter import RateLimiter, parse_duration
+from shared.tokens import messages_tokens
 
 OLLAMA_MODEL = "llama3-groq-tool-use:8b"
-# GROQ_MODEL = "meta-llama/llama-4-scout-17b-16e-instruct"    # cheaper
+GROQ_FAST_MODEL = "meta-llama/llama-4-scout-17b-16e-instruct"  # cheaper
 GROQ_MODEL = "meta-llama/llama-4-maverick-17b-128e-instruct"  # better
-GROQ_API_KEY = os.getenv("GROQ_API_KEY")
+# Provider settings, i.e. `GROQ_API_KEY`, `GROQ_BASE_URL` (e.g. a local fake server),
+# and per-model request and token limits, are read along with `.env` once the first client is created.
+# Models have separate limits at the provider, `GROQ_FAST_*` ones apply to the fast model.
+DEFAULT_REQUESTS_PER_MINUTE = 60
+DEFAULT_TOKENS_PER_MINUTE = 60000
+
+# Simple calls, e.g. leaf workers running a command, go to the fast model.
+# Planning, i.e. the root, managers, and large prompts, stay on the strong one.
+ROUTING_ENABLED = os.getenv("CORTEX_ROUTING", "1") != "0"
+STRONG_ROUTE = "strong"
+FAST_ROUTE = "fast"
+STRONG_MAX_DEPTH = 1  # the root
+FAST_MAX_PROMPT_TOKENS = 4000
+
+# One keep-alive connection pool is shared by every agent.
+MAX_CONNECTIONS = 32
+REQUEST_TIMEOUT = 120
+
+# Retries are done here, with the limiter's knowledge, never blindly by the provider SDK.
+MAX_RATE_LIMIT_RETRIES = 8
+MAX_ERROR_RETRIES = 2
+COMPLETION_TOKENS_ESTIMATE = 512
+
+# Streamed calls hand over text and completed tool calls while the rest is still being generated.
+STREAM_RESPONSES = os.getenv("CORTEX_STREAMING", "1") != "0"
+
+T = TypeVar("T", bound=BaseModel)
+TextCallback = Callable[[str], None]
+ToolCallCallback = Callable[[ToolCall], None]
+
+
+class StructuredOutputError(RuntimeError):
+    # the provider kept failing, or the response didn't parse into the schema
+    pass
+
+
+def _is_rate_limit_error(error: Exception) -> bool:
+    return getattr(error, "status_code", None) == 429
+
+
+def _retry_after(error: Exception) -> float | None:
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+    return parse_duration(response.headers.get("retry-after"))
+
+
+def _completed_tool_call(chunk: dict) -> ToolCall | None:
+    try:
+        args = json.loads(chunk["args"] or "{}")
+    except json.JSONDecodeError:
+        return None  # left to the final message, which reports it as invalid
+    if chunk["name"] is None or chunk["id"] is None or not isinstance(args, dict):
+        return None
+    return ToolCall(name=chunk["name"], args=args, id=chunk["id"], type="tool_call")
+
+
+def choose_route(depth: int, workers: int, prompt_tokens: int, escalated: bool) -> str:
+    if not ROUTING_ENABLED or escalated:
+        return STRONG_ROUTE
+    if (
+        depth <= STRONG_MAX_DEPTH
+        or workers > 0
+        or prompt_tokens > FAST_MAX_PROMPT_TOKENS
+    ):
+        return STRONG_ROUTE
+    return FAST_ROUTE
+
+
+def _cassette_key(agent_id: str, messages: list[BaseMessage], tools_hash: str) -> str:
+    # run ids and response metadata differ between runs, only what the model sees counts
+    # note: siblings with identical tasks send identical prompts, thus the caller is part of the key
+    return stable_hash(
+        [
+            agent_id,
+            [
+                {
+                    "type": m.type,
+                    "content": m.content,
+                    "tool_calls": getattr(m, "tool_calls", None),
+                    "tool_call_id": getattr(m, "tool_call_id", None),
+                }
+                for m in messages
+            ],
+            tools_hash,
+        ]
+    )
+
+
+class LLMClient:
+    def __init__(self, llm: BaseChatModel, limiter: RateLimiter):
+        self.llm = llm
+        self.limiter = limiter
+        # tool sets are class-level and long-lived, binding (schema to json) happens once per set
+        self._bound: dict[tuple[int, ...], tuple[list[BaseTool], Runnable, str]] = {}
+        self._structured: dict[type[BaseModel], Runnable] = {}
+        self._bound_lock = Lock()
+
+    def warm_up(self, tools: list[BaseTool]):
+        # binds the tool set ahead of the first call
+        self._bind(tools)
+
+    def _bind(self, tools: list[BaseTool] | None) -> tuple[Runnable, str]:
+        if not tools:
+            return self.llm, ""
+        key = tuple(id(t) for t in tools)
+        bound = self._bound.get(key)
+        if bound is None:
+            with self._bound_lock:
+                schemas = [convert_to_openai_tool(t) for t in tools]
+                # the tools are kept referenced, so their ids cannot be reused
+                bound = (list(tools), self.llm.bind_tools(tools), stable_hash(schemas))
+                self._bound[key] = bound
+        return bound[1], bound[2]
+
+    def invoke(
+        self,
+        messages: list[BaseMessage],
+        tools: list[BaseTool] | None = None,
+        priority: int = 0,
+        agent_id: str = "",
+        on_text: TextCallback | None = None,
+        on_tool_call: ToolCallCallback | None = None,
+    ) -> BaseMessage:
+        # callbacks are only called while streaming, the returned message is always complete
+        runnable, tools_hash = self._bind(tools)
+        if STREAM_RESPONSES and (on_text is not None or on_tool_call is not None):
+            produce = lambda: self._stream(
+                runnable, messages, priority, on_text, on_tool_call
+            )
+        else:
+            produce = lambda: self._invoke(runnable, messages, priority)
+        if active_cassette() is None:
+            return produce()
+        return recorded(
+            "llm",
+            _cassette_key(agent_id, messages, tools_hash),
+            produce,
+            encode=message_to_dict,
+            decode=lambda entry: messages_from_dict([entry])[0],
+        )
+
+    def invoke_structured(
+        self,
+        messages: list[BaseMessage],
+        schema: type[T],
+        priority: int = 0,
+        agent_id: str = "",
+    ) -> T:
+        runnable = self._structured.get(schema)
+        if runnable is None:
+            with self._bound_lock:
+                runnable = self.llm.with_structured_output(schema)
+                self._structured[schema] = runnable
+
+        def produce() -> dict:
+            # failures are recorded as well, replays fail at the very same calls
+            try:
+                value = self._call_with_retries(
+                    lambda: runnable.invoke(messages), messages, priority
+                )
+            except Exception as e:
+                return {"error": f"{type(e).__name__}: {e}"}
+            if value is None:
+                return {"error": f"No {schema.__name__} in the response."}
+            return {"value": value.model_dump()}
+
+        key = _cassette_key(agent_id, messages, schema.__name__)
+        outcome = (
+            produce() if active_cassette() is None else recorded("llm", key, produce)
+        )
+        if "error" in outcome:
+            raise StructuredOutputError(outcome["error"])
+        return schema.model_validate(outcome["value"])
+
+    def _call_with_retries(
+        self,
+        call: Callable[[], BaseMessage],
+        messages: list[BaseMessage],
+        priority: int,
+        can_retry: Callable[[], bool] = lambda: True,
+    ) -> BaseMessage:
+        estimated = messages_tokens(messages) + COMPLETION_TOKENS_ESTIMATE
+        rate_limited = 0
+        errors = 0
+        while True:
+            wait_start = time.perf_counter()
+            self.limiter.acquire(estimated, priority)
+            call_start = time.perf_counter()
+            metrics.observe("llm_limiter_wait_seconds", call_start - wait_start)
+            try:
+                result = call()
+            except Exception as e:
+                if not can_retry():
+                    raise
+                if _is_rate_limit_error(e) and rate_limited < MAX_RATE_LIMIT_RETRIES:
+                    rate_limited += 1
+                    metrics.increment("llm_retries_total", reason="rate_limit")
+                    self.limiter.settle(estimated, 0)  # rejected calls cost no tokens
+                    self.limiter.on_rate_limited(_retry_after(e))
+                    continue
+                if not _is_rate_limit_error(e) and errors < MAX_ERROR_RETRIES:
+                    errors += 1
+                    metrics.increment("llm_retries_total", reason="error")
+                    time.sleep(2**errors + random.random())
+                    continue
+                raise
+
+            metrics.observe("llm_latency_seconds", time.perf_counter() - call_start)
+            self.limiter.on_success()
+            usage = getattr(result, "usage_metadata", None)
+            if usage is not None:
+                self.limiter.settle(estimated, usage["total_tokens"])
+                metrics.observe("prompt_tokens", usage.get("input_tokens", 0))
+                metrics.observe("completion_tokens", usage.get("output_tokens", 0))
+            else:
+                metrics.observe("prompt_tokens", estimated - COMPLETION_TOKENS_ESTIMATE)
+            return result
+
+    def _invoke(
+        self,
+        runnable: Runnable,
+        messages: list[BaseMessage],
+        priority: int,
+    ) -> BaseMessage:
+        return self._call_with_retries(
+            lambda: runnable.invoke(messages), messages, priority
+        )
+
+    def _stream(
+        self,
+        runnable: Runnable,
+        messages: list[BaseMessage],
+        priority: int,
+        on_text: TextCallback | None,
+        on_tool_call: ToolCallCallback | None,
+    ) -> BaseMessage:
+        handed_over = [0]  # tool calls already given to `on_tool_call`
+
+        def stream() -> BaseMessage:
+            message = None
+            for chunk in runnable.stream(messages):
+                message = chunk if message is None else message + chunk
+                if (
+                    on_text is not None
+                    and isinstance(chunk.content, str)
+                    and chunk.content != ""
+                ):
+                    on_text(chunk.content)
+                if on_tool_call is None or not isinstance(message, AIMessageChunk):
+                    continue
+                # a tool call is complete once the next one starts
+                while handed_over[0] < len(message.tool_call_chunks) - 1:
+                    self._hand_over(
+                        message.tool_call_chunks[handed_over[0]], on_tool_call
+                    )
+                    handed_over[0] += 1
+            if isinstance(message, AIMessageChunk):
+                if on_tool_call is not None:
+                    while handed_over[0] < len(message.tool_call_chunks):
+                        self._hand_over(
+                            message.tool_call_chunks[handed_over[0]], on_tool_call
+                        )
+                        handed_over[0] += 1
+                message = message_chunk_to_message(message)
+            return message
+
+        # once a tool call has started, a retry could run it twice
+        return self._call_with_retries(
+            stream, messages, priority, can_retry=lambda: handed_over[0] == 0
+        )
+
+    @staticmethod
+    def _hand_over(chunk: dict, on_tool_call: ToolCallCallback):
+        tool_call = _completed_tool_call(chunk)
+        if tool_call is not None:
+            on_tool_call(tool_call)
+
+
+class ModelRouter:
+    # Each route has its own client and its own rate limits.
+    def __init__(self, routes: dict[str, LLMClient]):
+        self.routes = routes
+
+    def route(
+        self, depth: int, workers: int, prompt_tokens: int, escalated: bool = False
+    ) -> LLMClient:
+        return self.routes[choose_route(depth, workers, prompt_tokens, escalated)]
+
+    def strong(self) -> LLMClient:
+        return self.routes[STRONG_ROUTE]
+
+
+_env_loaded = False
+
+
+def load_env():
+    # deferred until a provider client is needed, importing this module reads nothing
+    global _env_loaded
+    if _env_loaded:
+        return
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    _env_loaded = True
+
+
+def _create_groq_client(model: str, limits_prefix: str) -> LLMClient:
+    # runtime import - the provider SDK alone takes a good part of a second to import
+    from langchain_groq import ChatGroq
+
+    limiter = RateLimiter(
+        int(
+            os.getenv(
+                f"{limits_prefix}_REQUESTS_PER_MINUTE", DEFAULT_REQUESTS_PER_MINUTE
+            )
+        ),
+        int(os.getenv(f"{limits_prefix}_TOKENS_PER_MINUTE", DEFAULT_TOKENS_PER_MINUTE)),
+    )
+    http_client = httpx.Client(
+        limits=httpx.Limits(
+            max_connections=MAX_CONNECTIONS,
+            max_keepalive_connections=MAX_CONNECTIONS,
+        ),
+        timeout=REQUEST_TIMEOUT,
+        # every response, 429s included, updates the route's limits
+        event_hooks={"response": [lambda r: limiter.observe_headers(r.headers)]},
+    )
+    base_url = os.getenv("GROQ_BASE_URL")
+    extra = {"base_url": base_url} if base_url else {}
+    cassette = active_cassette()
+    # replays never reach the provider, there's no need for a real key
+    api_key = (
+        "replay"
+        if cassette and cassette.mode == "replay"
+        else os.getenv("GROQ_API_KEY")
+    )
+    # llm = ChatOllama(model=OLLAMA_MODEL)
+    llm = ChatGroq(
+        model=model,
+        api_key=api_key,
+        max_retries=0,
+        http_client=http_client,
+        **extra,
+    )
+    return LLMClient(llm, limiter)
 
 
 class CoreLLM:
-    _llm = None
-
-    def __new__(cls, *args, **kwargs) -> BaseChatModel:
-        if cls._llm:
-            return cls._llm
-        # cls._llm = ChatOllama(model=OLLAMA_MODEL)
-        cls._llm = ChatGroq(model=GROQ_MODEL, api_key=GROQ_API_KEY)
-        return cls._llm
+    _router = None
+    # warm-up may be creating the router while the first agents get created
+    _lock = Lock()
+
+    def __new__(cls, *args, **kwargs) -> ModelRouter:
+        if cls._router:
+            return cls._router
+        with cls._lock:
+            if cls._router:
+                return cls._router
+            load_env()
+            cls._router = ModelRouter(
+                {
+                    STRONG_ROUTE: _create_groq_client(GROQ_MODEL, "GROQ"),
+                    FAST_ROUTE: _create_groq_client(GROQ_FAST_MODEL, "GROQ_FAST"),
+                }
+            )
+        return cls._router
+
+    @classmethod
+    def use(
+        cls,
+        llm: BaseChatModel,
+        limiter: RateLimiter | None = None,
+        fast_llm: BaseChatModel | None = None,
+    ):
+        # replaces the provider models, e.g. with scripted fakes - affects agents created afterwards
+        strong = LLMClient(llm, limiter or RateLimiter(10**9, 10**12))
+        fast = (
+            strong
+            if fast_llm is None
+            else LLMClient(fast_llm, RateLimiter(10**9, 10**12))
+        )
+        cls._router = ModelRouter({STRONG_ROUTE: strong, FAST_ROUTE: fast})
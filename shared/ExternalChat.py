@@ -1,11 +1,235 @@
-from langchain_core.messages import BaseMessage
+import itertools
+from threading import Lock
+from typing import Callable
+
+from langchain_core.messages import AIMessage, BaseMessage, HumanMessage, ToolMessage
+
+from shared.tokens import MESSAGE_OVERHEAD, estimate_tokens
+
+# Chats are compacted into a rolling summary once they outgrow their budget.
+# Compaction folds down to a fraction of the budget, so it doesn't re-trigger every turn.
+COMPACTION_LOW_WATERMARK = 0.6
+MIN_VERBATIM_MESSAGES = 4
+
+# Both sides of a chat share a single append-only log of compact records.
+# Roles are relative to the viewing side: its own messages are "AI", the peer's are "Human".
+# Records only become langchain messages while a prompt is being built.
+# Tool results are visible to the side which ran the tools only.
+
+_log_serials = itertools.count()
+
+
+class ChatRecord:
+    __slots__ = (
+        "author",
+        "content",
+        "tool_calls",
+        "tool_call_id",
+        "name",
+        "tokens",
+        "call_tokens",
+    )
+
+    def __init__(
+        self,
+        author: str,
+        content: str | list,
+        tool_calls: list[dict] | None = None,
+        tool_call_id: str | None = None,
+        name: str | None = None,
+    ):
+        self.author = author
+        self.content = content
+        self.tool_calls = tool_calls or None
+        self.tool_call_id = tool_call_id  # set for tool results only
+        self.name = name
+        self.tokens = MESSAGE_OVERHEAD + estimate_tokens(str(content))
+        # tool calls are only shown to their author
+        self.call_tokens = sum(
+            estimate_tokens(c["name"] + str(c["args"])) for c in tool_calls or ()
+        )
+
+    def is_tool_result(self) -> bool:
+        return self.tool_call_id is not None
+
+    def visible_to(self, viewer_id: str) -> bool:
+        return self.tool_call_id is None or self.author == viewer_id
+
+    def tokens_for(self, viewer_id: str) -> int:
+        return self.tokens + (self.call_tokens if self.author == viewer_id else 0)
+
+    def to_message(self, viewer_id: str) -> BaseMessage:
+        if self.tool_call_id is not None:
+            return ToolMessage(
+                self.content, tool_call_id=self.tool_call_id, name=self.name
+            )
+        if self.author == viewer_id:
+            return AIMessage(self.content, tool_calls=list(self.tool_calls or ()))
+        return HumanMessage(self.content)
+
+
+class ChatLog:
+    def __init__(self, members: tuple[str, str]):
+        self.members = members
+        self.serial = next(_log_serials)  # tells logs of re-opened chats apart
+        # absolute index of `records[0]`, the head folded by both sides gets trimmed
+        self.base = 0
+        self.records: list[ChatRecord] = []
+        # first unfolded record, per side
+        self.starts: dict[str, int] = {m: 0 for m in members}
+        self.lock = Lock()
+
+    @classmethod
+    def restored(
+        cls,
+        members: tuple[str, str],
+        base: int,
+        records: list[ChatRecord],
+        starts: dict[str, int],
+    ) -> "ChatLog":
+        log = cls(members)
+        log.base = base
+        log.records = records
+        log.starts = starts
+        log._trim()
+        return log
+
+    def end(self) -> int:
+        return self.base + len(self.records)
+
+    def append(self, record: ChatRecord):
+        with self.lock:
+            self.records.append(record)
+
+    def fold(self, viewer_id: str, until: int):
+        with self.lock:
+            self.starts[viewer_id] = until
+            self._trim()
+
+    def release(self, viewer_id: str):
+        with self.lock:
+            self.starts.pop(viewer_id, None)
+            self._trim()
+
+    def _trim(self):
+        cut = min(self.starts.values(), default=self.end())
+        del self.records[: cut - self.base]
+        self.base = max(self.base, cut)
 
 
 class ExternalChat:
-    def __init__(self, target_id: str, target_label: str):
+    # One side's view of a shared `ChatLog`.
+
+    def __init__(self, log: ChatLog, owner_id: str, target_id: str, target_label: str):
+        self.log = log
+        self.owner_id: str = owner_id
         self.target_id: str = target_id
         self.target_label: str = target_label
-        self.chat_history: list[BaseMessage] = []
+        self.summary: str = ""  # folded, older part of the chat
+        self.folded_count: int = 0  # messages folded into the summary so far
+        # log position counted into `_history_tokens`
+        self._scanned: int = log.starts.get(owner_id, 0)
+        self._history_tokens: int = 0
+
+    def _window(self) -> list[tuple[int, ChatRecord]]:
+        # unfolded, visible records with their absolute positions, log lock held
+        log = self.log
+        start = log.starts.get(self.owner_id, log.end())
+        # count whatever got appended since the last look
+        for record in log.records[max(self._scanned, start) - log.base :]:
+            if record.visible_to(self.owner_id):
+                self._history_tokens += record.tokens_for(self.owner_id)
+        self._scanned = log.end()
+        return [
+            (log.base + i, r)
+            for i, r in enumerate(log.records[start - log.base :], start - log.base)
+            if r.visible_to(self.owner_id)
+        ]
+
+    def version(self) -> tuple[int, int]:
+        # changes with every append and every compaction
+        log = self.log
+        return log.end(), log.starts.get(self.owner_id, log.end())
+
+    def records(self) -> list[ChatRecord]:
+        with self.log.lock:
+            return [r for _, r in self._window()]
+
+    @property
+    def chat_history(self) -> list[BaseMessage]:
+        return [r.to_message(self.owner_id) for r in self.records()]
+
+    def append(self, message: BaseMessage):
+        if isinstance(message, ToolMessage):
+            record = ChatRecord(
+                self.owner_id,
+                message.content,
+                tool_call_id=message.tool_call_id,
+                name=message.name,
+            )
+        elif isinstance(message, AIMessage):
+            record = ChatRecord(
+                self.owner_id, message.content, tool_calls=message.tool_calls
+            )
+        else:
+            record = ChatRecord(self.target_id, message.content)
+        self.log.append(record)
+
+    def extend(self, messages: list[BaseMessage]):
+        for message in messages:
+            self.append(message)
+
+    def stop_reading(self):
+        # for sides which never build prompts, e.g. the user, so they don't keep the log from being trimmed
+        self.log.release(self.owner_id)
+
+    def clear(self):
+        self.log.release(self.owner_id)
+        self.summary = ""
+        self.folded_count = 0
+        self._history_tokens = 0
+
+    def tokens(self) -> int:
+        with self.log.lock:
+            self._window()
+            return estimate_tokens(self.summary) + self._history_tokens
+
+    def compact(
+        self,
+        budget: int,
+        summarize: Callable[[str, list[BaseMessage]], str],
+    ):
+        with self.log.lock:
+            window = self._window()
+            history_tokens = self._history_tokens
+        if estimate_tokens(self.summary) + history_tokens <= budget:
+            return
+
+        # only the messages that just fell out of the window get summarised
+        target = int(budget * COMPACTION_LOW_WATERMARK)
+        summary_tokens = estimate_tokens(self.summary)
+        remaining = history_tokens
+        cut = 0
+        while (
+            cut < len(window) - MIN_VERBATIM_MESSAGES
+            and summary_tokens + remaining > target
+        ):
+            remaining -= window[cut][1].tokens_for(self.owner_id)
+            cut += 1
+        # tool results must directly follow their tool call, never open the window with one
+        while cut < len(window) and window[cut][1].is_tool_result():
+            cut += 1
+        if cut == 0:
+            return
+
+        # the log only grows at the tail, the folded head stays stable while summarising
+        folded = [r for _, r in window[:cut]]
+        self.summary = summarize(
+            self.summary, [r.to_message(self.owner_id) for r in folded]
+        )
+        self.log.fold(self.owner_id, window[cut - 1][0] + 1)
+        self._history_tokens -= sum(r.tokens_for(self.owner_id) for r in folded)
+        self.folded_count += cut
 
 
 def create_chat_pair(
@@ -15,6 +239,7 @@ def create_chat_pair(
     target_label: str,
 ) -> tuple[ExternalChat, ExternalChat]:
     # todo: trivial - move to pool
-    chat_s = ExternalChat(target_id, target_label)
-    chat_t = ExternalChat(starter_id, starter_label)
+    log = ChatLog((starter_id, target_id))
+    chat_s = ExternalChat(log, starter_id, target_id, target_label)
+    chat_t = ExternalChat(log, target_id, starter_id, starter_label)
     return chat_s, chat_t
@@ -0,0 +1,340 @@
+from contextlib import contextmanager
+from threading import Lock, Thread, local
+from typing import Iterator
+
+# Latency and token instrumentation, aggregated per agent and depth, and per round.
+# Observations are attributed to the agent whose turn, or tool call, is running on the current thread,
+# see `Metrics.scope`, so callers deep down, e.g. the shell or the LLM client, need no agent ids.
+# Exposed as Prometheus text, see `serve_metrics`, and as an end-of-run summary table.
+
+METRICS_PREFIX = "cortex_"
+ROUND_WINDOW = 100  # rounds kept per-round, older ones are dropped
+RELEASED = "released"  # stands in for terminated agents
+SUMMARY_ROUNDS = 10  # latest rounds shown in the summary
+QUANTILES = (0.5, 0.9, 0.99)
+
+# HDR-style log-linear buckets: exact below 2 * SUB_BUCKETS, then SUB_BUCKETS per power of two,
+# which bounds the relative error to 1 / SUB_BUCKETS at any magnitude, with a handful of buckets.
+SUB_BUCKET_BITS = 4
+SUB_BUCKETS = 1 << SUB_BUCKET_BITS
+SECONDS_RESOLUTION = 1_000_000  # `*_seconds` metrics are bucketed in microseconds
+
+Labels = tuple[tuple[str, str], ...]
+
+
+def _bucket_index(n: int) -> int:
+    if n < 2 * SUB_BUCKETS:
+        return n
+    shift = n.bit_length() - SUB_BUCKET_BITS - 1
+    return SUB_BUCKETS * (shift + 1) + (n >> shift) - SUB_BUCKETS
+
+
+def _bucket_value(index: int) -> float:
+    # midpoint of the bucket
+    if index < 2 * SUB_BUCKETS:
+        return index
+    shift = index // SUB_BUCKETS - 1
+    low = (index % SUB_BUCKETS + SUB_BUCKETS) << shift
+    return low + ((1 << shift) - 1) / 2
+
+
+class Histogram:
+    __slots__ = ("scale", "buckets", "count", "total", "min", "max")
+
+    def __init__(self, scale: int = 1):
+        self.scale = scale
+        self.buckets: dict[int, int] = {}
+        self.count = 0
+        self.total = 0.0
+        self.min = float("inf")
+        self.max = 0.0
+
+    def record(self, value: float):
+        index = _bucket_index(max(int(value * self.scale), 0))
+        self.buckets[index] = self.buckets.get(index, 0) + 1
+        self.count += 1
+        self.total += value
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+
+    def merge(self, other: "Histogram"):
+        for index, count in other.buckets.items():
+            self.buckets[index] = self.buckets.get(index, 0) + count
+        self.count += other.count
+        self.total += other.total
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    def percentile(self, q: float) -> float:
+        if self.count == 0:
+            return 0.0
+        rank = q * (self.count - 1)
+        seen = 0
+        for index in sorted(self.buckets.keys()):
+            seen += self.buckets[index]
+            if seen > rank:
+                value = _bucket_value(index) / self.scale
+                return min(max(value, self.min), self.max)
+        return self.max
+
+    def mean(self) -> float:
+        return self.total / self.count if self.count > 0 else 0.0
+
+
+class Metrics:
+    def __init__(self):
+        self.round = 0
+        # one series per agent, labelled with its depth too, so sums over either label add up
+        self._histograms: dict[tuple[str, Labels], Histogram] = {}
+        self._counters: dict[tuple[str, Labels], int] = {}
+        # per-round totals, for the summary only, kept out of Prometheus
+        self._round_histograms: dict[tuple[str, Labels], Histogram] = {}
+        self._round_counters: dict[tuple[str, Labels], int] = {}
+        self._lock = Lock()
+        self._scope = local()
+
+    @contextmanager
+    def scope(self, agent_id: str, depth: int) -> Iterator[None]:
+        # attributes everything observed on this thread to the agent
+        previous = getattr(self._scope, "value", None)
+        self._scope.value = (agent_id, depth)
+        try:
+            yield
+        finally:
+            self._scope.value = previous
+
+    def _keys(self, name: str, labels: dict[str, str]):
+        # e.g. health checks, or warming up shells, ahead of any agent
+        agent_id, depth = getattr(self._scope, "value", None) or ("none", "none")
+        extra = tuple(sorted(labels.items()))
+        return (
+            (name, (("agent", agent_id), ("depth", str(depth)), *extra)),
+            (name, (("round", str(self.round)), *extra)),
+        )
+
+    def observe(self, name: str, value: float, **labels: str):
+        scale = SECONDS_RESOLUTION if name.endswith("_seconds") else 1
+        key, round_key = self._keys(name, labels)
+        with self._lock:
+            for table, k in (
+                (self._histograms, key),
+                (self._round_histograms, round_key),
+            ):
+                histogram = table.get(k)
+                if histogram is None:
+                    histogram = table[k] = Histogram(scale)
+                histogram.record(value)
+
+    def increment(self, name: str, amount: int = 1, **labels: str):
+        key, round_key = self._keys(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+            self._round_counters[round_key] = (
+                self._round_counters.get(round_key, 0) + amount
+            )
+
+    def start_round(self, round_number: int):
+        # called by the scheduler, rounds past the window are dropped
+        with self._lock:
+            self.round = round_number
+            oldest = round_number - ROUND_WINDOW
+            for table in (self._round_histograms, self._round_counters):
+                stale = [k for k in table if int(k[1][0][1]) <= oldest]
+                for key in stale:
+                    del table[key]
+
+    def release(self, agent_id: str):
+        # folds a terminated agent into its depth's "released" series, bounding the label count
+        with self._lock:
+            for (name, labels), histogram in list(self._histograms.items()):
+                if labels[0] == ("agent", agent_id):
+                    del self._histograms[(name, labels)]
+                    key = (name, (("agent", RELEASED), *labels[1:]))
+                    if key not in self._histograms:
+                        self._histograms[key] = Histogram(histogram.scale)
+                    self._histograms[key].merge(histogram)
+            for (name, labels), count in list(self._counters.items()):
+                if labels[0] == ("agent", agent_id):
+                    del self._counters[(name, labels)]
+                    key = (name, (("agent", RELEASED), *labels[1:]))
+                    self._counters[key] = self._counters.get(key, 0) + count
+
+    def _tables(self, dimension: str):
+        if dimension == "round":
+            return self._round_histograms, self._round_counters
+        return self._histograms, self._counters
+
+    def histogram(
+        self, name: str, dimension: str, value: str | None = None, **labels: str
+    ) -> Histogram:
+        # merged over every matching key, e.g. all tools of a depth
+        merged = Histogram(SECONDS_RESOLUTION if name.endswith("_seconds") else 1)
+        with self._lock:
+            histograms, _ = self._tables(dimension)
+            for (n, key_labels), histogram in histograms.items():
+                if n == name and _matches(key_labels, dimension, value, labels):
+                    merged.merge(histogram)
+        return merged
+
+    def counter(
+        self, name: str, dimension: str, value: str | None = None, **labels: str
+    ) -> int:
+        with self._lock:
+            _, counters = self._tables(dimension)
+            return sum(
+                count
+                for (n, key_labels), count in counters.items()
+                if n == name and _matches(key_labels, dimension, value, labels)
+            )
+
+    def dimension_values(self, dimension: str) -> list[str]:
+        with self._lock:
+            histograms, counters = self._tables(dimension)
+            keys = [*histograms.keys(), *counters.keys()]
+        values = {dict(k[1]).get(dimension) for k in keys}
+        return sorted(values - {None, RELEASED}, key=_natural)
+
+    def prometheus_text(self) -> str:
+        with self._lock:
+            histograms = list(self._histograms.items())
+            counters = list(self._counters.items())
+        lines = []
+        typed = set()
+        for (name, labels), histogram in sorted(histograms, key=lambda i: i[0]):
+            metric = METRICS_PREFIX + name
+            if metric not in typed:
+                typed.add(metric)
+                lines.append(f"# TYPE {metric} summary")
+            for q in QUANTILES:
+                lines.append(
+                    f"{metric}{_labels(labels, ('quantile', str(q)))} {histogram.percentile(q):g}"
+                )
+            lines.append(f"{metric}_sum{_labels(labels)} {histogram.total:g}")
+            lines.append(f"{metric}_count{_labels(labels)} {histogram.count}")
+        for (name, labels), count in sorted(counters, key=lambda i: i[0]):
+            metric = METRICS_PREFIX + name
+            if metric not in typed:
+                typed.add(metric)
+                lines.append(f"# TYPE {metric} counter")
+            lines.append(f"{metric}{_labels(labels)} {count}")
+        return "\n".join(lines) + "\n"
+
+    def _summary_row(self, dimension: str, value: str) -> list:
+        llm = self.histogram("llm_latency_seconds", dimension, value)
+        build = self.histogram("prompt_build_seconds", dimension, value)
+        return [
+            value,
+            build.count,
+            f"{self.histogram('queue_wait_seconds', dimension, value).percentile(0.5) * 1000:.1f}",
+            f"{build.percentile(0.5) * 1000:.2f}",
+            f"{llm.percentile(0.5) * 1000:.0f}",
+            f"{llm.percentile(0.99) * 1000:.0f}",
+            f"{self.histogram('prompt_tokens', dimension, value).mean():.0f}",
+            f"{self.histogram('completion_tokens', dimension, value).mean():.0f}",
+            f"{self.histogram('prompt_shared_tokens', dimension, value).mean():.0f}",
+            f"{self.histogram('prompt_cached_tokens', dimension, value).mean():.0f}",
+            self.counter("llm_retries_total", dimension, value),
+            self.histogram("tool_seconds", dimension, value).count,
+            self.counter("tool_errors_total", dimension, value),
+            f"{self.histogram('shell_exec_seconds', dimension, value).percentile(0.5) * 1000:.1f}",
+            self.counter("shell_timeouts_total", dimension, value),
+        ]
+
+    def summary(self) -> str:
+        # one row per depth, then per each of the last rounds, plus the agents the most LLM time went to
+        columns = [
+            ("turns", 6),
+            ("queue_p50", 9),
+            ("build_p50", 9),
+            ("llm_p50", 8),
+            ("llm_p99", 8),
+            ("prompt_tok", 10),
+            ("compl_tok", 9),
+            ("shared_tok", 10),
+            ("cached_tok", 10),
+            ("retries", 7),
+            ("tools", 6),
+            ("tool_err", 8),
+            ("shell_p50", 9),
+            ("timeouts", 8),
+        ]
+        lines = ["METRICS SUMMARY (latencies in ms, tokens per call on average):"]
+        rounds = self.dimension_values("round")[-SUMMARY_ROUNDS:]
+        for dimension, values in (
+            ("depth", self.dimension_values("depth")),
+            ("round", rounds),
+        ):
+            table = [(dimension, 5), *columns]
+            lines.append(" ".join(f"{name:>{width}}" for name, width in table))
+            for value in values:
+                row = self._summary_row(dimension, value)
+                lines.append(
+                    " ".join(f"{v:>{width}}" for v, (_, width) in zip(row, table))
+                )
+
+        per_agent: dict[str, Histogram] = {}
+        with self._lock:
+            for (name, labels), histogram in self._histograms.items():
+                if name == "llm_latency_seconds" and labels[0] != ("agent", RELEASED):
+                    per_agent.setdefault(
+                        labels[0][1], Histogram(SECONDS_RESOLUTION)
+                    ).merge(histogram)
+        busiest = sorted(per_agent.items(), key=lambda i: -i[1].total)[:5]
+        if len(busiest) > 0:
+            lines.append(
+                "Most LLM time: "
+                + ", ".join(f"{a} {h.total:.1f}s/{h.count} calls" for a, h in busiest)
+            )
+        return "\n".join(lines)
+
+
+def _matches(
+    key_labels: Labels, dimension: str, value: str | None, labels: dict[str, str]
+) -> bool:
+    key_labels = dict(key_labels)
+    if dimension not in key_labels:
+        return False
+    if value is not None and key_labels[dimension] != value:
+        return False
+    return all(key_labels.get(k) == v for k, v in labels.items())
+
+
+def _natural(value: str):
+    return (0, int(value), "") if value.isdigit() else (1, 0, value)
+
+
+def _labels(labels: Labels, *extra: tuple[str, str]) -> str:
+    pairs = [*labels, *extra]
+    escaped = (
+        v.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        for _, v in pairs
+    )
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + "}"
+
+
+metrics = Metrics()
+
+
+def serve_metrics(port: int):
+    # local only, scraped from `http://127.0.0.1:<port>/metrics`
+    # runtime import - only runs with the endpoint enabled, startup doesn't pay for it
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = metrics.prometheus_text().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    server = ThreadingHTTPServer(("127.0.0.1", port), MetricsHandler)
+    Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+    return server
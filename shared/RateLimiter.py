@@ -0,0 +1,135 @@
+import heapq
+import itertools
+import re
+import time
+from threading import Condition
+
+# Token buckets for requests/min and tokens/min, shared by every agent using one provider.
+# Waiting callers are served strictly by priority (lower first, i.e. closer to the root),
+# so a wide subtree waking up at once cannot starve its own managers.
+# The provider's rate-limit headers are the source of truth, local buckets are only an estimate.
+
+MAX_BACKOFF_SECONDS = 60.0
+MIN_BACKOFF_SECONDS = 1.0
+
+_DURATION_PART = re.compile(r"(\d+(?:\.\d+)?)(ms|h|m|s)")
+_DURATION_UNITS = {"ms": 0.001, "s": 1.0, "m": 60.0, "h": 3600.0}
+
+
+def parse_duration(value: str | None) -> float | None:
+    # accepts both plain seconds ("12") and Go-style durations ("1m2.5s", "120ms")
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    parts = _DURATION_PART.findall(value)
+    if len(parts) == 0:
+        return None
+    return sum(float(amount) * _DURATION_UNITS[unit] for amount, unit in parts)
+
+
+def _parse_int(value: str | None) -> int | None:
+    try:
+        return int(value) if value is not None else None
+    except ValueError:
+        return None
+
+
+class RateLimiter:
+    def __init__(self, requests_per_minute: int, tokens_per_minute: int):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self._requests = float(requests_per_minute)
+        self._tokens = float(tokens_per_minute)
+        self._updated = time.monotonic()
+        self._blocked_until = 0.0  # set by 429s and exhausted limits
+        self._backoff = 0.0
+        self._waiting: list[tuple[int, int]] = []  # heap of (priority, ticket)
+        self._tickets = itertools.count()
+        self._cond = Condition()
+
+    def _refill(self, now: float):
+        elapsed = now - self._updated
+        self._updated = now
+        self._requests = min(
+            self.requests_per_minute,
+            self._requests + elapsed * self.requests_per_minute / 60,
+        )
+        self._tokens = min(
+            self.tokens_per_minute,
+            self._tokens + elapsed * self.tokens_per_minute / 60,
+        )
+
+    def _wait_time(self, now: float, tokens: float) -> float:
+        wait = max(self._blocked_until - now, 0)
+        if self._requests < 1:
+            wait = max(wait, (1 - self._requests) * 60 / self.requests_per_minute)
+        if self._tokens < tokens:
+            wait = max(wait, (tokens - self._tokens) * 60 / self.tokens_per_minute)
+        return wait
+
+    def acquire(self, tokens: int, priority: int = 0):
+        # a single oversized request would otherwise wait forever
+        tokens = min(tokens, self.tokens_per_minute)
+        with self._cond:
+            ticket = (priority, next(self._tickets))
+            heapq.heappush(self._waiting, ticket)
+            while True:
+                now = time.monotonic()
+                self._refill(now)
+                wait = self._wait_time(now, tokens)
+                if self._waiting[0] == ticket and wait <= 0:
+                    heapq.heappop(self._waiting)
+                    self._requests -= 1
+                    self._tokens -= tokens
+                    self._cond.notify_all()
+                    return
+                # woken up early whenever the queue head or the limits change
+                self._cond.wait(timeout=wait if wait > 0 else None)
+
+    def settle(self, estimated_tokens: int, actual_tokens: int):
+        # corrects the token bucket once the real usage is known
+        with self._cond:
+            self._tokens += (
+                min(estimated_tokens, self.tokens_per_minute) - actual_tokens
+            )
+            self._cond.notify_all()
+
+    def observe_headers(self, headers):
+        remaining_requests = _parse_int(headers.get("x-ratelimit-remaining-requests"))
+        remaining_tokens = _parse_int(headers.get("x-ratelimit-remaining-tokens"))
+        reset_requests = parse_duration(headers.get("x-ratelimit-reset-requests"))
+        reset_tokens = parse_duration(headers.get("x-ratelimit-reset-tokens"))
+        retry_after = parse_duration(headers.get("retry-after"))
+
+        with self._cond:
+            now = time.monotonic()
+            self._refill(now)
+            if remaining_requests is not None:
+                self._requests = min(self._requests, remaining_requests)
+                if remaining_requests == 0 and reset_requests is not None:
+                    self._blocked_until = max(self._blocked_until, now + reset_requests)
+            if remaining_tokens is not None:
+                self._tokens = min(self._tokens, remaining_tokens)
+                if remaining_tokens == 0 and reset_tokens is not None:
+                    self._blocked_until = max(self._blocked_until, now + reset_tokens)
+            if retry_after is not None:
+                self._blocked_until = max(self._blocked_until, now + retry_after)
+            self._cond.notify_all()
+
+    def on_rate_limited(self, retry_after: float | None = None):
+        # exponential backoff, unless the provider tells us exactly how long to wait
+        with self._cond:
+            self._backoff = min(
+                max(self._backoff * 2, MIN_BACKOFF_SECONDS),
+                MAX_BACKOFF_SECONDS,
+            )
+            wait = retry_after if retry_after is not None else self._backoff
+            self._blocked_until = max(self._blocked_until, time.monotonic() + wait)
+            self._cond.notify_all()
+
+    def on_success(self):
+        with self._cond:
+            self._backoff /= 2
@@ -0,0 +1,104 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any
+
+from shared.AgentPool import AgentPool
+from shared.Metrics import metrics
+
+# Rounds are event-driven: each agent's turn is awaited only by its parent,
+# so independent subtrees progress concurrently, while every child still
+# acts before its parent within the same round.
+# LLM calls are synchronous, thus turns with pending work run on a thread pool.
+# Subtrees without work are skipped entirely, see `Agent.subtree_has_work`.
+MAX_CONCURRENT_TURNS = 16
+
+# Agents may fall into prolonged sleep.
+# This is good, but may lead to stagnation.
+# Nudge allows agents to occasionally wake up and check their surroundings.
+ROUNDS_TO_NUDGE = 7
+NUDGE_PROMPT = "Hey, just checking in on the progress."
+
+
+class TreeScheduler:
+    def __init__(self, root: Any, max_concurrency: int = MAX_CONCURRENT_TURNS):
+        self.root = root
+        self.max_concurrency = max_concurrency
+        self.round = 0
+        self.round_turns = 0  # turns run in the last round
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_concurrency,
+            thread_name_prefix="agent-turn",
+        )
+        self._semaphore: asyncio.Semaphore | None = None
+        # timer wheel: due round -> (agent id, nudge token at scheduling time)
+        self.nudges: dict[int, list[tuple[str, int]]] = {}
+        self.paused: set[str] = set()  # roots of subtrees held back by the operator
+
+    def pause(self, agent_id: str):
+        self.paused.add(agent_id)
+
+    def resume(self, agent_id: str):
+        self.paused.discard(agent_id)
+        # ancestors cleared their marks while the subtree was held back
+        agent = AgentPool().get(agent_id)
+        if agent is None or not agent.subtree_has_work:
+            return
+        while agent is not None:
+            agent.subtree_has_work = True
+            agent = AgentPool().get(agent.parent_id)
+
+    def _schedule_nudge(self, agent: Any):
+        due = self.round + ROUNDS_TO_NUDGE
+        self.nudges.setdefault(due, []).append((agent.id, agent.nudge_token))
+
+    def _fire_nudges(self, due: int) -> int:
+        fired = 0
+        for agent_id, token in self.nudges.pop(due, []):
+            agent = AgentPool().get(agent_id)
+            # any work since scheduling invalidates the nudge
+            if agent is None or agent.nudge_token != token:
+                continue
+            AgentPool().message(agent.parent_id, agent.id, NUDGE_PROMPT)
+            fired += 1
+        return fired
+
+    def fire_idle_nudges(self) -> int:
+        # rounds only run while there's work, an idle tree gets its next nudges early instead
+        while len(self.nudges) > 0:
+            fired = self._fire_nudges(min(self.nudges))
+            if fired > 0:
+                return fired
+        return 0
+
+    async def _run_subtree(self, agent: Any):
+        # paused subtrees keep their marks, and pick up where they left off once resumed
+        if not agent.subtree_has_work or agent.id in self.paused:
+            return
+        # cleared before the children run - work arriving mid-round marks it again
+        agent.subtree_has_work = False
+
+        # note: snapshot - workers hired during this round act in the next one
+        children = list(getattr(agent, "children", {}).values())
+        await asyncio.gather(*(self._run_subtree(child) for child in children))
+
+        if not agent.has_pending_responses():
+            return
+        async with self._semaphore:
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(self._executor, agent.run_turn)
+        self.round_turns += 1
+        self._schedule_nudge(agent)
+
+    async def run_round_async(self):
+        self.round += 1
+        metrics.start_round(self.round)
+        self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        self.round_turns = 0
+        self._fire_nudges(self.round)
+        await self._run_subtree(self.root)
+
+    def run_round(self):
+        asyncio.run(self.run_round_async())
+
+    def shutdown(self):
+        self._executor.shutdown(wait=True)
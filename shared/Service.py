@@ -0,0 +1,50 @@
+import time
+from threading import Event, Lock, Thread
+from typing import Callable, Generic, TypeVar
+
+# Slow initialisation, e.g. client warm-up or health checks, wrapped to run in the background.
+# Nothing gets started on import - only by an explicit `start()`, or by the first `result()`.
+
+T = TypeVar("T")
+
+
+class Service(Generic[T]):
+    def __init__(self, name: str, start: Callable[[], T]):
+        self.name = name
+        self._start = start
+        self._thread: Thread | None = None
+        self._done = Event()
+        self._lock = Lock()
+        self._value: T | None = None
+        self._error: BaseException | None = None
+        self.started_at: float | None = None  # perf_counter
+        self.duration: float | None = None  # seconds, once done
+
+    def start(self) -> "Service[T]":
+        with self._lock:
+            if self._thread is None:
+                self.started_at = time.perf_counter()
+                self._thread = Thread(
+                    target=self._run, name=f"service-{self.name}", daemon=True
+                )
+                self._thread.start()
+        return self
+
+    def _run(self):
+        try:
+            self._value = self._start()
+        except BaseException as e:
+            self._error = e  # re-raised to whoever waits for the result
+        finally:
+            self.duration = time.perf_counter() - self.started_at
+            self._done.set()
+
+    def is_done(self) -> bool:
+        return self._done.is_set()
+
+    def result(self) -> T:
+        self.start()
+        self._done.wait()
+        if self._error is not None:
+            raise self._error
+        return self._value
@@ -0,0 +1,53 @@
+import os
+from collections import OrderedDict
+from threading import Lock
+
+# Results of successfully finished tasks, shared by the whole tree.
+# Entries are keyed by the normalised task text and a fingerprint of the workspace the task finished in.
+# A task repeated over an unchanged workspace gets the earlier result, instead of a new worker.
+# Entries of other workspace states are never matched, but kept, the workspace may come back to them,
+# e.g. once a temporary file is removed, they're evicted by recency only.
+
+# 0 disables the cache
+TASK_CACHE_SIZE = int(os.getenv("CORTEX_TASK_CACHE_SIZE", "128"))
+
+
+def normalize_task(task: str) -> str:
+    # case, whitespace and trailing punctuation don't make a task different
+    return " ".join(task.lower().split()).rstrip(".!")
+
+
+class TaskCache:
+    def __init__(self, max_entries: int = TASK_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._entries: OrderedDict[tuple[str, str], str] = OrderedDict()
+        self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, task: str, fingerprint: str) -> str | None:
+        with self._lock:
+            key = (normalize_task(task), fingerprint)
+            result = self._entries.get(key)
+            if result is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return result
+
+    def put(self, task: str, fingerprint: str, result: str):
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            key = (normalize_task(task), fingerprint)
+            self._entries[key] = result
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+task_cache = TaskCache()
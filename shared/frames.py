@@ -0,0 +1,37 @@
+import struct
+from typing import Iterator
+
+# Append-only files of length-prefixed frames, shared by cassettes and checkpoints.
+# A torn frame at the tail, e.g. after a crash mid-write, is dropped when reading,
+# writers cut it off with `complete_length` before appending, or it would swallow new frames.
+
+_FRAME_HEADER = struct.Struct("<I")
+
+
+def pack_frame(payload: bytes) -> bytes:
+    return _FRAME_HEADER.pack(len(payload)) + payload
+
+
+def _frame_spans(data: bytes) -> Iterator[tuple[int, int]]:
+    # start and end of every complete frame's payload
+    offset = 0
+    while offset + _FRAME_HEADER.size <= len(data):
+        (length,) = _FRAME_HEADER.unpack_from(data, offset)
+        start = offset + _FRAME_HEADER.size
+        offset = start + length
+        if offset > len(data):
+            return
+        yield start, offset
+
+
+def iter_frames(data: bytes) -> Iterator[bytes]:
+    for start, end in _frame_spans(data):
+        yield data[start:end]
+
+
+def complete_length(data: bytes) -> int:
+    # bytes up to the end of the last complete frame
+    end = 0
+    for _, end in _frame_spans(data):
+        pass
+    return end
@@ -0,0 +1,31 @@
+from langchain_core.messages import BaseMessage, AIMessage
+
+# Cheap, tokenizer-free estimate. It's rough, code and non-ASCII text run well over
+# 4 chars per token and get underestimated, so budgets should leave some headroom.
+CHARS_PER_TOKEN = 4
+MESSAGE_OVERHEAD = 4  # role and framing tokens
+
+
+def estimate_tokens(text: str) -> int:
+    return len(text) // CHARS_PER_TOKEN + 1
+
+
+def message_tokens(message: BaseMessage) -> int:
+    tokens = MESSAGE_OVERHEAD + estimate_tokens(str(message.content))
+    if isinstance(message, AIMessage):
+        for tool_call in message.tool_calls:
+            tokens += estimate_tokens(tool_call["name"] + str(tool_call["args"]))
+    return tokens
+
+
+def messages_tokens(messages: list[BaseMessage]) -> int:
+    return sum(message_tokens(m) for m in messages)
+
+
+def fit_text(text: str, max_tokens: int) -> str:
+    # cuts on line boundaries, keeping the head
+    max_chars = max(max_tokens, 0) * CHARS_PER_TOKEN
+    if len(text) <= max_chars:
+        return text
+    cut = text.rfind("\n", 0, max_chars)
+    return text[: max(cut, 0)] + "\n... (truncated)"
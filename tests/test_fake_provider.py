@@ -0,0 +1,45 @@
+import time
+from threading import Thread
+
+import pytest
+from langchain_core.messages import HumanMessage
+
+from debug.fake_provider import create_server
+import shared.CoreLLM
+from shared.CoreLLM import GROQ_MODEL, _create_groq_client
+from shared.Metrics import metrics
+
+RETRY_AFTER = 0.3
+
+
+@pytest.fixture
+def client(monkeypatch):
+    # every second request gets a 429
+    server = create_server(0, reject_every=2, retry_after=RETRY_AFTER, latency=0)
+    Thread(target=server.serve_forever, daemon=True).start()
+    monkeypatch.setenv("GROQ_BASE_URL", f"http://127.0.0.1:{server.server_address[1]}")
+    monkeypatch.setenv("GROQ_API_KEY", "fake")
+    monkeypatch.setattr(shared.CoreLLM, "STREAM_RESPONSES", True)
+    yield _create_groq_client(GROQ_MODEL, "GROQ")
+    server.shutdown()
+
+
+def test_streamed_call_backs_off_on_429(client):
+    messages = [HumanMessage("hi")]
+    text = []
+    first = client.invoke(messages, on_text=text.append)
+    assert first.content == "Fake reply #1."
+    assert "".join(text) == first.content
+
+    text.clear()
+    retries = metrics.counter("llm_retries_total", "depth", reason="rate_limit")
+    start = time.perf_counter()
+    second = client.invoke(messages, on_text=text.append)
+    # the 429 is retried after `retry-after`, and only the successful stream gets through
+    assert second.content == "Fake reply #3."
+    assert "".join(text) == second.content
+    assert time.perf_counter() - start >= RETRY_AFTER
+    assert (
+        metrics.counter("llm_retries_total", "depth", reason="rate_limit")
+        == retries + 1
+    )
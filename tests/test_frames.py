@@ -0,0 +1,70 @@
+import contextlib
+import io
+
+from debug.benchmark import build_tree, scripted_policy
+from debug.fake_llm import ScriptedChatModel
+from debug.fake_shell import fake_shell_backend
+from runtimes.runtime import linux_instances, use_shell_backend
+from shared.AgentPool import AgentPool
+from shared.Checkpoint import Checkpoint
+from shared.CoreLLM import CoreLLM
+from shared.frames import complete_length, iter_frames, pack_frame
+from shared.Scheduler import TreeScheduler
+
+# a crash mid-write leaves the length header of a frame, and only part of its payload
+TORN_FRAME = pack_frame(b"x" * 1000)[:50]
+
+
+def test_torn_tail_is_dropped():
+    data = pack_frame(b"a") + pack_frame(b"bb") + TORN_FRAME
+    assert list(iter_frames(data)) == [b"a", b"bb"]
+    assert complete_length(data) == len(data) - len(TORN_FRAME)
+
+
+def test_torn_header_is_dropped():
+    data = pack_frame(b"a") + pack_frame(b"b")[:2]
+    assert list(iter_frames(data)) == [b"a"]
+    assert complete_length(data) == len(pack_frame(b"a"))
+
+
+def test_frames_appended_after_cutting_torn_tail():
+    data = pack_frame(b"a") + TORN_FRAME
+    data = data[: complete_length(data)] + pack_frame(b"c") + pack_frame(b"d")
+    assert list(iter_frames(data)) == [b"a", b"c", b"d"]
+
+
+def _run_rounds(scheduler: TreeScheduler, checkpoint: Checkpoint, rounds: int):
+    with contextlib.redirect_stdout(io.StringIO()):
+        for _ in range(rounds):
+            scheduler.run_round()
+            checkpoint.write(scheduler)
+    checkpoint.close()
+
+
+def _restore(path: str) -> tuple[Checkpoint, TreeScheduler]:
+    AgentPool()._init()
+    linux_instances.clear()
+    checkpoint = Checkpoint(path)
+    return checkpoint, checkpoint.restore()
+
+
+def test_checkpoint_survives_second_crash(tmp_path):
+    CoreLLM.use(ScriptedChatModel(script=scripted_policy(0)))
+    use_shell_backend(fake_shell_backend())
+    path = str(tmp_path / "checkpoint.bin")
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        _, root, _ = build_tree(5)
+    _run_rounds(TreeScheduler(root), Checkpoint(path), 3)
+    with open(path, "ab") as f:
+        f.write(TORN_FRAME)
+
+    # resumed after the first crash, progress continues and then crashes again
+    checkpoint, scheduler = _restore(path)
+    assert scheduler.round == 3
+    _run_rounds(scheduler, checkpoint, 2)
+    with open(path, "ab") as f:
+        f.write(TORN_FRAME)
+
+    _, scheduler = _restore(path)
+    assert scheduler.round == 5
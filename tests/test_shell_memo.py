@@ -0,0 +1,43 @@
+import pytest
+
+from runtimes.shell_memo import is_read_only
+
+
+@pytest.mark.parametrize(
+    "command, read_only",
+    [
+        ("ls -la", True),
+        ("cat a.txt | grep foo | wc -l", True),
+        ("git status && git log --oneline -5", True),
+        ("find . -name '*.py'", True),
+        ("tree -L 2", True),
+        ("file main.py", True),
+        ("ls 2>/dev/null", True),
+        ("ls > /dev/null; pwd", True),
+        ("grep -r foo . 2>&1", True),
+        # writes files
+        ("tree -o out.txt", False),
+        ("tree -ao out.txt", False),
+        ("git diff --output=patch.diff", False),
+        ("git log --output patch.diff", False),
+        ("file -C -m magic", False),
+        ("file --compile -m magic", False),
+        ("find . -delete", False),
+        ("find . -exec rm {} ;", False),
+        ("rg --pre ./script foo", False),
+        ("ls > /dev/nullx", False),
+        ("ls >/dev/null/x", False),
+        ("ls > out.txt", False),
+        ("echo hi", False),
+        # not known to be read-only
+        ("git commit -m x", False),
+        ("git", False),
+        ("ls & rm -rf x", False),
+        ("ls $(rm -rf x)", False),
+        ("cat `rm -rf x`", False),
+        ("ls 'unterminated", False),
+        ("", False),
+    ],
+)
+def test_is_read_only(command: str, read_only: bool):
+    assert is_read_only(command) == read_only
@@ -0,0 +1,57 @@
+import time
+from threading import Lock
+
+from models.agents.tools import ToolDispatch
+
+CALL_SECONDS = 0.3
+
+
+def _dispatch(log: list[tuple[str, str]]) -> ToolDispatch:
+    lock = Lock()
+
+    def execute(tool_call):
+        with lock:
+            log.append(("start", tool_call["id"]))
+        time.sleep(CALL_SECONDS)
+        with lock:
+            log.append(("end", tool_call["id"]))
+        return tool_call["id"]
+
+    return ToolDispatch(execute, lambda tool_call: tool_call["args"]["safe"])
+
+
+def _call(call_id: str, safe: bool) -> dict:
+    return {"id": call_id, "name": "tool", "args": {"safe": safe}}
+
+
+def test_parallel_safe_calls_run_as_a_batch():
+    log = []
+    calls = [_call("a", True), _call("b", True), _call("c", True)]
+    start = time.perf_counter()
+    assert _dispatch(log).results(calls) == ["a", "b", "c"]
+    assert time.perf_counter() - start < 2 * CALL_SECONDS
+
+
+def test_ordered_call_is_a_barrier():
+    log = []
+    calls = [_call("a", True), _call("w", False), _call("b", True), _call("c", True)]
+    start = time.perf_counter()
+    assert _dispatch(log).results(calls) == ["a", "w", "b", "c"]
+    # a, then w, then b and c together
+    assert time.perf_counter() - start < 4 * CALL_SECONDS
+    assert log.index(("end", "a")) < log.index(("start", "w"))
+    assert log.index(("end", "w")) < min(
+        log.index(("start", "b")), log.index(("start", "c"))
+    )
+
+
+def test_early_calls_finish_before_ordered_ones():
+    log = []
+    dispatch = _dispatch(log)
+    dispatch.submit_early(_call("a", True))
+    dispatch.submit_early(_call("w", False))
+    dispatch.submit_early(_call("b", True))  # held back, comes after an ordered call
+    calls = [_call("a", True), _call("w", False), _call("b", True)]
+    assert dispatch.results(calls) == ["a", "w", "b"]
+    assert log.index(("end", "a")) < log.index(("start", "w"))
+    assert log.index(("end", "w")) < log.index(("start", "b"))